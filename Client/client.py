@@ -1,4 +1,5 @@
 import os
+import time
 import threading
 import tkinter as tk
 import socket
@@ -9,7 +10,7 @@ from tkinter import colorchooser
 from tkmacosx import Button
 import hashlib
 from Common.message_handler import *
-from Common.file_io import FileInfo, get_file_type, FileType, read_file_for_network, DirectoryInfo, receive_network_file_binary, receive_network_file
+from Common.file_io import FileInfo, get_file_type, FileType, read_file_for_network, DirectoryInfo, receive_network_file_binary, receive_network_file, receive_ndjson_stream
 
 class FileSharingApp(tk.Tk):
     """
@@ -264,6 +265,10 @@ class MyFilesPage(Page):
     def __init__(self, parent, bg_color, text_color, button_color):
         super().__init__(parent, bg_color, text_color, button_color)
         self.current_dir = None
+        self.page_size = 500
+        # The last listing received, and the token to ask the server for the changes since then
+        self.dir_token = None
+        self.dir_entries = {}
     
     # creates content
     def create_content(self):
@@ -325,6 +330,12 @@ class MyFilesPage(Page):
         self.delete_button = Button(button_frame, text="Delete File", command=self.delete_files, font=("Figtree", 14), bg=self.button_color, fg=self.text_color, borderless=1, state=tk.DISABLED)
         self.delete_button.pack(side=tk.RIGHT, padx=10)
 
+        self.rename_button = Button(button_frame, text="Rename", command=self.rename_files, font=("Figtree", 14), bg=self.button_color, fg=self.text_color, borderless=1, state=tk.DISABLED)
+        self.rename_button.pack(side=tk.RIGHT, padx=10)
+
+        self.copy_button = Button(button_frame, text="Copy", command=self.copy_files, font=("Figtree", 14), bg=self.button_color, fg=self.text_color, borderless=1, state=tk.DISABLED)
+        self.copy_button.pack(side=tk.RIGHT, padx=10)
+
         self.create_subfolder_button = Button(nav_frame, text="Create Subfolder", command=self.create_subfolder, font=("Figtree", 14), bg=self.button_color, fg=self.text_color, borderless=1)
         self.create_subfolder_button.pack(side=tk.RIGHT, padx=10)
         
@@ -352,33 +363,78 @@ class MyFilesPage(Page):
         except Exception as e:
             self.show_error(f"Error handling double-click: {e}")
 
-    # requests files from server
+    # requests files from server, streamed so the list fills in as they arrive
     def request_files(self):
-        dir_message = DirMessage()
         try:
             if self.master.con is None:
                 print("No connection")
                 return
             
-            self.master.con.sendall(dir_message.construct_message_json().encode())
+            entries = {}
+            cursor = None
+            token = self.dir_token
+            while True:
+                # Only one level is shown, so only one level is requested. The token is only valid for the first page, and pages are only used if the server does not stream
+                dir_message = DirMessage(depth=1, page_size=self.page_size, cursor=cursor, token=token if cursor is None else None, encoding=DirEncoding.Compact, stream=cursor is None)
+                self.master.con.sendall(dir_message.construct_message_json().encode())
 
-            dir_resp = MessageBasis.parse_from_json(self.master.con.recv(1024).strip(b'\x00').decode("utf-8"))
-            code, message, curr, size = dir_resp.code(), dir_resp.message(), dir_resp.curr_dir(), dir_resp.size()
-            
-            self.current_dir = curr
-            
-            self.master.con.sendall(AckMessage(200, "OK").construct_message_json().encode())
-            
-            if code == 200:
-                dir_struct_data = receive_network_file_binary(self.master.con, size).decode("utf-8")
-                dir_struct = DirectoryInfo.from_dict(json.loads(dir_struct_data))
-                self.display_files(dir_struct)
+                dir_resp = MessageBasis.parse_from_json(self.master.con.recv(1024).strip(b'\x00').decode("utf-8"))
+                code, message, curr, size = dir_resp.code(), dir_resp.message(), dir_resp.curr_dir(), dir_resp.size()
                 
-                # Update path display
-                path_text = f"Path: /{self.current_dir}" if self.current_dir else "Path: /"
-                self.path_label.config(text=path_text)
-            else:
-                print(f"Failed to get directory structure because: {message}")  
+                if code == 304:
+                    # Nothing changed since the last listing
+                    entries = self.dir_entries
+                    break
+                if code != 200:
+                    print(f"Failed to get directory structure because: {message}")
+                    self.dir_token = None
+                    return
+
+                self.current_dir = curr
+                
+                self.master.con.sendall(AckMessage(200, "OK").construct_message_json().encode())
+
+                if dir_resp.stream():
+                    self.path_label.config(text=f"Path: /{self.current_dir}" if self.current_dir else "Path: /")
+                    self.file_list.delete(0, tk.END)
+                    for record in receive_ndjson_stream(self.master.con):
+                        item = DirectoryInfo(record["name"]) if record["kind"] == "directory" else FileInfo.from_dict(record)
+                        entries[item.name()] = item
+                        self.file_list.insert(tk.END, self.entry_label(item))
+                        if len(entries) % 100 == 1:
+                            self.file_list.update_idletasks() # Show what has arrived so far
+                    
+                    token = dir_resp.token()
+                    break
+                
+                dir_struct_data = json.loads(receive_network_file_binary(self.master.con, size).decode("utf-8"))
+                if dir_resp.delta():
+                    entries = dict(self.dir_entries)
+                    for name in dir_struct_data["removed"]:
+                        entries.pop(name, None)
+                    for item in DirectoryInfo.from_dict({"name": "", "contents": dir_struct_data["added"] + dir_struct_data["changed"]}).contents():
+                        entries[item.name()] = item
+                    break
+
+                for item in DirectoryInfo.from_compact(dir_struct_data).contents():
+                    entries[item.name()] = item
+
+                if cursor is None:
+                    token = dir_resp.token()
+                cursor = dir_resp.cursor()
+                if cursor is None:
+                    break
+
+            if dir_resp.delta() or code == 304:
+                token = dir_resp.token()
+            self.dir_token = token
+            self.dir_entries = entries
+            if not dir_resp.stream():
+                self.display_files(DirectoryInfo(self.current_dir or "", list(entries.values())))
+            
+            # Update path display
+            path_text = f"Path: /{self.current_dir}" if self.current_dir else "Path: /"
+            self.path_label.config(text=path_text)
         except Exception as e:
             print(f"Error: {e}")
 
@@ -386,10 +442,11 @@ class MyFilesPage(Page):
     def display_files(self, dir_info):
         self.file_list.delete(0, tk.END)
         for item in dir_info.contents():
-            if isinstance(item, FileInfo):
-                self.file_list.insert(tk.END, f"{item.name()} (f)")
-            elif isinstance(item, DirectoryInfo):
-                self.file_list.insert(tk.END, f"{item.name()} (d)")
+            self.file_list.insert(tk.END, self.entry_label(item))
+
+    # the text shown in the list for a file or directory
+    def entry_label(self, item) -> str:
+        return f"{item.name()} (d)" if isinstance(item, DirectoryInfo) else f"{item.name()} (f)"
 
     # thread for uploading files
     def upload_files(self):
@@ -531,6 +588,40 @@ class MyFilesPage(Page):
         except Exception as e:
             print(f"Error: {e}")
 
+    # thread for renaming (or moving) files & folders
+    def rename_files(self):
+        self.relocate_selected(RelocateAction.Move, "Rename", "renamed")
+
+    # thread for copying files & folders
+    def copy_files(self):
+        self.relocate_selected(RelocateAction.Copy, "Copy", "copied")
+
+    def relocate_selected(self, action, title, done):
+        selected = self.file_list.curselection()
+        if not selected:
+            return
+
+        source = self.file_list.get(selected).split(" ")[0].strip()
+        destination = simpledialog.askstring(title, f"Enter the new path of {source}:", initialvalue=source)
+        if destination is not None and len(destination.strip()) > 0:
+            threading.Thread(target=self._relocate, args=(source, destination.strip(), action, done)).start()
+
+    # moves or copies a file or folder on the server
+    def _relocate(self, source, destination, action, done):
+        try:
+            self.master.con.sendall(RelocateMessage(source, destination, action).construct_message_json().encode())
+            relocate_resp = self.master.con.recv(1024).strip(b'\x00').decode("utf-8")
+            relocate_message = MessageBasis.parse_from_json(relocate_resp)
+            if relocate_message is not None and isinstance(relocate_message, AckMessage):
+                if relocate_message.code() == 200:
+                    self.after(0, lambda: messagebox.showinfo("Success", f"{source} {done} successfully."))
+                    self.after(0, self.request_files)
+                else:
+                    self.after(0, lambda: messagebox.showinfo("Failure", f"{source} could not be {done} because: {relocate_message.message()}"))
+            self.after(0, self.update_button_states)
+        except Exception as e:
+            print(f"Error: {e}")
+
     # thread for creating subfolder
     def create_subfolder(self):
         folder_name = simpledialog.askstring("Create Subfolder", "Enter the name of the subfolder:")
@@ -626,10 +717,15 @@ class MyFilesPage(Page):
             self.download_button.config(state=tk.DISABLED)
             self.delete_button.config(state=tk.DISABLED)
             self.open_folder_button.config(state=tk.DISABLED)
+            self.rename_button.config(state=tk.DISABLED)
+            self.copy_button.config(state=tk.DISABLED)
             return
 
         selected_index = selected_indices[0]
         selected_item = self.file_list.get(selected_index)
+        relocatable = tk.NORMAL if selected_item.endswith(" (f)") or selected_item.endswith(" (d)") else tk.DISABLED
+        self.rename_button.config(state=relocatable)
+        self.copy_button.config(state=relocatable)
         if selected_item.endswith(" (f)"):
             self.download_button.config(state=tk.NORMAL)
             self.delete_button.config(state=tk.NORMAL)
@@ -675,6 +771,8 @@ class PerformancePage(Page):
         self.data_rate = None
         self.file_transfer_time = None
         self.latency = None
+        self.jitter = None
+        self.last_pong = None # The server's timestamp from the last ping, and when it was received
 
     # create content
     def create_content(self):
@@ -726,29 +824,60 @@ class PerformancePage(Page):
         )
         self.latency_label.pack(pady=10)
 
+        self.jitter_label = tk.Label(
+            self,
+            text=f"Jitter (s): {self.jitter}",
+            font=("Figtree", 14),
+            fg=self.text_color,
+            bg=self.bg_color
+        )
+        self.jitter_label.pack(pady=10)
+
         self.get_stats()
 
     # updates labels
     def update_labels(self):
         data_rate_rounded = round(self.data_rate, 2) if self.data_rate is not None else 0
         file_transfer_rounded = round(self.file_transfer_time, 2) if self.file_transfer_time is not None else 0
-        latency_rounded = round(self.latency, 2) if self.latency is not None else 0
+        latency_rounded = round(self.latency, 4) if self.latency is not None else 0
+        jitter_rounded = round(self.jitter, 4) if self.jitter is not None else 0
 
         self.data_rate_label.config(text=f"Data Rate (MB/s): {data_rate_rounded}")
         self.file_transfer_label.config(text=f"File Transfer Time (s): {file_transfer_rounded}")
         self.latency_label.config(text=f"Latency (s): {latency_rounded}")
+        self.jitter_label.config(text=f"Jitter (s): {jitter_rounded}")
+
+    # pings the server, so it can measure the round trip time. Returns the round trip time seen by the client
+    def ping(self) -> float | None:
+        echo, held = None, None
+        if self.last_pong is not None:
+            echo, received = self.last_pong
+            held = time.perf_counter() - received
+
+        sent = time.perf_counter()
+        self.master.con.sendall(PingMessage(sent, echo, held).construct_message_json().encode())
+        pong = MessageBasis.parse_from_json(self.master.con.recv(1024).strip(b'\x00').decode("utf-8"))
+        received = time.perf_counter()
+        if pong is None or not isinstance(pong, PingMessage) or pong.sent() != sent:
+            return None
+
+        self.last_pong = (pong.server_time(), received)
+        return received - sent - pong.processing()
 
     # gets stats from server on recent upload or download
     def get_stats(self):
         try:
-            
+            for _ in range(2): # The second ping carries the echo the server measures from
+                self.ping()
+
             self.master.con.sendall(StatsMessage().construct_message_json().encode())
-            stats_resp = self.master.con.recv(1024).strip(b'\x00').decode("utf-8")
+            stats_resp = self.master.con.recv(4096).strip(b'\x00').decode("utf-8")
             stats_message = MessageBasis.parse_from_json(stats_resp)
             if stats_message is not None and isinstance(stats_message, StatsMessage):
                 self.data_rate = stats_message.data_rates()
                 self.file_transfer_time = stats_message.file_transfer_time()
                 self.latency = stats_message.latency()
+                self.jitter = stats_message.jitter()
                 self.update_labels()
             else:
                 self.show_error(f"Failed to get performance stats: {stats_message.message()}")
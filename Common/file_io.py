@@ -1,9 +1,15 @@
 from pathlib import Path
+from collections import deque
+import json
 import os
 from enum import Enum
 from math import ceil
 from socket import socket
-from typing import Self
+from typing import Self, Iterable, Iterator
+from sys import intern
+import tempfile
+
+from Common.tracing import tracer
 
 file_buffer_size = 4096
 
@@ -12,11 +18,34 @@ class FileType(Enum):
     Audio = "audio"
     Video = "video"
 
+class SyncPolicy(Enum):
+    """
+    How much of a received file is synced to disk before it is published
+    """
+    Never = "none" # Left to the OS, so a crash can lose a file that was published
+    End = "end" # Synced once, before it is published
+    Periodic = "periodic" # Synced every sync_bytes as it is written, and before it is published
+
+sync_bytes = 16 * 1024 * 1024
+
+# os.umask can only be read by setting it, which is not safe once other threads are making files, so it is read once here
+process_umask = os.umask(0)
+os.umask(process_umask)
+
+# Looking a kind up by value through the enum's constructor is several times slower than a dictionary, which adds up when parsing large listings
+file_types = {kind.value: kind for kind in FileType}
+
 def get_file_type(path: Path) -> FileType | None:
     if path is None:
         return None
     
-    match path.suffix:
+    return get_suffix_type(path.suffix)
+
+def get_suffix_type(suffix: str) -> FileType:
+    """
+    Determines the file type from the suffix (extension) of a file name, including the '.'
+    """
+    match suffix:
         case ".mp4" | ".mov" | ".avi" | ".wmv":
             return FileType.Video
         case ".mp3" | ".wav" | ".aac" | ".flac" | ".aiff":
@@ -41,41 +70,56 @@ def get_file_total_size(path: Path | str) -> int | None:
 
 class FileInfo:
     """
-    A structure that contains the path & allows for relative moving
+    A structure that contains the path & allows for relative moving. The modification time is in seconds since the epoch, and the content hash (a SHA-256 hex digest) is only known for some files.
+    Listings can hold millions of these, so they use slots, and the names & owners are interned (owners especially repeat across a listing).
     """
+    __slots__ = ("__parent", "__name", "__owner", "__kind", "__size", "__mtime", "__hash", "__path")
 
-    def __init__(self, name: str | str, owner_username, kind: FileType, size: int, parent = None):
+    def __init__(self, name: str | str, owner_username, kind: FileType, size: int = 0, parent = None, mtime: float | None = None, content_hash: str | None = None):
         self.__parent = parent
-        self.__name = name
-        self.__owner = owner_username
+        self.__name = intern(name)
+        self.__owner = intern(owner_username) if isinstance(owner_username, str) else owner_username
         self.__kind = kind
+        self.__size = size if size is not None else 0
+        self.__mtime = mtime
+        self.__hash = content_hash
+        self.__path = None
 
     def to_dict(self) -> dict:
-        return {
+        result = {
             "kind": "file",
             "name": self.__name,
             "file_kind": self.__kind.value,
-            "owner": self.__owner
+            "owner": self.__owner,
+            "size": self.__size
         }
+        if self.__mtime is not None:
+            result["mtime"] = int(self.__mtime)
+        if self.__hash is not None:
+            result["hash"] = self.__hash
+
+        return result
     def from_dict(data: dict, parent = None) -> Self:
         try:
             name = data["name"]
-            file_kind = FileType(data["file_kind"])
+            file_kind = file_types[data["file_kind"]]
             owner = data["owner"]
+            size = int(data.get("size", 0))
         except:
             name = None
             file_kind = None
             owner = None
+            size = None
 
-        if name == None or file_kind == None:
+        if name == None or file_kind == None or size == None:
             raise ValueError("The dictionary does not contain enough data to fill this structure")
         
-        return FileInfo(name, owner, file_kind, parent)
+        return FileInfo(name, owner, file_kind, size, parent, data.get("mtime"), data.get("hash"))
           
     def __eq__(self, other) -> bool:
         if self is None and other is None:
             return True
-        elif self is None or other is None:
+        elif self is None or other is None or not isinstance(other, FileInfo):
             return False
         
         return self.__name == other.__name and self.__owner == other.__owner and self.__kind == other.__kind
@@ -86,20 +130,32 @@ class FileInfo:
         return self.__kind
     def owner_username(self) -> str:
         return self.__owner
+    def size(self) -> int:
+        return self.__size
+    def mtime(self) -> float | None:
+        return self.__mtime
+    def content_hash(self) -> str | None:
+        return self.__hash
+    def set_content_hash(self, content_hash: str | None):
+        self.__hash = content_hash
     def parent(self):
         return self.__parent
     def set_parent(self, parent):
         self.__parent = parent
-    
+        self.__path = None
+
+    def clear_cached_path(self):
+        self.__path = None
     def target_path_relative(self) -> Path:
         """
-        Returns the current path relative to the root
+        Returns the current path relative to the root. The path is cached, so after the first call this is O(1).
         """
-
         if self.__parent is None:
             return None
-        
-        return self.__parent.target_path_relative().joinpath(self.__name)
+
+        if self.__path is None:
+            self.__path = self.__parent.target_path_relative().joinpath(self.__name)
+        return self.__path
     
     def target_path_absolute(self, env_path: Path) -> str:
         """
@@ -108,14 +164,21 @@ class FileInfo:
         return env_path.joinpath(self.target_path_relative())
 
 class DirectoryInfo:
+    """
+    A directory, and the files & directories in it. Like FileInfo, this uses slots, interned names, and a cached path.
+    Every walk of the tree (encoding, decoding, comparing) uses an explicit stack instead of recursion, so very deep trees cannot hit the recursion limit.
+    """
+    __slots__ = ("__name", "__contents", "__parent", "__path")
+
     def __init__(self, name: str, contents: list[FileInfo | Self] | None = None, parent: Self | None = None):
-        self.__name = name
+        self.__name = intern(name)
         if contents is None:
             self.__contents = []
         else:
             self.__contents = contents
 
         self.__parent = parent
+        self.__path = None
 
         # Build proper order
         for content in self.__contents:
@@ -123,14 +186,29 @@ class DirectoryInfo:
                 content.set_parent(self)
 
     def to_dict(self) -> dict:
-        contents = []
-        for item in self.__contents:
-            contents.append(item.to_dict())
-        return {
+        result = {
             "kind": "directory",
             "name": self.__name,
-            "contents": contents
-        } 
+            "contents": []
+        }
+
+        stack = [(self, result["contents"])]
+        while len(stack) != 0:
+            directory, contents = stack.pop()
+            for item in directory.__contents:
+                if isinstance(item, DirectoryInfo):
+                    entry = {
+                        "kind": "directory",
+                        "name": item.__name,
+                        "contents": []
+                    }
+                    stack.append((item, entry["contents"]))
+                else:
+                    entry = item.to_dict()
+
+                contents.append(entry)
+
+        return result
     def from_dict(data: dict) -> Self | None:
         try:
             name = data["name"]
@@ -142,22 +220,130 @@ class DirectoryInfo:
         if name == None or contents == None:
             raise ValueError("The contents could not be read")
         
-        trueContents = []
-        for info in contents:
-            if info["kind"] == "directory":
-                trueContents.append(DirectoryInfo.from_dict(info))
-            elif info["kind"] == "file":
-                trueContents.append(FileInfo.from_dict(info))
-
-        return DirectoryInfo(name, trueContents)
+        result = DirectoryInfo(name)
+        stack = [(result, contents)]
+        try:
+            while len(stack) != 0:
+                directory, contents = stack.pop()
+                for info in contents:
+                    if info["kind"] == "directory":
+                        item = DirectoryInfo(info["name"], parent=directory)
+                        stack.append((item, list(info["contents"])))
+                    elif info["kind"] == "file":
+                        item = FileInfo.from_dict(info, directory)
+                    else:
+                        continue
+
+                    directory.__contents.append(item)
+        except (KeyError, TypeError):
+            raise ValueError("The contents could not be read")
+
+        return result
+
+    compact_kinds = ["directory"] + [kind.value for kind in FileType]
+
+    def to_compact(self) -> dict:
+        """
+        Encodes the tree as a table of entries, one list per column, rather than one dictionary per entry. Each entry holds the index of its parent entry (-1 for this directory), and the entries of a directory are kept together & in order, after their parent.
+        The kinds and owners are stored once, and referred to by their index.
+        """
+        kinds = {kind: index for index, kind in enumerate(DirectoryInfo.compact_kinds)}
+        owners = {}
+        columns = {
+            "parent": [],
+            "name": [],
+            "kind": [],
+            "size": [],
+            "mtime": [],
+            "owner": []
+        }
+        hashes = []
+
+        queue = deque([(self, -1)])
+        while len(queue) != 0:
+            directory, parent = queue.popleft()
+            for item in directory.contents():
+                index = len(columns["name"])
+                columns["parent"].append(parent)
+                columns["name"].append(item.name())
+                if isinstance(item, DirectoryInfo):
+                    columns["kind"].append(0)
+                    columns["size"].append(0)
+                    columns["mtime"].append(None)
+                    columns["owner"].append(None)
+                    hashes.append(None)
+                    queue.append((item, index))
+                else:
+                    columns["kind"].append(kinds[item.kind().value])
+                    columns["size"].append(item.size())
+                    columns["mtime"].append(int(item.mtime()) if item.mtime() is not None else None)
+                    columns["owner"].append(owners.setdefault(item.owner_username(), len(owners)))
+                    hashes.append(item.content_hash())
+
+        if any(content_hash is not None for content_hash in hashes):
+            columns["hash"] = hashes
+
+        return {
+            "format": "compact",
+            "name": self.__name,
+            "kinds": DirectoryInfo.compact_kinds,
+            "owners": list(owners),
+            "columns": columns
+        }
+    def from_compact(data: dict) -> Self:
+        try:
+            name = data["name"]
+            kinds = list(data["kinds"])
+            owners = list(data["owners"])
+            columns = dict(data["columns"])
+            parents, names, entry_kinds, sizes, mtimes, entry_owners = columns["parent"], columns["name"], columns["kind"], columns["size"], columns["mtime"], columns["owner"]
+        except:
+            raise ValueError("The contents could not be read")
+
+        hashes = columns.get("hash")
+        if len({len(parents), len(names), len(entry_kinds), len(sizes), len(mtimes), len(entry_owners)}) > 1 or (hashes is not None and len(hashes) != len(names)):
+            raise ValueError("The columns are not all the same length")
+
+        result = DirectoryInfo(name)
+        entries = []
+        try:
+            for i in range(len(names)):
+                parent = result if parents[i] < 0 else entries[parents[i]]
+                if not isinstance(parent, DirectoryInfo):
+                    raise ValueError()
+
+                kind = kinds[entry_kinds[i]]
+                if kind == "directory":
+                    item = DirectoryInfo(names[i], parent=parent)
+                else:
+                    item = FileInfo(names[i], owners[entry_owners[i]], file_types[kind], sizes[i], parent, mtimes[i], hashes[i] if hashes is not None else None)
+
+                parent.add_content(item)
+                entries.append(item)
+        except (ValueError, IndexError, KeyError, TypeError):
+            raise ValueError(f"Entry {len(entries)} is not valid")
+
+        return result
     
     def __eq__(self, other) -> bool:
         if other is None and self is None:
             return True
-        elif other is None or self is None:
+        elif other is None or self is None or not isinstance(other, DirectoryInfo):
             return False
-        else:
-            return self.__name == other.__name and self.__files == other.__files and self.__dirs == other.__dirs
+
+        stack = [(self, other)]
+        while len(stack) != 0:
+            left, right = stack.pop()
+            if left.__name != right.__name or len(left.__contents) != len(right.__contents):
+                return False
+
+            for left_item, right_item in zip(left.__contents, right.__contents):
+                if isinstance(left_item, DirectoryInfo) and isinstance(right_item, DirectoryInfo):
+                    stack.append((left_item, right_item))
+                elif left_item != right_item:
+                    return False
+
+        return True
         
     def name(self) -> str:
         return self.__name
@@ -165,16 +351,51 @@ class DirectoryInfo:
         return self.__parent
     def set_parent(self, parent: Self | None):
         self.__parent = parent
+        self.clear_cached_path()
+
+    def clear_cached_path(self):
+        """
+        Forgets the cached path of this directory and everything below it, as they all depend on it
+        """
+        if self.__path is None:
+            return # Paths are cached from the top down, so nothing below a directory without one can have one either
+
+        stack = [self]
+        while len(stack) != 0:
+            directory = stack.pop()
+            if directory.__path is None:
+                continue
+
+            directory.__path = None
+            for item in directory.__contents:
+                if isinstance(item, DirectoryInfo):
+                    stack.append(item)
+                else:
+                    item.clear_cached_path()
 
     def target_path_relative(self) -> Path:
         """
-        Returns the current path relative to the root
+        Returns the current path relative to the root. The path is cached, so after the first call this is O(1).
         """
+        if self.__path is not None:
+            return self.__path
 
-        if self.__parent is None:
-            return Path("")
-        else:
-            return self.__parent.target_path_relative().joinpath(self.__name)
+        # Find the closest directory with a cached path, then fill in the paths on the way back down
+        missing = []
+        directory = self
+        while directory is not None and directory.__path is None:
+            missing.append(directory)
+            directory = directory.__parent
+
+        path = directory.__path if directory is not None else None
+        for directory in reversed(missing):
+            if directory.__parent is None:
+                path = Path("")
+            else:
+                path = path.joinpath(directory.__name)
+            directory.__path = path
+
+        return self.__path
     
     def target_path_absolute(self, env_path: Path) -> str:
         """
@@ -197,10 +418,11 @@ def read_file_for_network(path: Path, buff_size: int = file_buffer_size) -> list
     Reads the contents of a file as binary, and then splits it up into buff_size chunks
     """
     try:
-        f = open(path, 'rb')
+        with tracer.span("read", "disk", path=str(path)):
+            f = open(path, 'rb')
 
-        contents = f.read()
-        f.close()
+            contents = f.read()
+            f.close()
 
         return split_binary_for_network(contents, buff_size)
     except:
@@ -223,20 +445,29 @@ def split_binary_for_network(contents: bytes, buff_size: int = file_buffer_size)
 
     return result
     
-def receive_network_file(path: Path, s: socket, frame_size: int, buff_size: int = file_buffer_size) -> bool:
+def receive_network_file(path: Path, s: socket, frame_size: int, buff_size: int = file_buffer_size, digest = None, staging: Path | None = None, sync: SyncPolicy = SyncPolicy.Never, publish = os.replace) -> bool:
     """
-    Constructs the file sent over a network, assuming said file was sent using the split_binary_for_network protocol
+    Constructs the file sent over a network, assuming said file was sent using the split_binary_for_network protocol. If digest (ex. a hashlib object) is provided, everything written is also fed to it.
+    The file is written to a temporary file in staging (or next to path, if not given), which must be on the same file system as path. Once all of it is received, it is synced as sync says, and moved to path in one step by publish(temporary, path), so nobody ever sees a partial file at path. publish replaces whatever is at path by default; one that raises instead (ex. FileExistsError) fails the receive. If receiving fails, the temporary file is removed, and path is left as it was.
     """
     retry_count = 5
+    if frame_size < 0:
+        return False
+
+    try:
+        fd, temp_name = tempfile.mkstemp(prefix=".upload-", dir=staging if staging is not None else path.parent)
+    except Exception as e:
+        print(f"[IO] Network file recv failed with message '{str(e)}'")
+        return False
+
+    published = False
     try:
-        if frame_size < 0:
-            return False
-        
         total_windows = frame_size
         frame_size *= buff_size
         windows_so_far = 0.0
+        unsynced = 0
         
-        with open(path, 'wb') as f:
+        with open(fd, 'wb') as f:
             while frame_size > 0 and windows_so_far < total_windows:
                 try:
                     chunk = s.recv(buff_size)
@@ -245,9 +476,19 @@ def receive_network_file(path: Path, s: socket, frame_size: int, buff_size: int
                         return False
                     
                     if frame_size <= buff_size: # Last packet
-                        f.write(chunk.rstrip(b'\x00')) # Remove trailing zeroes from buffer packing
+                        data = chunk.rstrip(b'\x00') # Remove trailing zeroes from buffer packing
                     else:
-                        f.write(chunk)
+                        data = chunk
+
+                    with tracer.span("write", "disk", bytes=len(data)):
+                        f.write(data)
+                    if digest is not None:
+                        digest.update(data)
+
+                    unsynced += len(data)
+                    if sync == SyncPolicy.Periodic and unsynced >= sync_bytes:
+                        sync_file(f)
+                        unsynced = 0
 
                     frame_size -= len(chunk)
                     windows_so_far += len(chunk) / buff_size
@@ -258,10 +499,56 @@ def receive_network_file(path: Path, s: socket, frame_size: int, buff_size: int
                     retry_count -= 1
                     continue
 
+            if sync != SyncPolicy.Never:
+                sync_file(f)
+
+        os.chmod(temp_name, published_mode(path)) # mkstemp makes the file readable only by its owner
+        publish(temp_name, path)
+        published = True
+        if sync != SyncPolicy.Never:
+            sync_directory(path.parent) # So the rename itself survives a crash
         return True
     except Exception as e:
         print(f"[IO] Network file recv failed with message '{str(e)}'")
-        return False
+        return published
+    finally:
+        if not published:
+            try:
+                os.remove(temp_name)
+            except OSError:
+                pass
+
+def published_mode(path: Path) -> int:
+    """
+    Returns the permissions a received file is published with: those of the file it replaces, or the ones a new file would get under the process's umask
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        return 0o666 & ~process_umask
+
+def sync_file(f):
+    """
+    Writes the file's buffer, and syncs its data (but not its metadata, where the OS can tell them apart) to disk
+    """
+    with tracer.span("sync", "disk"):
+        f.flush()
+        getattr(os, "fdatasync", os.fsync)(f.fileno())
+def sync_directory(path: Path):
+    """
+    Syncs the directory, so that the files just created or renamed in it are kept. Not every OS can open directories, in which case this does nothing.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 def receive_network_file_binary(socket: socket, frame_size: int, buff_size: int = file_buffer_size) -> bytes | None:
     """
     Constructs the file sent over a network, assuming said file was sent using the split_binary_for_network protocol
@@ -300,4 +587,51 @@ def receive_network_file_binary(socket: socket, frame_size: int, buff_size: int
         return result
     except Exception as e:
         print(f"[IO] Network file recv failed with message '{str(e)}'")
-        return None
\ No newline at end of file
+        return None
+
+stream_end_kind = "end"
+
+def send_ndjson_stream(s: socket, records: Iterable[dict], batch_size: int = file_buffer_size) -> int:
+    """
+    Sends the records as lines of JSON, as they are produced, followed by an end record ({"kind": "end", "count": ...}). The first record is sent on its own so the receiver can start right away; after that, lines are gathered until batch_size bytes are ready, to save on system calls.
+    This returns how many records were sent.
+    """
+    count = 0
+    pending = []
+    pending_size = 0
+    for record in records:
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        pending.append(line)
+        pending_size += len(line)
+        count += 1
+
+        if count == 1 or pending_size >= batch_size:
+            s.sendall(b"".join(pending))
+            pending = []
+            pending_size = 0
+
+    pending.append(json.dumps({"kind": stream_end_kind, "count": count}, separators=(",", ":")).encode() + b"\n")
+    s.sendall(b"".join(pending))
+    return count
+
+def receive_ndjson_stream(s: socket, buff_size: int = file_buffer_size) -> Iterator[dict]:
+    """
+    Yields each record sent by send_ndjson_stream as soon as its line arrives, stopping after the end record (which is not yielded). A ValueError is raised if the connection closes first.
+    """
+    buffer = b""
+    while True:
+        chunk = s.recv(buff_size)
+        if chunk is None or len(chunk) == 0:
+            raise ValueError("The connection closed before the stream ended")
+
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop() # The last piece is an incomplete line (or empty)
+        for line in lines:
+            if len(line) == 0:
+                continue
+
+            record = json.loads(line)
+            if record.get("kind") == stream_end_kind:
+                return
+            yield record
@@ -6,12 +6,17 @@ from .message_handler import AckMessage
 class HttpCodes(Enum):
     Continue = 100
     Ok = 200
+    PartialContent = 206
+    NotModified = 304
     Unauthorized = 401
     Forbidden = 403
     NotFound = 404
     TooLarge = 406
     Conflict = 409
+    RangeNotSatisfiable = 416
     ImNotATeapot = 418
+    ServiceUnavailable = 503
+    InsufficientStorage = 507
 
     def __int__(self):
         return self.value
@@ -52,3 +57,14 @@ class ConflictError(HTTPErrorBasis):
     def __init__(self, reason: str):
         super().__init__(HttpCodes.Conflict, reason)
 
+class ServiceUnavailableError(HTTPErrorBasis):
+    def __init__(self, reason: str):
+        super().__init__(HttpCodes.ServiceUnavailable, reason)
+
+class InsufficientStorageError(HTTPErrorBasis):
+    def __init__(self, reason: str):
+        super().__init__(HttpCodes.InsufficientStorage, reason)
+
+class RangeNotSatisfiableError(HTTPErrorBasis):
+    def __init__(self, reason: str):
+        super().__init__(HttpCodes.RangeNotSatisfiable, reason)
@@ -3,7 +3,7 @@ from enum import Enum
 from typing import Self, Any
 from pathlib import Path
 
-from Server.io_tools import FileType
+from Common.file_io import FileType
 
 """
 
@@ -26,6 +26,9 @@ class MessageType(Enum):
     Move = "move"
     Subfolder = "subfolder"
     Stats = "stats"
+    Search = "search"
+    Ping = "ping"
+    Relocate = "relocate"
 
 class MessageBasis:
     """
@@ -130,6 +133,12 @@ class MessageBasis:
                     return SubfolderMessage.parse(data, req)
                 case MessageType.Stats:
                     return StatsMessage.parse(data, req)
+                case MessageType.Search:
+                    return SearchMessage.parse(data, req)
+                case MessageType.Relocate:
+                    return RelocateMessage.parse(data, req)
+                case MessageType.Ping:
+                    return PingMessage.parse(data, req)
         except:
             return None
 
@@ -257,11 +266,22 @@ class UploadMessage(MessageBasis):
         return UploadMessage(name, kind, size)
 
 class DownloadMessage(MessageBasis):
-    def __init__(self, *args):
+    def __init__(self, *args, ranges: list[tuple[int, int | None]] | None = None, total_size: int | None = None):
         """
         If the arguments contains one element, it expects the path for a request. If it contains 4 elements, it expects the status code, message, file kind, and file size. The file kind and file size must either be a value, or none. It cannot be a mixed state.
+
+        For requests, ranges are the byte ranges of the file to send, each a start and an end (exclusive, or None for the end of the file). For responses, ranges are the byte ranges sent, and total_size is the size of the whole file in bytes.
         """
 
+        self.__ranges = None
+        self.__total_size = None
+        if ranges is not None:
+            if len(ranges) == 0:
+                raise ValueError("At least one range must be given")
+            self.__ranges = [(int(start), int(end) if end is not None else None) for start, end in ranges]
+            if any(start < 0 or (end is not None and end <= start) for start, end in self.__ranges):
+                raise ValueError("Each range must start at or after zero, and end after it starts")
+
         if len(args) == 1:
             self.__path = args[0]
             self.__is_response = False
@@ -283,6 +303,7 @@ class DownloadMessage(MessageBasis):
             else:
                 self.__kind = FileType(kind)
                 self.__size = int(size)
+                self.__total_size = int(total_size) if total_size is not None else None
         else:
             raise ValueError("too many, or not enough, positional arguments supplied")
         
@@ -293,9 +314,12 @@ class DownloadMessage(MessageBasis):
         if self.is_response():
             return {}
         
-        return {
+        result = {
             "path": self.__path
         }
+        if self.__ranges is not None:
+            result["ranges"] = [[start, end] for start, end in self.__ranges]
+        return result
     def data_response(self) -> dict:
         if self.is_request():
             return {}
@@ -309,6 +333,10 @@ class DownloadMessage(MessageBasis):
                 "kind": self.__kind.value,
                 "size": self.__size 
             }
+            if self.__ranges is not None:
+                format["ranges"] = [[start, end] for start, end in self.__ranges]
+            if self.__total_size is not None:
+                format["total_size"] = self.__total_size
 
         return {
             "status": self.__status,
@@ -346,6 +374,16 @@ class DownloadMessage(MessageBasis):
             return self.__size
         else:
             return None
+    def ranges(self) -> list[tuple[int, int | None]] | None:
+        """
+        Returns the byte ranges asked for (for requests), or sent (for responses), or None for the whole file
+        """
+        return self.__ranges
+    def total_size(self) -> int | None:
+        if self.is_response():
+            return self.__total_size
+        else:
+            return None
     
     def parse(data: dict, req: bool = True) -> Self:
         if req:
@@ -354,7 +392,7 @@ class DownloadMessage(MessageBasis):
             if path == None:
                 raise ValueError("Not enough data to fill this message")
             else:
-                return DownloadMessage(path)
+                return DownloadMessage(path, ranges=data.get("ranges"))
         else:
             try:
                 status = int(data["status"])
@@ -371,7 +409,7 @@ class DownloadMessage(MessageBasis):
             if len(format) == 0:
                 return DownloadMessage(status, message, None, None)
             else:
-                return DownloadMessage(status, message, format["kind"], format["size"])
+                return DownloadMessage(status, message, format["kind"], format["size"], ranges=format.get("ranges"), total_size=format.get("total_size"))
 
 class DeleteMessage(MessageBasis):
     def __init__(self, path: str | Path):
@@ -398,14 +436,44 @@ class DeleteMessage(MessageBasis):
         else:
             return DeleteMessage(path)
 
+class DirSort(Enum):
+    """
+    The order that entries of a paged directory listing are returned in
+    """
+    Name = "name"
+    Size = "size"
+    Kind = "kind"
+
+class DirEncoding(Enum):
+    """
+    How the directory structure of a Dir response is encoded. Tree nests a dictionary per entry, compact is the table made by DirectoryInfo.to_compact.
+    """
+    Tree = "tree"
+    Compact = "compact"
+
 class DirMessage(MessageBasis):
-    def __init__(self, *args):
+    def __init__(self, *args, depth: int | None = None, page_size: int | None = None, cursor: str | None = None, sort: DirSort = DirSort.Name, descending: bool = False, token: str | None = None, delta: bool = False, encoding: DirEncoding = DirEncoding.Tree, hashes: bool = False, stream: bool = False):
         """
         If no arguments are provided, the message is a request. Otherwise, it expects 4 arguments: code, message, curr_dir, and size. 
+
+        For requests, depth limits how many levels of the tree are returned (None for all), and page_size limits how many entries of the current directory are returned (None for all). The cursor continues a previous page. The entries are ordered by sort.
+        A request with a depth of 1 can provide the token of an earlier response, to only get the changes since then. The encoding picks how the structure is sent, and hashes asks for the content hashes the server knows.
+        If stream is true, the entries are sent as lines of JSON while the server walks the directory, rather than as one structure (see receive_ndjson_stream). Paging, the encoding, and hashes do not apply to streams.
+        For responses, cursor is the value to request the next page with, or None if this was the last page. The token describes the listing sent, delta is true if only the changes since the request's token are sent, and stream is true if the entries follow as a stream.
         """
 
         if len(args) == 0:
             self.__is_response = False
+
+            if (depth is not None and int(depth) < 1) or (page_size is not None and int(page_size) < 1):
+                raise ValueError("The depth and page size must be at least one")
+
+            self.__depth = int(depth) if depth is not None else None
+            self.__page_size = int(page_size) if page_size is not None else None
+            self.__sort = DirSort(sort)
+            self.__descending = bool(descending)
+            self.__encoding = DirEncoding(encoding)
+            self.__hashes = bool(hashes)
         elif len(args) == 4:
             code = args[0]
             message = args[1]
@@ -423,7 +491,7 @@ class DirMessage(MessageBasis):
             if size_raw is None:
                 size = 0
             elif not isinstance(size_raw, int):
-                size = int(size)
+                size = int(size_raw)
             else:
                 size = size_raw
 
@@ -434,6 +502,11 @@ class DirMessage(MessageBasis):
             self.__size = size
         else:
             raise ValueError("Not enough arguments or too many")
+        
+        self.__cursor = cursor
+        self.__token = token
+        self.__delta = bool(delta)
+        self.__stream = bool(stream)
 
     def message_type(self) -> MessageType:
         return MessageType.Dir
@@ -441,17 +514,46 @@ class DirMessage(MessageBasis):
         if self.__is_response:
             return {}
         
-        return { }
+        result = { }
+        if self.__depth is not None:
+            result["depth"] = self.__depth
+        if self.__page_size is not None:
+            result["page_size"] = self.__page_size
+        if self.__cursor is not None:
+            result["cursor"] = self.__cursor
+        if self.__sort != DirSort.Name or self.__descending:
+            result["sort"] = self.__sort.value
+            result["descending"] = self.__descending
+        if self.__token is not None:
+            result["token"] = self.__token
+        if self.__encoding != DirEncoding.Tree:
+            result["encoding"] = self.__encoding.value
+        if self.__hashes:
+            result["hashes"] = True
+        if self.__stream:
+            result["stream"] = True
+
+        return result
     def data_response(self) -> dict:
         if not self.__is_response:
             return {}
         
-        return {
+        result = {
             "response": self.__code,
             "message": self.__message,
             "curr_dir": str(self.__curr_dir),
             "size": self.__size
         }
+        if self.__cursor is not None:
+            result["cursor"] = self.__cursor
+        if self.__token is not None:
+            result["token"] = self.__token
+        if self.__delta:
+            result["delta"] = True
+        if self.__stream:
+            result["stream"] = True
+
+        return result
     
     def is_request(self) -> bool:
         return not self.__is_response
@@ -478,10 +580,58 @@ class DirMessage(MessageBasis):
             return None
         else:
             return self.__size
+    def depth(self) -> int | None:
+        if self.is_request():
+            return self.__depth
+        else:
+            return None
+    def page_size(self) -> int | None:
+        if self.is_request():
+            return self.__page_size
+        else:
+            return None
+    def sort(self) -> DirSort | None:
+        if self.is_request():
+            return self.__sort
+        else:
+            return None
+    def descending(self) -> bool | None:
+        if self.is_request():
+            return self.__descending
+        else:
+            return None
+    def encoding(self) -> DirEncoding | None:
+        if self.is_request():
+            return self.__encoding
+        else:
+            return None
+    def hashes(self) -> bool | None:
+        if self.is_request():
+            return self.__hashes
+        else:
+            return None
+    def cursor(self) -> str | None:
+        return self.__cursor
+    def token(self) -> str | None:
+        return self.__token
+    def delta(self) -> bool:
+        return self.__delta
+    def stream(self) -> bool:
+        return self.__stream
     
     def parse(data: dict, req: bool = True) -> Self:
         if req:
-            return DirMessage()
+            return DirMessage(
+                depth=data.get("depth"),
+                page_size=data.get("page_size"),
+                cursor=data.get("cursor"),
+                sort=DirSort(data.get("sort", DirSort.Name.value)),
+                descending=bool(data.get("descending", False)),
+                token=data.get("token"),
+                encoding=DirEncoding(data.get("encoding", DirEncoding.Tree.value)),
+                hashes=bool(data.get("hashes", False)),
+                stream=bool(data.get("stream", False))
+            )
         else:
             try:
                 code = int(data["response"])
@@ -497,7 +647,7 @@ class DirMessage(MessageBasis):
             if code == None or message == None or curr_dir == None or size == None:
                 raise ValueError("The dictionary does not provide enough information, or the root directory is of invalid format")
             else:
-                return DirMessage(code, message, curr_dir, size)
+                return DirMessage(code, message, curr_dir, size, cursor=data.get("cursor"), token=data.get("token"), delta=bool(data.get("delta", False)), stream=bool(data.get("stream", False)))
 
 class MoveMessage(MessageBasis):
     def __init__(self, path: Path | str):
@@ -560,13 +710,63 @@ class SubfolderMessage(MessageBasis):
             raise ValueError("Not enough data supplied")
         else:
             return SubfolderMessage(path, action)
+
+class RelocateAction(Enum):
+    Move = "move" # Also used to rename
+    Copy = "copy"
+class RelocateMessage(MessageBasis):
+    def __init__(self, source: Path | str, destination: Path | str, action: RelocateAction):
+        """
+        Asks the server to move or copy the file or directory at source (relative to the current directory) to destination, without sending its contents over the network.
+        """
+        self.__source = Path(source)
+        self.__destination = Path(destination)
+        self.__action = action
+
+    def message_type(self) -> MessageType:
+        return MessageType.Relocate
+    def data(self) -> dict:
+        return {
+            "source": str(self.__source),
+            "destination": str(self.__destination),
+            "action": self.__action.value
+        }
+
+    def source(self) -> Path:
+        return self.__source
+    def destination(self) -> Path:
+        return self.__destination
+    def action(self) -> RelocateAction:
+        return self.__action
+
+    def parse(data: dict, req: bool = True) -> Self:
+        if not req:
+            raise ValueError("Relocate message has no response variant")
+
+        try:
+            source = data["source"]
+            destination = data["destination"]
+            action = RelocateAction(data["action"])
+        except:
+            source = None
+            destination = None
+            action = None
+
+        if source == None or destination == None or action == None:
+            raise ValueError("Not enough data supplied")
+        else:
+            return RelocateMessage(source, destination, action)
         
 class StatsMessage(MessageBasis):
-    def __init__(self, *args):
+    def __init__(self, *args, jitter: float | None = None, percentiles: dict | None = None):
         """
-        If the args contains no elements, it is a request. Otherwise, it expexts the data rates, file transfer times, and latency.
+        If the args contains no elements, it is a request. Otherwise, it expexts the data rates, file transfer times, and latency (the smoothed round trip time of the connection).
+
+        For responses, jitter is how much the round trip time varies, and percentiles holds the recent percentiles of the user and of the whole server, for each measurement (see the message format guide).
         """
 
+        self.__percentiles = None
+        self.__jitter = None
         if len(args) == 0:
             self.__request = True
             self.__data_rates = None
@@ -579,6 +779,8 @@ class StatsMessage(MessageBasis):
             self.__data_rates = args[0]
             self.__file_transfer_time = args[1]
             self.__latency = args[2]
+            self.__jitter = jitter
+            self.__percentiles = percentiles
 
         else:
             raise ValueError("Too many or not enough arguments")
@@ -588,11 +790,17 @@ class StatsMessage(MessageBasis):
     def data(self) -> dict:
         return {}
     def data_response(self) -> dict:
-        return {
+        result = {
             "data_rate": self.__data_rates,
             "file_transfer": self.__file_transfer_time,
             "latency": self.__latency
         }
+        if self.__jitter is not None:
+            result["jitter"] = self.__jitter
+        if self.__percentiles is not None:
+            result["percentiles"] = self.__percentiles
+
+        return result
     
     def is_request(self) -> bool:
         return self.__request
@@ -605,6 +813,10 @@ class StatsMessage(MessageBasis):
         return self.__file_transfer_time
     def latency(self) -> Any | None:
         return self.__latency
+    def jitter(self) -> float | None:
+        return self.__jitter
+    def percentiles(self) -> dict | None:
+        return self.__percentiles
     
     def parse(data: dict, req: bool = True) -> Self:
         if req:
@@ -622,4 +834,201 @@ class StatsMessage(MessageBasis):
             if data_rates == None or file_transfer == None or latency == None:
                 raise ValueError("The dictionary does not provide enough information, or the root directory is of invalid format")
             else:
-                return StatsMessage(data_rates, file_transfer, latency)
\ No newline at end of file
+                return StatsMessage(data_rates, file_transfer, latency, jitter=data.get("jitter"), percentiles=data.get("percentiles"))
+
+class PingMessage(MessageBasis):
+    def __init__(self, sent: float, echo: float | None = None, held: float | None = None, server_time: float | None = None, processing: float | None = None):
+        """
+        Measures the round trip time between the client and the server. sent is the time (on the sender's clock) the ping was sent, and is echoed back in the response.
+
+        For requests, echo is the server_time of the last response received, and held is how many seconds ago that response was received. This lets the server measure the round trip on its own clock.
+        For responses, server_time is a timestamp of the server's to echo in the next ping, and processing is how many seconds the server took to reply (to be taken off of the round trip). A message with a server_time is a response.
+        """
+        self.__sent = sent
+        self.__echo = echo
+        self.__held = held
+        self.__server_time = server_time
+        self.__processing = processing
+
+    def message_type(self) -> MessageType:
+        return MessageType.Ping
+    def data(self) -> dict:
+        result = { "sent": self.__sent }
+        if self.__echo is not None and self.__held is not None:
+            result["echo"] = self.__echo
+            result["held"] = self.__held
+
+        return result
+    def data_response(self) -> dict:
+        return {
+            "sent": self.__sent,
+            "time": self.__server_time,
+            "processing": self.__processing
+        }
+
+    def is_request(self) -> bool:
+        return self.__server_time is None
+    def is_response(self) -> bool:
+        return self.__server_time is not None
+
+    def sent(self) -> float:
+        return self.__sent
+    def echo(self) -> float | None:
+        return self.__echo
+    def held(self) -> float | None:
+        return self.__held
+    def server_time(self) -> float | None:
+        return self.__server_time
+    def processing(self) -> float | None:
+        return self.__processing
+
+    def parse(data: dict, req: bool = True) -> Self:
+        try:
+            sent = float(data["sent"])
+            if req:
+                echo = data.get("echo")
+                held = data.get("held")
+                return PingMessage(sent, float(echo) if echo is not None else None, float(held) if held is not None else None)
+            else:
+                return PingMessage(sent, server_time=float(data["time"]), processing=float(data["processing"]))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("The dictionary does not provide the times of the ping")
+
+class SearchMatch(Enum):
+    """
+    How the query of a search is matched against file names
+    """
+    Prefix = "prefix"
+    Substring = "substring"
+
+class SearchMessage(MessageBasis):
+    def __init__(self, *args, query: str = "", match: SearchMatch = SearchMatch.Substring, kind: FileType | None = None, min_size: int | None = None, max_size: int | None = None, owner: str | None = None, page_size: int | None = None, cursor: str | None = None):
+        """
+        If no arguments are provided, the message is a request. Otherwise, it expects 3 arguments: code, message, and size (the number of frames the results are sent in).
+
+        For requests, query is matched against the names of the files below the current directory, ignoring case. An empty query matches every file. The results can be narrowed to one kind of file, a size range (in bytes, inclusive), and an owner. The cursor continues a previous page.
+        For responses, cursor is the value to request the next page with, or None if this was the last page.
+        """
+
+        if len(args) == 0:
+            self.__is_response = False
+
+            query = str(query)
+            if "\x00" in query:
+                raise ValueError("The query cannot contain a null character")
+            if page_size is not None and int(page_size) < 1:
+                raise ValueError("The page size must be at least one")
+            if (min_size is not None and int(min_size) < 0) or (max_size is not None and int(max_size) < 0):
+                raise ValueError("The sizes cannot be negative")
+
+            self.__query = query
+            self.__match = SearchMatch(match)
+            self.__kind = FileType(kind) if kind is not None else None
+            self.__min_size = int(min_size) if min_size is not None else None
+            self.__max_size = int(max_size) if max_size is not None else None
+            self.__owner = owner
+            self.__page_size = int(page_size) if page_size is not None else None
+        elif len(args) == 3:
+            self.__is_response = True
+            self.__code = int(args[0])
+            self.__message = args[1]
+            self.__size = int(args[2]) if args[2] is not None else 0
+        else:
+            raise ValueError("Not enough arguments or too many")
+
+        self.__cursor = cursor
+
+    def message_type(self) -> MessageType:
+        return MessageType.Search
+    def data(self) -> dict:
+        if self.__is_response:
+            return {}
+
+        result = {
+            "query": self.__query
+        }
+        if self.__match != SearchMatch.Substring:
+            result["match"] = self.__match.value
+        if self.__kind is not None:
+            result["kind"] = self.__kind.value
+        if self.__min_size is not None:
+            result["min_size"] = self.__min_size
+        if self.__max_size is not None:
+            result["max_size"] = self.__max_size
+        if self.__owner is not None:
+            result["owner"] = self.__owner
+        if self.__page_size is not None:
+            result["page_size"] = self.__page_size
+        if self.__cursor is not None:
+            result["cursor"] = self.__cursor
+
+        return result
+    def data_response(self) -> dict:
+        if not self.__is_response:
+            return {}
+
+        result = {
+            "response": self.__code,
+            "message": self.__message,
+            "size": self.__size
+        }
+        if self.__cursor is not None:
+            result["cursor"] = self.__cursor
+
+        return result
+
+    def is_request(self) -> bool:
+        return not self.__is_response
+    def is_response(self) -> bool:
+        return self.__is_response
+
+    def code(self) -> int | None:
+        return self.__code if self.is_response() else None
+    def message(self) -> str | None:
+        return self.__message if self.is_response() else None
+    def size(self) -> int | None:
+        return self.__size if self.is_response() else None
+    def query(self) -> str | None:
+        return self.__query if self.is_request() else None
+    def match(self) -> SearchMatch | None:
+        return self.__match if self.is_request() else None
+    def kind(self) -> FileType | None:
+        return self.__kind if self.is_request() else None
+    def min_size(self) -> int | None:
+        return self.__min_size if self.is_request() else None
+    def max_size(self) -> int | None:
+        return self.__max_size if self.is_request() else None
+    def owner(self) -> str | None:
+        return self.__owner if self.is_request() else None
+    def page_size(self) -> int | None:
+        return self.__page_size if self.is_request() else None
+    def cursor(self) -> str | None:
+        return self.__cursor
+
+    def parse(data: dict, req: bool = True) -> Self:
+        if req:
+            kind = data.get("kind")
+            return SearchMessage(
+                query=data.get("query", ""),
+                match=SearchMatch(data.get("match", SearchMatch.Substring.value)),
+                kind=FileType(kind) if kind is not None else None,
+                min_size=data.get("min_size"),
+                max_size=data.get("max_size"),
+                owner=data.get("owner"),
+                page_size=data.get("page_size"),
+                cursor=data.get("cursor")
+            )
+        else:
+            try:
+                code = int(data["response"])
+                message = data["message"]
+                size = int(data["size"])
+            except:
+                code = None
+                message = None
+                size = None
+
+            if code == None or message == None or size == None:
+                raise ValueError("The dictionary does not provide enough information")
+            else:
+                return SearchMessage(code, message, size, cursor=data.get("cursor"))
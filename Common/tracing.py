@@ -0,0 +1,157 @@
+from contextlib import nullcontext
+from contextvars import ContextVar
+from pathlib import Path
+import threading
+import random
+import json
+import time
+import os
+
+class Trace:
+    """
+    The spans recorded for one request. At most max_events are kept, so a long transfer cannot grow a trace without bound; the rest are only counted.
+    """
+
+    __slots__ = ("trace_id", "events", "dropped", "max_events")
+
+    def __init__(self, trace_id: str, max_events: int):
+        self.trace_id = trace_id
+        self.events: list[dict] = []
+        self.dropped = 0
+        self.max_events = max_events
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict | None = None, keep: bool = False):
+        """
+        Adds a span. Unless keep is true, it is dropped once the trace is full.
+        """
+        if len(self.events) >= self.max_events and not keep:
+            self.dropped += 1
+            return
+
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": { "trace_id": self.trace_id }
+        }
+        if args:
+            event["args"].update(args)
+        self.events.append(event)
+
+class Span:
+    """
+    Records the time spent in a with block as a span of the trace
+    """
+
+    __slots__ = ("trace", "name", "category", "args", "start")
+
+    def __init__(self, trace: Trace, name: str, category: str, args: dict):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *args):
+        self.trace.add(self.name, self.category, self.start, time.perf_counter(), self.args)
+
+no_span = nullcontext() # Shared, so that nothing is made for each span when not tracing
+current_trace: ContextVar[tuple[Trace, float, str, dict] | None] = ContextVar("current_trace", default=None)
+
+class Tracer:
+    """
+    Traces a sample of requests, and writes them to a file as Chrome trace events (readable by chrome://tracing or Perfetto). Each traced request gets an ID, which is carried (in a context variable, so each thread has its own) to every span recorded while it is handled.
+    Only sample_rate of the requests are traced, and when a request is not traced, a span costs one context variable lookup. The file is written in the JSON array format, which may be left without its closing bracket, so traces are appended as they finish. Once it grows past max_bytes, it is moved to a .1 file, replacing the last one.
+    """
+
+    def __init__(self, max_events: int = 10_000, max_bytes: int = 64 << 20):
+        self.__lock = threading.Lock()
+        self.__path = None
+        self.__file = None
+        self.__sample_rate = 0.0
+        self.__max_events = max_events
+        self.__max_bytes = max_bytes
+
+    def open(self, path: Path, sample_rate: float):
+        """
+        Starts tracing sample_rate (0 to 1) of the requests, writing them to path
+        """
+        self.close()
+        with self.__lock:
+            self.__path = path
+            self.__sample_rate = sample_rate
+            self.__open_file()
+
+    def __open_file(self):
+        self.__file = open(self.__path, "a")
+        if self.__file.tell() == 0:
+            self.__file.write("[\n")
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            self.__sample_rate = 0.0
+
+    def start(self, name: str, **args) -> object | None:
+        """
+        Decides if the request named is traced, and if so starts its trace in the current context. Returns a token to hand to finish, or None if it is not traced.
+        """
+        if self.__sample_rate <= 0 or random.random() >= self.__sample_rate:
+            return None
+
+        current = (Trace(os.urandom(8).hex(), self.__max_events), time.perf_counter(), name, args)
+        current_trace.set(current) # Replacing any trace that was never finished
+        return current
+
+    def trace_id(self) -> str | None:
+        """
+        Returns the ID of the trace of the current context, if there is one
+        """
+        current = current_trace.get()
+        return current[0].trace_id if current is not None else None
+
+    def span(self, name: str, category: str, **args):
+        """
+        Returns a context manager that records the time spent in it as a span of the current trace (or does nothing if there is none)
+        """
+        current = current_trace.get()
+        if current is None:
+            return no_span
+        return Span(current[0], name, category, args)
+
+    def finish(self, token: object | None):
+        """
+        Ends the trace started with token, and writes it
+        """
+        if token is None:
+            return
+
+        trace, start, name, args = token
+        if current_trace.get() is token:
+            current_trace.set(None)
+
+        if trace.dropped != 0:
+            args["dropped_spans"] = trace.dropped
+        trace.add(name, "request", start, time.perf_counter(), args, keep=True)
+
+        lines = "".join(json.dumps(event, separators=(",", ":")) + ",\n" for event in trace.events)
+        with self.__lock:
+            if self.__file is None:
+                return
+
+            self.__file.write(lines)
+            self.__file.flush()
+            if self.__file.tell() >= self.__max_bytes:
+                self.__file.close()
+                os.replace(self.__path, self.__path.with_name(self.__path.name + ".1"))
+                self.__open_file()
+
+tracer = Tracer()
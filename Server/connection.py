@@ -3,23 +3,29 @@ import socket
 import time
 
 from .credentials import Credentials, user_database
-from .io_tools import root_directory, move_relative, create_directory_info, make_relative, get_file_type, is_path_valid
-from .network_analysis import network_analyzer
-from .server_io import RequestUpload, UploadFile, ExtractFileContents, DeleteFile, ModifySubdirectories
+from .io_tools import root_directory, move_relative, make_relative, get_file_type, is_path_valid
+from .dir_cache import get_directory_listing
+from .network_analysis import network_analyzer, StatMetric, RttEstimator
+from .metrics import server_metrics, CountingSocket
+from .handler_timing import handler_timings, Phase
+from .server_io import RequestUpload, UploadFile, ExtractFileContents, DeleteFile, ModifySubdirectories, SearchFiles, RelocatePath
+from .mapped_file import MappedFrames
 from Common.message_handler import *
-from Common.file_io import split_binary_for_network
-from Common.http_codes import HttpCodes, HTTPErrorBasis
+from Common.file_io import send_ndjson_stream
+from Common.tracing import tracer
+from Common.http_codes import HttpCodes, HTTPErrorBasis, UnauthorizedError
 
 class ConnectionCore:
     def __init__(self, conn: socket.socket, addr, path: Path):
         if path is None:
             raise ValueError("Path cannot be None")
 
-        self.__conn = conn
+        self.__conn = CountingSocket(conn) if conn is not None else None
         self.__addr = addr
         self.__lock = threading.Lock()
         self.__cred = None
         self.__path = path
+        self.__rtt = RttEstimator()
 
     def set_cred(self, cred: Credentials) -> None:
         self.__cred = cred
@@ -60,6 +66,8 @@ class ConnectionCore:
         return self.__path
     def set_path(self, new_path: str | None):
         self.__path = new_path
+    def rtt(self) -> RttEstimator:
+        return self.__rtt
 
 class Connection:
     def __init__(self): 
@@ -87,6 +95,13 @@ class Connection:
             else:
                 return True
 
+    def is_alive(self) -> bool:
+        """
+        Returns if the connection's thread is running, without changing anything (ex. for other threads to count connections)
+        """
+        thread = self.__thread
+        return thread is not None and thread.is_alive()
+
     def start(self):
         if self.__thread == None or self.__thread.is_alive():
             raise RuntimeError("Could not start this thread knowing that the thread is non-existent or is already running")
@@ -113,13 +128,30 @@ def recv_message(connection: socket.socket, buff_size: int) -> MessageBasis | No
     except Exception as e: # Unexpected error
         raise e
     
+    parse_start = time.perf_counter()
     result = MessageBasis.parse_from_json(contents)
+    handler_timings.note_parse(time.perf_counter() - parse_start)
     if result is None:
         raise ValueError("Invalid format")
     else:
         return result
 def send_message(connection: socket.socket, message: MessageBasis, response: bool = True):
     connection.sendall(message.construct_message_json(request=not response).encode())
+    server_metrics.note_status(response_status(message))
+def response_status(message: MessageBasis) -> int | None:
+    """
+    Returns the status code a response carries, if it has one
+    """
+    if isinstance(message, (AckMessage, DirMessage, SearchMessage)):
+        code = message.code()
+    elif isinstance(message, DownloadMessage):
+        code = message.status()
+    elif isinstance(message, (StatsMessage, PingMessage)):
+        code = HttpCodes.Ok.value
+    else:
+        return None
+
+    return int(code) if code is not None else None
 
 def connection_proc(conn: ConnectionCore) -> None:
     global user_database
@@ -220,164 +252,252 @@ def connection_proc(conn: ConnectionCore) -> None:
                 finally:
                     conn.unlock()
             
+            request_start = time.perf_counter()
             print(f"[{addr_str}] Processing request of kind {message.message_type().value}")
+            server_metrics.note_status(None)
 
-            if not conn.lock(): # We need our socket
-                print(f"[{addr_str}] Closing connection")
-
-            responses = []
-            match message.message_type():
-                case MessageType.Connect:
-                    # Invalid, already connected
-                    responses.append(AckMessage(418, "Already connected"))
+            trace = tracer.start(message.message_type().value, ip=addr_str, user=conn.cred().getUsername() if conn.cred() is not None else None)
+            if trace is not None:
+                print(f"[{addr_str}] Tracing as {tracer.trace_id()}")
 
-                case MessageType.Close:
-                    responses.append(AckMessage(200, "Goodbye!"))
+            queue_start = time.perf_counter()
+            with tracer.span("lock wait", "lock"):
+                locked = conn.lock()
+            if not locked: # We need our socket
+                print(f"[{addr_str}] Closing connection")
+            handler_timings.begin(time.perf_counter() - queue_start)
 
-                case MessageType.Ack:
-                    print(f"[{addr_str}] Got ack with code {message.code()}, message '{message.message()}'")
+            # Everything the handler does is counted, and the socket given back, however it leaves (ex. by continue, or an error)
+            try:
+                responses = []
+                match message.message_type():
+                    case MessageType.Connect:
+                        # Invalid, already connected
+                        responses.append(AckMessage(418, "Already connected"))
 
-                case MessageType.Upload:
-                    path, kind, size = message.name(), message.kind(), message.size()
+                    case MessageType.Close:
+                        responses.append(AckMessage(200, "Goodbye!"))
 
-                    conn.conn().settimeout(None)
+                    case MessageType.Ack:
+                        print(f"[{addr_str}] Got ack with code {message.code()}, message '{message.message()}'")
 
-                    path = move_relative(path, conn.path())
-                    upload_handle = RequestUpload(path, size, conn.cred())
-                    if isinstance(upload_handle, HTTPErrorBasis):
-                        responses.append(upload_handle.to_ack())
-                        upload_handle = None
-                    else:
-                        start_time = time.perf_counter()
+                    case MessageType.Upload:
+                        path, kind, size = message.name(), message.kind(), message.size()
 
-                        send_message(conn.conn(), AckMessage(200, "OK"))
-                        print(f"[{addr_str}] Processing upload of frame size {size}")
+                        conn.conn().settimeout(None)
 
-                        # Now we get our file
-                        if UploadFile(upload_handle, conn.conn(), size):
-                            responses.append(AckMessage(200, "OK"))
-                            print(f"[{addr_str}] Upload success")
+                        path = move_relative(path, conn.path())
+                        with handler_timings.phase(Phase.Disk):
+                            upload_handle = RequestUpload(path, size, conn.cred())
+                        if isinstance(upload_handle, HTTPErrorBasis):
+                            responses.append(upload_handle.to_ack())
+                            upload_handle = None
                         else:
-                            responses.append(AckMessage(HttpCodes.Conflict, "File upload failed"))
-                            print(f"[{addr_str}] Upload failed")
+                            start_time = time.perf_counter()
+
+                            try:
+                                send_message(conn.conn(), AckMessage(200, "OK"))
+                            except:
+                                upload_handle.release() # UploadFile will not run to give back the reservation
+                                raise
+                            print(f"[{addr_str}] Processing upload of frame size {size}")
+
+                            # Now we get our file
+                            with handler_timings.phase(Phase.Disk):
+                                uploaded = UploadFile(upload_handle, conn.conn(), size)
+                            if uploaded:
+                                responses.append(AckMessage(200, "OK"))
+                                print(f"[{addr_str}] Upload success")
+                            else:
+                                responses.append(AckMessage(HttpCodes.Conflict, "File upload failed"))
+                                print(f"[{addr_str}] Upload failed")
 
-                        end_time = time.perf_counter()
-                        network_analyzer.record_transfer(size * 4096, start_time, end_time, addr_str)
+                            end_time = time.perf_counter()
+                            network_analyzer.record_transfer(size * 4096, start_time, end_time, addr_str, conn.cred().getUsername() if conn.cred() is not None else None, MessageType.Upload.value, conn.rtt().srtt())
 
-                    conn.conn().settimeout(3.0)
+                        conn.conn().settimeout(3.0)
 
-                case MessageType.Download:
-                    path = message.path()
-                    path = move_relative(path, conn.path())
+                    case MessageType.Download:
+                        path = message.path()
+                        path = move_relative(path, conn.path())
 
-                    file_contents = ExtractFileContents(path, conn.cred())
-                    if isinstance(file_contents, HTTPErrorBasis):
-                        responses.append(DownloadMessage(file_contents.code, file_contents.message, None, None))
+                        with handler_timings.phase(Phase.Disk):
+                            file_contents = ExtractFileContents(path, conn.cred(), message.ranges())
+                        if isinstance(file_contents, HTTPErrorBasis):
+                            responses.append(DownloadMessage(file_contents.code, file_contents.message, None, None))
                         
-                    else:
-                        kind = get_file_type(path)
-                        size = len(file_contents)
+                        else:
+                            kind = get_file_type(path)
+                            size = len(file_contents)
 
-                        start_time = time.perf_counter()
+                            start_time = time.perf_counter()
 
-                        send_message(conn.conn(), DownloadMessage(HttpCodes.Ok, "OK", kind, size))
+                            if isinstance(file_contents, MappedFrames) and file_contents.ranges() is not None:
+                                send_message(conn.conn(), DownloadMessage(HttpCodes.PartialContent, "Partial content", kind, size, ranges=file_contents.ranges(), total_size=file_contents.size()))
+                            else:
+                                send_message(conn.conn(), DownloadMessage(HttpCodes.Ok, "OK", kind, size))
                         
-                        try:
-                            ack = recv_message(conn.conn(), buff_size)
-                            if ack is None or not isinstance(ack, AckMessage):
-                                print(f"[{addr_str}] Message recieved, expected ack, but got {ack.message_type().value if ack is not None else None}")
+                            try:
+                                ack = recv_message(conn.conn(), buff_size)
+                                if ack is None or not isinstance(ack, AckMessage):
+                                    print(f"[{addr_str}] Message recieved, expected ack, but got {ack.message_type().value if ack is not None else None}")
                             
-                            if ack.code() == 200:
-                                for item in file_contents:
-                                    conn.conn().sendall(item)
-                            else:
-                                print(f'[{addr_str}] Could not download because of {ack.message()}')
+                                if ack.code() == 200:
+                                    for item in file_contents:
+                                        conn.conn().sendall(item)
+                                else:
+                                    print(f'[{addr_str}] Could not download because of {ack.message()}')
 
-                            ack = recv_message(conn.conn(), buff_size)
-                            if ack is None or not isinstance(ack, AckMessage):
-                                print(f"[{addr_str}] Message recieved, expected ack, but got {ack.message_type().value if ack is not None else None}")
+                                ack = recv_message(conn.conn(), buff_size)
+                                if ack is None or not isinstance(ack, AckMessage):
+                                    print(f"[{addr_str}] Message recieved, expected ack, but got {ack.message_type().value if ack is not None else None}")
 
                             
-                            if ack.code() == 200:
-                                print(f'[{addr_str}] Download completed')
-                            else:
-                                print(f'[{addr_str}] Could not download because of {ack.message()}. Stats are still recorded')
+                                if ack.code() == 200:
+                                    print(f'[{addr_str}] Download completed')
+                                else:
+                                    print(f'[{addr_str}] Could not download because of {ack.message()}. Stats are still recorded')
 
-                            end_time = time.perf_counter()
-                            network_analyzer.record_transfer(size * 4096, start_time, end_time, addr_str)
+                                end_time = time.perf_counter()
+                                network_analyzer.record_transfer(size * 4096, start_time, end_time, addr_str, conn.cred().getUsername() if conn.cred() is not None else None, MessageType.Download.value, conn.rtt().srtt())
                             
-                        except Exception as e:
-                            responses.append(AckMessage(HttpCodes.Conflict, str(e)))
-
-                case MessageType.Delete:
-                    path = message.path()
-                    path = move_relative(path, conn.path())
-
-                    result = DeleteFile(path, conn.cred())
-                    if result is None:
-                        responses.append(AckMessage(HttpCodes.Ok, "OK"))
-                    else:
-                        responses.append(result.to_ack())
-
-                case MessageType.Dir:
-                    if conn.cred() is None:
-                        responses.append(DirMessage(401, "Not signed in", None, None))
-                    else:
-                        # Use current path for directory listing
-                        dir_structure = create_directory_info(conn.path())
-                        dir_contents = json.dumps(dir_structure.to_dict()).encode()
-                        network_dir = split_binary_for_network(dir_contents)
+                            except Exception as e:
+                                responses.append(AckMessage(HttpCodes.Conflict, str(e)))
+                            finally:
+                                if isinstance(file_contents, MappedFrames):
+                                    file_contents.close()
+
+                    case MessageType.Delete:
+                        path = message.path()
+                        path = move_relative(path, conn.path())
+
+                        with handler_timings.phase(Phase.Disk):
+                            result = DeleteFile(path, conn.cred())
+                        if result is None:
+                            responses.append(AckMessage(HttpCodes.Ok, "OK"))
+                        else:
+                            responses.append(result.to_ack())
 
-                        curr_dir = make_relative(conn.path())
+                    case MessageType.Dir:
+                        listing = None
+                        if conn.cred() is None:
+                            responses.append(DirMessage(401, "Not signed in", None, None))
+                        else:
+                            # Use current path for directory listing
+                            try:
+                                with handler_timings.phase(Phase.Disk):
+                                    listing = get_directory_listing(conn.path(), message)
+                            except ValueError as e:
+                                responses.append(DirMessage(HttpCodes.Conflict.value, str(e), None, None))
 
-                        send_message(conn.conn(), DirMessage(200, "OK", curr_dir, len(network_dir)))
-                        ack = recv_message(conn.conn(), buff_size)
-                        if ack is None or not isinstance(ack, AckMessage):
-                            print(f"[{addr_str}] Invalid ack received for dir message")
-                            continue
+                        curr_dir = make_relative(conn.path())
+                        if listing is not None and listing.not_modified():
+                            responses.append(DirMessage(HttpCodes.NotModified.value, "Not modified", curr_dir, 0, token=listing.token))
+                        elif listing is not None and listing.is_stream():
+                            send_message(conn.conn(), DirMessage(200, "OK", curr_dir, 0, token=listing.token, stream=True))
+                            ack = recv_message(conn.conn(), buff_size)
+                            if ack is None or not isinstance(ack, AckMessage) or ack.code() != HttpCodes.Ok.value:
+                                print(f"[{addr_str}] Dir stream was not accepted by the client")
+                            else:
+                                send_ndjson_stream(conn.conn(), listing.records)
+                        elif listing is not None:
+                            send_message(conn.conn(), DirMessage(200, "OK", curr_dir, len(listing.frames), cursor=listing.cursor, token=listing.token, delta=listing.delta))
+                            ack = recv_message(conn.conn(), buff_size)
+                            if ack is None or not isinstance(ack, AckMessage):
+                                print(f"[{addr_str}] Invalid ack received for dir message")
+                                continue
 
-                        if ack.code() != HttpCodes.Ok.value:
-                            print(f"[{addr_str}] Dir failed, client responded with '{ack.message()}'")
+                            if ack.code() != HttpCodes.Ok.value:
+                                print(f"[{addr_str}] Dir failed, client responded with '{ack.message()}'")
 
-                        for item in network_dir:
-                            conn.conn().sendall(item)
+                            for item in listing.frames:
+                                conn.conn().sendall(item)
                         
-                case MessageType.Move:
-                    path = message.path()
-                    path = move_relative(path, conn.path())
-
-                    if not is_path_valid(path):
-                        responses.append(AckMessage(HttpCodes.Forbidden, "Invalid path"))
-                    else:
-                        conn.set_path(path)
-                        responses.append(AckMessage(HttpCodes.Ok, "OK"))
+                    case MessageType.Move:
+                        path = message.path()
+                        path = move_relative(path, conn.path())
+
+                        if not is_path_valid(path):
+                            responses.append(AckMessage(HttpCodes.Forbidden, "Invalid path"))
+                        else:
+                            conn.set_path(path)
+                            responses.append(AckMessage(HttpCodes.Ok, "OK"))
                 
-                case MessageType.Subfolder:
-                    path, action = message.path(), message.action()
-                    path = move_relative(path, conn.path())
-
-                    result = ModifySubdirectories(path, action)
-                    if result is None:
-                        responses.append(AckMessage(200, "OK"))
-                    else:
-                        responses.append(result.to_ack())
-                case MessageType.Stats:
-                    last = network_analyzer.get_last_ip_stats(addr_str)
-                    responses.append(
-                        StatsMessage(last.data_rate, last.transfer_time, last.latency) if last is not None else StatsMessage(0, 0, 0)
-                    )
-                    
-            print(f"[{addr_str}] Response contains {len(responses)} message(s)")
-            if responses is not None and len(responses) != 0:
-                for response in responses:
-                    if isinstance(response, MessageBasis):
-                        send_message(conn.conn(), response)
-                    elif isinstance(response, str):
-                        conn.conn().send(response.encode())
-                    else:
-                        conn.conn().send(response) # Binary
+                    case MessageType.Subfolder:
+                        path, action = message.path(), message.action()
+                        path = move_relative(path, conn.path())
 
-            conn.unlock()
+                        with handler_timings.phase(Phase.Disk):
+                            result = ModifySubdirectories(path, action)
+                        if result is None:
+                            responses.append(AckMessage(200, "OK"))
+                        else:
+                            responses.append(result.to_ack())
+                    case MessageType.Relocate:
+                        source = move_relative(message.source(), conn.path())
+                        destination = move_relative(message.destination(), conn.path())
+
+                        with handler_timings.phase(Phase.Disk):
+                            result = RelocatePath(source, destination, message.action(), conn.cred())
+                        if result is None:
+                            responses.append(AckMessage(200, "OK"))
+                        else:
+                            responses.append(result.to_ack())
+                    case MessageType.Search:
+                        if conn.cred() is None:
+                            result = UnauthorizedError()
+                        else:
+                            with handler_timings.phase(Phase.Disk):
+                                result = SearchFiles(conn.path(), message)
+
+                        if isinstance(result, HTTPErrorBasis):
+                            responses.append(SearchMessage(int(result.code), result.message, 0))
+                        else:
+                            frames, cursor = result
+                            send_message(conn.conn(), SearchMessage(HttpCodes.Ok.value, "OK", len(frames), cursor=cursor))
+                            ack = recv_message(conn.conn(), buff_size)
+                            if ack is None or not isinstance(ack, AckMessage) or ack.code() != HttpCodes.Ok.value:
+                                print(f"[{addr_str}] Search results were not accepted by the client")
+                            else:
+                                for item in frames:
+                                    conn.conn().sendall(item)
+
+                    case MessageType.Stats:
+                        last = network_analyzer.get_last_ip_stats(addr_str)
+                        user = conn.cred().getUsername() if conn.cred() is not None else None
+                        percentiles = {
+                            "user": { metric.value: network_analyzer.percentiles(metric, user=user) for metric in StatMetric } if user is not None else {},
+                            "server": { metric.value: network_analyzer.percentiles(metric) for metric in StatMetric }
+                        }
+                        srtt = conn.rtt().srtt() if conn.rtt().srtt() is not None else 0
+                        jitter = conn.rtt().jitter() if conn.rtt().jitter() is not None else 0
+                        responses.append(
+                            StatsMessage(last.data_rate, last.transfer_time, srtt, jitter=jitter, percentiles=percentiles) if last is not None else StatsMessage(0, 0, srtt, jitter=jitter, percentiles=percentiles)
+                        )
+
+                    case MessageType.Ping:
+                        if message.echo() is not None:
+                            # The time since the echoed response was sent, less the time the client held it, is a round trip on our own clock
+                            conn.rtt().add(request_start - message.echo() - message.held())
+
+                        now = time.perf_counter()
+                        responses.append(PingMessage(message.sent(), server_time=now, processing=now - request_start))
+                    
+                print(f"[{addr_str}] Response contains {len(responses)} message(s)")
+                if responses is not None and len(responses) != 0:
+                    for response in responses:
+                        if isinstance(response, MessageBasis):
+                            send_message(conn.conn(), response)
+                        elif isinstance(response, str):
+                            conn.conn().send(response.encode())
+                        else:
+                            conn.conn().send(response) # Binary
+            finally:
+                server_metrics.count_request(message.message_type().value)
+                handler_timings.finish(message.message_type().value)
+                tracer.finish(trace)
+                network_analyzer.record_latency(message.message_type().value, time.perf_counter() - request_start, conn.cred().getUsername() if conn.cred() is not None else None)
+                conn.unlock()
 
     except OSError as e:
         print(f"OSError caught: {str(e)}\nClosing connection")
@@ -1,6 +1,8 @@
 from pathlib import Path
+import threading
 import json
 
+from .journal import AppendJournal, write_snapshot
 from .server_paths import user_database_loc
 
 class Credentials:
@@ -23,11 +25,21 @@ class Credentials:
             return self.__username == obj.__username and self.__passwordHash == obj.__passwordHash
         
 class UserDatabase:
-    def __init__(self):
+    """
+    Stores the password hash of every user. The users are loaded from a snapshot file, and every change after that is appended to a journal next to it. Once the journal grows past compact_after records, it is folded back into the snapshot.
+    """
+
+    def __init__(self, compact_after: int = 1024):
         self.__path = None
         self.__users = None
+        self.__journal = None
+        self.__lock = threading.Lock()
+        self.__compact_after = compact_after
         
-    def open(self, path: Path):
+    def open(self, path: Path, legacy_path: Path | None = None):
+        """
+        Loads the users from the snapshot at path, and replays the journal next to it. If the snapshot is missing or empty, and legacy_path (the file older versions of the server kept users in) exists, its users are imported into the snapshot first.
+        """
         if path is None:
             raise ValueError("Path must not be none")
         
@@ -40,29 +52,91 @@ class UserDatabase:
         self.__path = path
         with open(self.__path, "r") as f:
             contents = f.read()
-            if contents is None or len(contents) == 0:
-                contents = "{ }"
+            if contents is None or len(contents.strip()) == 0:
+                contents = None
+            else:
+                self.__users = dict(json.loads(contents))
 
-            self.__users = dict(json.loads(contents))
+        if contents is None:
+            self.__users = {}
+            if legacy_path is not None and legacy_path.is_file():
+                self.__users = UserDatabase.__read_legacy(legacy_path)
+                write_snapshot(self.__path, self.__users) # So the import only happens once
+                print(f"[IO] Imported {len(self.__users)} user(s) from {legacy_path.name}")
         
         if self.__users is None:
             raise ValueError("Could not load database from that path")
+        
+        self.__journal = AppendJournal(path.with_suffix(".journal"))
+        for record in self.__journal.open():
+            try:
+                self.__users[record["username"]] = record["password"]
+            except (KeyError, TypeError):
+                continue
+
+    def __read_legacy(path: Path) -> dict[str, str]:
+        """
+        Reads the users from the file older versions of the server kept them in. That file was shared with the owners of files, so whichever was saved last is what is there: users are stored as username to password hash, and owners as path to the username & password hash of the owner. Users are taken from either.
+        """
+        try:
+            with open(path, "r") as f:
+                contents = f.read()
+                data = json.loads(contents) if len(contents.strip()) != 0 else {}
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[IO] Could not read users from {path.name}: {str(e)}")
+            return {}
+
+        if not isinstance(data, dict):
+            return {}
+
+        users = {}
+        owners = {}
+        for key, value in data.items():
+            if isinstance(value, str):
+                users[key] = value
+            elif isinstance(value, dict) and isinstance(value.get("username"), str) and isinstance(value.get("password"), str):
+                owners[value["username"]] = value["password"]
+
+        return owners | users
 
     def get_user(self, username: str) -> None | Credentials:
         if not isinstance(username, str):
             username = str(username)
 
-        if username in self.__users:
-            return Credentials(username, self.__users[username])
+        password = self.__users.get(username)
+        if password is not None:
+            return Credentials(username, password)
         else:
             return None
         
     def set_user_pass(self, cred: Credentials) -> Credentials:
-        self.__users[cred.getUsername()] = cred.getPasswordHash()
+        with self.__lock:
+            self.__journal.append({
+                "username": cred.getUsername(),
+                "password": cred.getPasswordHash()
+            })
+            self.__users[cred.getUsername()] = cred.getPasswordHash()
+
+            if len(self.__journal) >= self.__compact_after:
+                self.__compact()
+
+        return cred
+
+    def __compact(self):
+        """
+        Writes the full set of users to the snapshot, and empties the journal. The lock must be held.
+        """
+        write_snapshot(self.__path, self.__users)
+        self.__journal.truncate()
 
     def save(self):
-        with open(self.__path, "w") as f:
-            contents = json.dumps(self.__users)
-            f.write(contents)
+        with self.__lock:
+            if self.__journal is None:
+                return
+            
+            if len(self.__journal) != 0:
+                self.__compact()
+            self.__journal.close()
+            self.__journal = None
 
 user_database = UserDatabase()
\ No newline at end of file
@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterator
+import threading
+import json
+
+from Common.file_io import split_binary_for_network
+from Common.message_handler import DirMessage, DirEncoding
+from .io_tools import create_directory_info, create_directory_page, stream_directory, max_dir_page_size, file_owner_db, known_hash, attach_file_hashes, relative_prefix
+from .namespace_index import namespace_index
+
+class DirectoryCache:
+    """
+    Caches the encoded (network ready) Dir response of directories. Since a Dir response contains the entire tree below a directory, any change to a path invalidates the cached responses of that path and every one of its ancestors.
+    The least recently used paths are dropped once more than max_entries paths are cached, or the cached responses total more than max_bytes. A response larger than max_response_bytes is never cached.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024, max_response_bytes: int = 8 * 1024 * 1024):
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[Path, dict] = OrderedDict() # Path to variant to (response, bytes)
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__max_response_bytes = max_response_bytes
+        self.__bytes = 0
+        self.__generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def cached_bytes(self) -> int:
+        return self.__bytes
+
+    def generation(self) -> int:
+        """
+        Returns a token that must be taken before building a response, and handed to put. If the tree changes while the response is built, the response is not cached.
+        """
+        return self.__generation
+
+    def get(self, path: Path, variant = None):
+        """
+        Returns the cached response for the path. The variant separates the different kinds of listings (depth, page, etc.) of the same path.
+        """
+        with self.__lock:
+            variants = self.__entries.get(path)
+            result = variants.get(variant) if variants is not None else None
+            if result is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__entries.move_to_end(path)
+            return result[0]
+    def put(self, path: Path, value, generation: int, variant = None, size: int = 0):
+        """
+        Caches the response, which takes up size bytes, for the path
+        """
+        if size > self.__max_response_bytes:
+            return
+
+        with self.__lock:
+            if generation != self.__generation:
+                return # Something changed while the listing was built, so it may already be stale
+
+            variants = self.__entries.setdefault(path, {})
+            old = variants.pop(variant, None)
+            if old is not None:
+                self.__bytes -= old[1]
+            variants[variant] = (value, size)
+            self.__bytes += size
+            self.__entries.move_to_end(path)
+            while len(self.__entries) > self.__max_entries or self.__bytes > self.__max_bytes:
+                self.__drop(next(iter(self.__entries)))
+
+    def __drop(self, path: Path):
+        """
+        Drops every cached response of the path. The lock must be held.
+        """
+        variants = self.__entries.pop(path, None)
+        if variants is not None:
+            self.__bytes -= sum(size for _, size in variants.values())
+
+    def invalidate(self, path: Path, subtree: bool = False):
+        """
+        Drops the cached responses for path and all of its ancestors. If subtree is true, the responses of everything below path are dropped as well (used when a directory is removed).
+        """
+        if path is None:
+            return
+
+        with self.__lock:
+            self.__generation += 1
+
+            self.__drop(path)
+            for parent in path.parents:
+                self.__drop(parent)
+
+            if subtree:
+                for key in [key for key in self.__entries if key.is_relative_to(path)]:
+                    self.__drop(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+            self.__bytes = 0
+
+directory_cache = DirectoryCache()
+namespace_index.add_listener(lambda path, removed: directory_cache.invalidate(path, subtree=removed))
+
+class DirListing:
+    """
+    The result of a Dir request. If frames is None, the directory was not modified since the request's token, and nothing needs to be sent. For streamed listings, records holds the entries to stream (as they are found), and frames is empty.
+    """
+
+    def __init__(self, frames: list[bytes] | None, cursor: str | None = None, token: str | None = None, delta: bool = False, records: Iterator[dict] | None = None):
+        self.frames = frames
+        self.cursor = cursor
+        self.token = token
+        self.delta = delta
+        self.records = records
+
+    def not_modified(self) -> bool:
+        return self.frames is None
+    def is_stream(self) -> bool:
+        return self.records is not None
+
+def get_directory_listing(path: Path, request: DirMessage | None = None) -> DirListing:
+    """
+    Determines the Dir response for the path, split up for the network. If the request holds a token the namespace index can follow, only the changes since then are sent. Otherwise the listing is served from the cache if possible, and then from the namespace index, before going to the disk.
+    Streamed listings always walk the disk, as they are sent while the walk runs.
+    """
+    global directory_cache
+    global namespace_index
+
+    if request is None:
+        request = DirMessage()
+
+    # Tokens only describe the direct children of a directory, so they are only used for single level listings
+    tracked = request.depth() == 1
+    if tracked and request.token() is not None and request.cursor() is None:
+        changes = namespace_index.changes_since(path, request.token())
+        if changes is not None:
+            token, delta = changes
+            if delta is None:
+                return DirListing(None, token=token)
+            
+            if len(delta["added"]) + len(delta["changed"]) + len(delta["removed"]) <= max_dir_page_size:
+                if request.hashes():
+                    attach_entry_hashes(delta["added"] + delta["changed"], path)
+                return DirListing(split_binary_for_network(json.dumps(delta).encode()), token=token, delta=True)
+
+    if request.stream():
+        return DirListing([], token=namespace_index.token(path) if tracked else None, records=stream_directory(path, request.depth()))
+
+    # Only the first page of a listing is cached, since the cursors of the pages after it are up to the client, and there is no end to them
+    cacheable = request.cursor() is None
+    variant = (request.depth(), request.page_size(), request.sort(), request.descending(), request.encoding(), request.hashes())
+    cached = directory_cache.get(path, variant) if cacheable else None
+    if cached is not None:
+        return cached
+
+    generation = directory_cache.generation()
+    # The token is taken before the listing, so a change made in between is sent again later, rather than lost
+    token = namespace_index.token(path) if tracked else None
+    if request.page_size() is None:
+        dir_structure = namespace_index.directory_info(path, request.depth())
+        if dir_structure is None:
+            dir_structure = create_directory_info(path, request.depth())
+        next_cursor = None
+    else:
+        page = namespace_index.directory_page(path, request.depth(), request.page_size(), request.cursor(), request.sort(), request.descending())
+        if page is None:
+            page = create_directory_page(path, request.depth(), request.page_size(), request.cursor(), request.sort(), request.descending())
+        dir_structure, next_cursor = page
+
+    if request.hashes():
+        attach_file_hashes(dir_structure, path)
+    encoded = dir_structure.to_compact() if request.encoding() == DirEncoding.Compact else dir_structure.to_dict()
+    
+    result = DirListing(split_binary_for_network(json.dumps(encoded, separators=(",", ":")).encode()), next_cursor, token)
+    if cacheable:
+        directory_cache.put(path, result, generation, variant, size=sum(len(frame) for frame in result.frames))
+    return result
+
+def attach_entry_hashes(entries: list[dict], path: Path):
+    """
+    The version of attach_file_hashes for the encoded entries of a delta, which are all directly inside path.
+    """
+    global file_owner_db
+
+    prefix = relative_prefix(path)
+    files = [entry for entry in entries if entry["kind"] == "file"]
+    hashes = file_owner_db.file_hashes([prefix + entry["name"] for entry in files])
+    for entry in files:
+        content_hash = known_hash(hashes.get(prefix + entry["name"]), entry["size"], entry.get("mtime"))
+        if content_hash is not None:
+            entry["hash"] = content_hash
@@ -0,0 +1,136 @@
+from pathlib import Path
+import ctypes
+import ctypes.util
+import errno
+import shutil
+import os
+
+try:
+    import fcntl
+except ImportError: # Not on Windows
+    fcntl = None
+
+FICLONE = 0x40049409 # From <linux/fs.h>
+AT_FDCWD = -100 # From <fcntl.h>
+RENAME_NOREPLACE = 1 # From <linux/fs.h>
+
+def load_renameat2():
+    """
+    Returns libc's renameat2, or None if it does not have one (it is Linux only, and needs glibc 2.28)
+    """
+    try:
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name if libc_name is not None else "libc.so.6", use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return None
+
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    return renameat2
+
+renameat2 = load_renameat2()
+
+def rename_no_replace(source: Path | str, destination: Path | str):
+    """
+    Renames source to destination in one step, raising FileExistsError if something is already at destination, rather than replacing it. Uses renameat2 with RENAME_NOREPLACE where the OS and file system support it. Otherwise, files are hard linked (which fails if the name is taken) and then unlinked, and directories are renamed onto an empty directory made just before (which fails if anything was put in it).
+    """
+    source, destination = Path(source), Path(destination)
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, os.fsencode(source), AT_FDCWD, os.fsencode(destination), RENAME_NOREPLACE) == 0:
+            return
+
+        error = ctypes.get_errno()
+        if error not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP): # Anything but the flag not being supported
+            raise OSError(error, os.strerror(error), str(source), None, str(destination))
+
+    if os.name == "nt":
+        os.rename(source, destination) # Never replaces on Windows
+    elif source.is_dir() and not source.is_symlink():
+        destination.mkdir() # Takes the name, or fails if it is taken
+        try:
+            os.rename(source, destination)
+        except OSError:
+            destination.rmdir()
+            raise
+    else:
+        os.link(source, destination, follow_symlinks=False)
+        os.unlink(source)
+
+def copy_file(source: Path, destination: Path):
+    """
+    Copies the contents of source into a new file at destination. Where the file system supports it, the copy is a reflink, sharing the blocks of source until either is changed. Otherwise it is made by copy_file_range (in the kernel, or by the file server for network file systems), and only if that is not available is it copied through Python.
+    """
+    with open(source, "rb") as src, open(destination, "xb") as dst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass # Not supported by the file system
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30) != 0:
+                    pass
+                return
+            except OSError:
+                # Not supported between these files, so start over
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+def copy_tree(source: Path, destination: Path) -> list[Path]:
+    """
+    Copies the directory at source, and everything below it, to a new directory at destination, with copy_file. Symbolic links are skipped, as they could lead outside of the root. Returns the paths of the files copied, relative to the directories.
+    """
+    copied = []
+    destination.mkdir()
+    for directory, directories, files in os.walk(source):
+        relative = Path(directory).relative_to(source)
+        for name in directories:
+            if not os.path.islink(os.path.join(directory, name)): # Links to directories are not followed by the walk
+                (destination / relative / name).mkdir()
+        for name in files:
+            if os.path.islink(os.path.join(directory, name)):
+                continue
+
+            copy_file(Path(directory) / name, destination / relative / name)
+            copied.append(relative / name)
+
+    return copied
+
+def make_parents(path: Path) -> list[Path]:
+    """
+    Makes the directories missing above path, and returns those that were made, the deepest first, so remove_parents can undo it
+    """
+    missing = []
+    parent = path.parent
+    while not os.path.lexists(parent):
+        missing.append(parent)
+        parent = parent.parent
+
+    created = []
+    try:
+        for directory in reversed(missing):
+            try:
+                directory.mkdir()
+            except FileExistsError:
+                continue # Made by someone else in the meantime, so it is not ours to remove
+            created.append(directory)
+    except OSError:
+        remove_parents(list(reversed(created)))
+        raise
+
+    return list(reversed(created))
+
+def remove_parents(created: list[Path]):
+    """
+    Removes the directories made by make_parents, unless something has been put in them since
+    """
+    for directory in created:
+        try:
+            directory.rmdir()
+        except OSError:
+            return
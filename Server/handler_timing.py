@@ -0,0 +1,162 @@
+from contextlib import nullcontext
+from enum import Enum
+import threading
+import time
+
+from .histogram import WindowedHistogram
+
+class Phase(Enum):
+    """
+    The parts the handling of a request is split into
+    """
+    Queue = "queue" # Waiting for the connection's lock
+    Parse = "parse" # Decoding messages
+    Handler = "handler" # Everything not in another phase
+    Disk = "disk" # File system & database work
+    Send = "send" # Writing to the socket
+    Receive = "receive" # Reading from the socket, after the request itself
+
+class RequestTiming:
+    """
+    Splits the time spent handling one request between the phases. Phases nest, and the time spent in an inner phase is only counted for it (so sending frames from inside a Disk phase counts as Send).
+    """
+
+    def __init__(self, queue: float, parse: float):
+        self.__totals = dict.fromkeys(Phase, 0.0)
+        self.__totals[Phase.Queue] = queue
+        self.__totals[Phase.Parse] = parse
+        self.__stack: list[Phase] = []
+        self.__current = Phase.Handler
+        self.__since = time.perf_counter()
+
+    def enter(self, phase: Phase):
+        now = time.perf_counter()
+        self.__totals[self.__current] += now - self.__since
+        self.__stack.append(self.__current)
+        self.__current = phase
+        self.__since = now
+    def exit(self):
+        now = time.perf_counter()
+        self.__totals[self.__current] += now - self.__since
+        self.__current = self.__stack.pop() if len(self.__stack) != 0 else Phase.Handler
+        self.__since = now
+
+    def move(self, phase: Phase, seconds: float):
+        """
+        Counts seconds that just passed in the current phase for phase instead
+        """
+        self.__totals[phase] += seconds
+        self.__since += seconds
+
+    def stop(self) -> dict[Phase, float]:
+        self.__totals[self.__current] += time.perf_counter() - self.__since
+        return self.__totals
+
+no_phase = nullcontext() # Shared, so that nothing is made for each phase when not timing
+
+class PhaseContext:
+    def __init__(self, timing: RequestTiming, phase: Phase):
+        self.__timing = timing
+        self.__phase = phase
+
+    def __enter__(self):
+        self.__timing.enter(self.__phase)
+    def __exit__(self, *args):
+        self.__timing.exit()
+
+class HandlerTimings:
+    """
+    Times the phases of the requests handled by connection_proc, and totals them per message type. Each thread has at most one request being timed.
+    When disabled (the default), nothing is timed; the calls only check the flag, so they cost next to nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__totals: dict[tuple[str, Phase], list] = {} # Count & total seconds
+        self.__histograms: dict[tuple[str, Phase], WindowedHistogram] = {}
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def begin(self, queue: float = 0.0):
+        """
+        Starts timing a request on this thread. queue is how long it waited before being handled. The time taken to parse the message it came in is taken from the last note_parse.
+        """
+        if not self.enabled:
+            return
+
+        parse = getattr(self.__local, "parse", 0.0)
+        self.__local.parse = 0.0
+        self.__local.timing = RequestTiming(queue, parse)
+
+    def current(self) -> RequestTiming | None:
+        """
+        Returns the timing of the request being handled by this thread, if there is one
+        """
+        if not self.enabled:
+            return None
+        return getattr(self.__local, "timing", None)
+
+    def phase(self, phase: Phase):
+        """
+        Returns a context manager that counts the time spent in it as phase, for the request being timed
+        """
+        if not self.enabled:
+            return no_phase
+
+        timing = getattr(self.__local, "timing", None)
+        return PhaseContext(timing, phase) if timing is not None else no_phase
+
+    def note_parse(self, seconds: float):
+        """
+        Notes the time spent parsing a message. If a request is being timed, it is counted for it; otherwise it is kept for the next request.
+        """
+        if not self.enabled:
+            return
+
+        timing = getattr(self.__local, "timing", None)
+        if timing is not None:
+            timing.move(Phase.Parse, seconds)
+        else:
+            self.__local.parse = seconds
+
+    def finish(self, kind: str):
+        """
+        Stops timing the request on this thread, and adds its phases to the totals of its message type
+        """
+        timing = self.current()
+        if timing is None:
+            return
+
+        self.__local.timing = None
+        totals = timing.stop()
+        with self.__lock:
+            for phase, seconds in totals.items():
+                key = (kind, phase)
+                total = self.__totals.get(key)
+                if total is None:
+                    total = [0, 0.0]
+                    self.__totals[key] = total
+                    self.__histograms[key] = WindowedHistogram()
+
+                total[0] += 1
+                total[1] += seconds
+                self.__histograms[key].record(seconds)
+
+    def summary(self, window: float = 300.0) -> dict[str, dict[str, dict]]:
+        """
+        Returns, for each message type and phase, the count of requests and total seconds since the server started, along with the percentiles (as in Histogram.summary) over the last window seconds.
+        """
+        result = {}
+        with self.__lock:
+            for (kind, phase), (count, seconds) in self.__totals.items():
+                summary = self.__histograms[(kind, phase)].window(window).summary()
+                summary["total_count"] = count
+                summary["total_seconds"] = seconds
+                result.setdefault(kind, {})[phase.value] = summary
+
+        return result
+
+handler_timings = HandlerTimings()
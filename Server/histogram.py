@@ -0,0 +1,108 @@
+import math
+import time
+
+class Histogram:
+    """
+    Counts values in logarithmic buckets, so percentiles can be found without keeping the values themselves. Each doubling of the value is split into buckets_per_doubling buckets, so a reported percentile is within about 2% of the real value, for any size of value. Values of zero (or less) are counted on their own.
+    """
+
+    buckets_per_doubling = 16
+
+    def __init__(self):
+        self.__counts: dict[int, int] = {}
+        self.__zeros = 0
+        self.__count = 0
+        self.__max = 0.0
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def record(self, value: float):
+        if value > 0:
+            bucket = math.floor(math.log2(value) * Histogram.buckets_per_doubling)
+            self.__counts[bucket] = self.__counts.get(bucket, 0) + 1
+        else:
+            self.__zeros += 1
+
+        if self.__count == 0 or value > self.__max:
+            self.__max = value
+        self.__count += 1
+
+    def merge(self, other: "Histogram"):
+        """
+        Adds the counts of other into this histogram
+        """
+        for bucket, count in other.__counts.items():
+            self.__counts[bucket] = self.__counts.get(bucket, 0) + count
+        self.__zeros += other.__zeros
+
+        if other.__count != 0 and (self.__count == 0 or other.__max > self.__max):
+            self.__max = other.__max
+        self.__count += other.__count
+
+    def max(self) -> float:
+        return self.__max
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns the value that p percent of the recorded values are at or below. The middle of the bucket it falls in is given, but never more than the largest value seen.
+        """
+        if self.__count == 0:
+            return 0.0
+
+        rank = max(1, math.ceil(self.__count * p / 100))
+        seen = self.__zeros
+        if seen >= rank:
+            return 0.0
+
+        for bucket in sorted(self.__counts):
+            seen += self.__counts[bucket]
+            if seen >= rank:
+                return min(2 ** ((bucket + 0.5) / Histogram.buckets_per_doubling), self.__max)
+
+        return self.__max
+
+    def summary(self) -> dict:
+        """
+        Returns the count, p50, p90, p99, and max. The values are rounded to 4 significant figures, as the buckets are not more precise than that.
+        """
+        return {
+            "count": self.__count,
+            "p50": float(f"{self.percentile(50):.4g}"),
+            "p90": float(f"{self.percentile(90):.4g}"),
+            "p99": float(f"{self.percentile(99):.4g}"),
+            "max": float(f"{self.__max:.4g}")
+        }
+
+class WindowedHistogram:
+    """
+    A histogram of the values recorded over the last slice_seconds * slice_count seconds. Time is split into slices, each with its own histogram, kept in a ring; a slice is cleared when the ring comes back around to it. Asking for a window merges the slices it covers, so the window is only as precise as one slice.
+    """
+
+    def __init__(self, slice_seconds: float = 10.0, slice_count: int = 60):
+        self.__slice_seconds = slice_seconds
+        self.__slices: list[tuple[int, Histogram] | None] = [None] * slice_count
+
+    def record(self, value: float, now: float | None = None):
+        index = int((time.time() if now is None else now) // self.__slice_seconds)
+        position = index % len(self.__slices)
+
+        current = self.__slices[position]
+        if current is None or current[0] != index:
+            current = (index, Histogram())
+            self.__slices[position] = current
+
+        current[1].record(value)
+
+    def window(self, seconds: float, now: float | None = None) -> Histogram:
+        """
+        Returns the histogram of the values recorded in the last seconds (at most the full length of the ring).
+        """
+        index = int((time.time() if now is None else now) // self.__slice_seconds)
+        oldest = index - min(max(1, math.ceil(seconds / self.__slice_seconds)), len(self.__slices)) + 1
+
+        result = Histogram()
+        for current in self.__slices:
+            if current is not None and oldest <= current[0] <= index:
+                result.merge(current[1])
+        return result
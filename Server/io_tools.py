@@ -1,12 +1,17 @@
-from Common.file_io import FileType, get_file_type
-from typing import Self
+from Common.file_io import FileType, get_file_type, get_suffix_type
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Self, Iterator
 from pathlib import Path
+import sqlite3
+import threading
 import json
 import os
 
 from .credentials import Credentials
 from .server_paths import root_directory
-from Common.file_io import FileInfo, DirectoryInfo, get_file_total_size
+from Common.file_io import FileInfo, DirectoryInfo
+from Common.message_handler import DirSort
 
 # Path Management
 def move_relative(raw_path: str, curr_dir: Path) -> Path | None:
@@ -57,100 +62,587 @@ def is_path_valid(path: Path) -> bool:
 
     target_size = len(root_directory.parts)
     if len(path.parts) == target_size:
-        return True
+        return path.parts == root_directory.parts
     elif len(path.parts) < target_size:
         return False
     else:
         return path.parts[0:target_size] == root_directory.parts
 
 # File management  
+class OwnerIndex:
+    """
+    An in memory map of relative path -> owner. The map is split into stripes, each with its own lock, so writers only block other writers that land on the same stripe. Readers never take a lock.
+    """
+
+    def __init__(self, stripe_count: int = 16):
+        self.__stripes = [dict() for _ in range(stripe_count)]
+        self.__locks = [threading.Lock() for _ in range(stripe_count)]
+
+    def __stripe(self, key: str) -> int:
+        return hash(key) % len(self.__stripes)
+
+    def lock_for(self, key: str) -> threading.Lock:
+        """
+        Returns the lock guarding the stripe holding 'key'. This must be held while calling put or remove.
+        """
+        return self.__locks[self.__stripe(key)]
+    def lock_all(self) -> ExitStack:
+        """
+        Returns a context manager holding the lock of every stripe, for changes to many keys at once. The locks are always taken in the same order, so this cannot deadlock with another caller.
+        """
+        stack = ExitStack()
+        for lock in self.__locks:
+            stack.enter_context(lock)
+        return stack
+
+    def get(self, key: str) -> str | None:
+        return self.__stripes[self.__stripe(key)].get(key)
+    def put(self, key: str, owner: str):
+        self.__stripes[self.__stripe(key)][key] = owner
+    def remove(self, key: str):
+        self.__stripes[self.__stripe(key)].pop(key, None)
+
+    def clear(self):
+        for lock, stripe in zip(self.__locks, self.__stripes):
+            with lock:
+                stripe.clear()
+    def __len__(self) -> int:
+        return sum(len(stripe) for stripe in self.__stripes)
+
 class FileOwnerDB:
+    """
+    Stores the owner (and size) of every file inside of the root directory. Files uploaded through the server also have the hash of their contents, along with the modification time they had when hashed. The data lives in an SQLite database running in WAL mode, so every change is committed as it happens, and lookups by path or owner are indexed.
+    Owner lookups by path are served from an in memory OwnerIndex, so connection threads scanning directories are never blocked by uploads.
+    The bytes each user owns are kept in a usage table, updated in the same transaction as the files, and mirrored in memory, so quota checks never have to add up the files. Users can have a quota, or else default_quota applies (None for no limit).
+    """
+
     def __init__(self):
         self.__path = None
-        self.__data = None
+        self.__local = threading.local()
+        self.__index = OwnerIndex()
+        self.__usage_lock = threading.Lock() # Held across every change to the usage, in the database & in memory
+        self.__usage: dict[str, int] = {}
+        self.__quotas: dict[str, int] = {}
+        self.__reserved: dict[str, int] = {}
+        self.__default_quota = None
+
+    def open(self, path: Path, default_quota: int | None = None, legacy_path: Path | None = None):
+        """
+        Opens (or makes) the database at path. If the database is new, and legacy_path (the JSON file older versions of the server kept owners in) holds owners, they are imported in the same transaction that makes the tables.
+        """
+        if path is None:
+            raise ValueError("Path must not be none")
 
-    def open(self, path: Path):
-        if not path.exists():
-            try:
-                path.touch()
-            except:
-                raise ValueError("Could not open file at that path")
-        
-        with open(path, 'r') as f:
-            contents = f.read()
-        
-        if not contents or len(contents) == 0:
-            contents = "{}"
-        
-        self.__data = dict(json.loads(contents))
         self.__path = path
+        self.__default_quota = default_quota
+        try:
+            conn = self.__conn()
+            with conn:
+                has_files = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone() is not None
+                has_usage = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage'").fetchone() is not None
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY,
+                        owner TEXT NOT NULL,
+                        size INTEGER NOT NULL DEFAULT 0,
+                        hash TEXT,
+                        mtime REAL
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS files_owner ON files (owner, path)")
 
-    def get_file_owner(self, path: Path, is_absolute: bool = True) -> Credentials | None:
-        if is_absolute:
-            path = make_relative(path)
+                if not has_files and legacy_path is not None and legacy_path.is_file():
+                    legacy = FileOwnerDB.__read_legacy(legacy_path)
+                    conn.executemany("INSERT OR REPLACE INTO files (path, owner, size) VALUES (?, ?, ?)", legacy)
+                    print(f"[IO] Imported the owners of {len(legacy)} file(s) from {legacy_path.name}")
+
+                # Databases made before hashes were recorded are missing the columns
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+                if "hash" not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN hash TEXT")
+                if "mtime" not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN mtime REAL")
+
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS usage (
+                        owner TEXT PRIMARY KEY,
+                        bytes INTEGER NOT NULL DEFAULT 0,
+                        quota INTEGER
+                    )
+                """)
+                if not has_usage: # Made before usage was tracked, so it is added up once here
+                    conn.execute("INSERT INTO usage (owner, bytes) SELECT owner, SUM(size) FROM files GROUP BY owner")
+
+            self.__index.clear()
+            for key, owner in conn.execute("SELECT path, owner FROM files"):
+                self.__index.put(key, owner)
+
+            with self.__usage_lock:
+                self.__usage.clear()
+                self.__quotas.clear()
+                self.__reserved.clear()
+                for owner, used, quota in conn.execute("SELECT owner, bytes, quota FROM usage"):
+                    self.__usage[owner] = used
+                    if quota is not None:
+                        self.__quotas[owner] = quota
+        except sqlite3.Error:
+            raise ValueError("Could not open file at that path")
+
+    def __read_legacy(path: Path) -> list[tuple[str, str, int]]:
+        """
+        Reads the owners from the file older versions of the server kept them in, as (key, owner, size). That file was shared with the users, so whichever was saved last is what is there; only the entries shaped like owners (path to the username & password hash of the owner) are taken. The sizes are read from the files that are still there.
+        """
+        try:
+            with open(path, "r") as f:
+                contents = f.read()
+                data = json.loads(contents) if len(contents.strip()) != 0 else {}
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[IO] Could not read owners from {path.name}: {str(e)}")
+            return []
+
+        if not isinstance(data, dict):
+            return []
+
+        owners = []
+        for key, value in data.items():
+            if not isinstance(value, dict) or not isinstance(value.get("username"), str):
+                continue
 
+            key = Path(key.replace("\\", "/")).as_posix() # Saved with the separators of the OS it ran on
+            try:
+                size = os.stat(root_directory / key).st_size
+            except OSError:
+                size = 0
+            owners.append((key, value["username"], size))
+
+        return owners
+
+    def __conn(self) -> sqlite3.Connection:
+        """
+        SQLite connections cannot be shared across threads, so each connection thread gets its own.
+        """
+        conn = getattr(self.__local, "conn", None)
+        if conn is None:
+            if self.__path is None:
+                raise ValueError("The database has not been opened")
+
+            conn = sqlite3.connect(self.__path, timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.__local.conn = conn
+
+        return conn
+
+    def __key(path: Path | str, is_absolute: bool) -> str | None:
         if path is None:
             return None
-        
-        result = self.__data.get(str(path))
-        if result is None:
-            return None
-        else:
-            return Credentials(result["username"], result["password"])
-    def set_file_owner(self, path: Path, credentials: Credentials, is_absolute: bool = True):
+        if isinstance(path, str) and not is_absolute:
+            return path # Already a key
         if is_absolute:
             path = make_relative(path)
-
         if path is None:
+            return None
+
+        return path.as_posix()
+
+    def get_file_owner(self, path: Path, is_absolute: bool = True) -> str | None:
+        """
+        Returns the username of the owner of the file, if it has one.
+        """
+        key = FileOwnerDB.__key(path, is_absolute)
+        if key is None:
+            return None
+        
+        return self.__index.get(key)
+    def set_file_owner(self, path: Path, credentials: Credentials, is_absolute: bool = True, size: int = 0, content_hash: str | None = None, mtime: float | None = None):
+        """
+        Sets the owner of the file. If the hash of the file's contents is known, it should be given with the modification time the file had when it was hashed.
+        """
+        key = FileOwnerDB.__key(path, is_absolute)
+        if key is None:
             raise ValueError("The path provided is not valid")
         
-        self.__data[str(path)] = {
-            "username": credentials.getUsername(),
-            "password": credentials.getPasswordHash()
-        }
+        size = size if size is not None else 0
+        conn = self.__conn()
+        with self.__index.lock_for(key), self.__usage_lock:
+            # The database is written first, so the index never holds an owner that would be lost in a crash
+            with conn:
+                changes = self.__replace_usage(conn, key, credentials.getUsername(), size)
+                conn.execute(
+                    "INSERT OR REPLACE INTO files (path, owner, size, hash, mtime) VALUES (?, ?, ?, ?, ?)",
+                    (key, credentials.getUsername(), size, content_hash, mtime)
+                )
+            self.__apply_usage(changes)
+            self.__index.put(key, credentials.getUsername())
+    def claim_file_owner(self, path: Path, credentials: Credentials, is_absolute: bool = True, size: int = 0) -> str:
+        """
+        Sets the owner of the file only if it does not already have one. This returns the owner after the call.
+        """
+        key = FileOwnerDB.__key(path, is_absolute)
+        if key is None:
+            raise ValueError("The path provided is not valid")
+        
+        size = size if size is not None else 0
+        conn = self.__conn()
+        with self.__index.lock_for(key):
+            owner = self.__index.get(key)
+            if owner is not None:
+                return owner
+            
+            with self.__usage_lock:
+                with conn:
+                    inserted = conn.execute(
+                        "INSERT OR IGNORE INTO files (path, owner, size) VALUES (?, ?, ?)",
+                        (key, credentials.getUsername(), size)
+                    ).rowcount
+                    changes = [(credentials.getUsername(), size)] if inserted == 1 else []
+                    self.__write_usage(conn, changes)
+                self.__apply_usage(changes)
+            self.__index.put(key, credentials.getUsername())
+            return credentials.getUsername()
+    def remove_file(self, path: Path, is_absolute: bool = True):
+        key = FileOwnerDB.__key(path, is_absolute)
+        if key is None:
+            return
+        
+        conn = self.__conn()
+        with self.__index.lock_for(key), self.__usage_lock:
+            with conn:
+                changes = self.__replace_usage(conn, key, None, 0)
+                conn.execute("DELETE FROM files WHERE path = ?", (key,))
+            self.__apply_usage(changes)
+            self.__index.remove(key)
+
+    def __replace_usage(self, conn: sqlite3.Connection, key: str, owner: str | None, size: int) -> list[tuple[str, int]]:
+        """
+        Moves the usage of the file at key (if it is recorded) off of its owner, and adds size to owner (if any). The changes are written in the current transaction, and returned to apply in memory once it commits. The usage lock must be held.
+        """
+        changes = []
+        old = conn.execute("SELECT owner, size FROM files WHERE path = ?", (key,)).fetchone()
+        if old is not None:
+            changes.append((old[0], -old[1]))
+        if owner is not None:
+            changes.append((owner, size))
 
-    def save(self):
-        with open(self.__path, 'w') as f:
-            f.write(json.dumps(self.__data))
+        self.__write_usage(conn, changes)
+        return changes
+    def __write_usage(self, conn: sqlite3.Connection, changes: list[tuple[str, int]]):
+        for owner, delta in changes:
+            conn.execute(
+                "INSERT INTO usage (owner, bytes) VALUES (?, ?) ON CONFLICT (owner) DO UPDATE SET bytes = bytes + excluded.bytes",
+                (owner, delta)
+            )
+    def __apply_usage(self, changes: list[tuple[str, int]]):
+        for owner, delta in changes:
+            self.__usage[owner] = self.__usage.get(owner, 0) + delta
+
+    def usage(self, username: str) -> int:
+        """
+        Returns how many bytes of files the user owns
+        """
+        return self.__usage.get(username, 0)
+    def quota(self, username: str) -> int | None:
+        """
+        Returns how many bytes of files the user may own, or None if there is no limit
+        """
+        return self.__quotas.get(username, self.__default_quota)
+    def set_quota(self, username: str, quota: int | None):
+        """
+        Sets the quota of the user. None makes the default quota apply.
+        """
+        conn = self.__conn()
+        with self.__usage_lock:
+            with conn:
+                conn.execute(
+                    "INSERT INTO usage (owner, quota) VALUES (?, ?) ON CONFLICT (owner) DO UPDATE SET quota = excluded.quota",
+                    (username, quota)
+                )
+            if quota is None:
+                self.__quotas.pop(username, None)
+            else:
+                self.__quotas[username] = quota
+
+    def reserve(self, username: str, size: int) -> bool:
+        """
+        Sets aside size bytes of the user's quota for an upload, if they fit along with what the user owns and has already set aside. Returns false if they do not. The bytes must be given back with release once the upload is done, as the file's real size is counted then.
+        """
+        with self.__usage_lock:
+            reserved = self.__reserved.get(username, 0)
+            quota = self.quota(username)
+            if quota is not None and self.__usage.get(username, 0) + reserved + size > quota:
+                return False
+
+            self.__reserved[username] = reserved + size
+            return True
+    def release(self, username: str, size: int):
+        with self.__usage_lock:
+            reserved = self.__reserved.get(username, 0) - size
+            if reserved > 0:
+                self.__reserved[username] = reserved
+            else:
+                self.__reserved.pop(username, None)
+
+    def set_file_owners(self, files: list[tuple[Path, int, str | None, float | None]], credentials: Credentials, is_absolute: bool = True):
+        """
+        Sets the owner of many files (each given as the path, size, hash, and modification time, as for set_file_owner) in one transaction.
+        """
+        keys = [FileOwnerDB.__key(path, is_absolute) for path, _, _, _ in files]
+        if any(key is None for key in keys):
+            raise ValueError("The path provided is not valid")
+
+        conn = self.__conn()
+        with self.__index.lock_all(), self.__usage_lock:
+            changes = []
+            with conn:
+                for key, (_, size, content_hash, mtime) in zip(keys, files):
+                    size = size if size is not None else 0
+                    changes.extend(self.__replace_usage(conn, key, credentials.getUsername(), size))
+                    conn.execute(
+                        "INSERT OR REPLACE INTO files (path, owner, size, hash, mtime) VALUES (?, ?, ?, ?, ?)",
+                        (key, credentials.getUsername(), size, content_hash, mtime)
+                    )
+            self.__apply_usage(changes)
+            for key in keys:
+                self.__index.put(key, credentials.getUsername())
+
+    def move_files(self, old: Path, new: Path, is_absolute: bool = True) -> int:
+        """
+        Moves the record of the file at old, or of every file below the directory at old, to the same place below new, keeping their owners, sizes, and hashes. Any records already at new are dropped, as the move replaced whatever they described. Returns how many records were moved.
+        """
+        old_key = FileOwnerDB.__key(old, is_absolute)
+        new_key = FileOwnerDB.__key(new, is_absolute)
+        if old_key is None or new_key is None or old_key == "." or new_key == ".":
+            raise ValueError("The path provided is not valid")
+
+        # The path itself, or anything below it (see files_under)
+        at = "path = ? OR (path >= ? AND path < ?)"
+        conn = self.__conn()
+        with self.__index.lock_all(), self.__usage_lock:
+            with conn:
+                stale = conn.execute(f"SELECT path, owner, size FROM files WHERE {at}", (new_key, new_key + "/", new_key + "0")).fetchall()
+                conn.execute(f"DELETE FROM files WHERE {at}", (new_key, new_key + "/", new_key + "0"))
+                changes = [(owner, -size) for _, owner, size in stale]
+                self.__write_usage(conn, changes)
+
+                moved = conn.execute(f"SELECT path, owner FROM files WHERE {at}", (old_key, old_key + "/", old_key + "0")).fetchall()
+                conn.execute(
+                    f"UPDATE files SET path = ? || substr(path, ?) WHERE {at}",
+                    (new_key, len(old_key) + 1, old_key, old_key + "/", old_key + "0")
+                )
+
+            self.__apply_usage(changes)
+            for key, _, _ in stale:
+                self.__index.remove(key)
+            for key, owner in moved:
+                self.__index.remove(key)
+            for key, owner in moved:
+                self.__index.put(new_key + key[len(old_key):], owner)
+
+        return len(moved)
+
+    def files_under(self, path: Path, is_absolute: bool = True) -> list[tuple[str, str]]:
+        """
+        Returns the (relative path, owner) of every file stored below the directory provided.
+        """
+        key = FileOwnerDB.__key(path, is_absolute)
+        if key is None:
+            return []
+        
+        if key == ".":
+            return self.__conn().execute("SELECT path, owner FROM files ORDER BY path").fetchall()
+        
+        # Every path below 'key' sorts between 'key/' and 'key0', as '0' directly follows '/'
+        return self.__conn().execute(
+            "SELECT path, owner FROM files WHERE path >= ? AND path < ? ORDER BY path",
+            (key + "/", key + "0")
+        ).fetchall()
+    def file_hashes(self, keys: list[str]) -> dict[str, tuple[str, int, float]]:
+        """
+        Returns relative path -> (hash, size, modification time) for each of the files (relative paths) that has a recorded hash. Use known_hash to check if the hash still describes the file.
+        """
+        result = {}
+        conn = self.__conn()
+        for start in range(0, len(keys), 500): # SQLite limits how many parameters a statement can have
+            batch = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT path, hash, size, mtime FROM files WHERE hash IS NOT NULL AND path IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            for row in rows:
+                result[row[0]] = (row[1], row[2], row[3])
+
+        return result
+    def files_owned_by(self, username: str) -> list[str]:
+        """
+        Returns the relative paths of every file owned by the user
+        """
+        rows = self.__conn().execute("SELECT path FROM files WHERE owner = ? ORDER BY path", (username,)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        conn = getattr(self.__local, "conn", None)
+        if conn is not None:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.close()
+            self.__local.conn = None
 
 file_owner_db = FileOwnerDB()
 
+def known_hash(recorded: tuple[str, int, float] | None, size: int, mtime: float | None) -> str | None:
+    """
+    Returns the recorded hash (from file_hashes) if the file still has the size & modification time (to the second) it was hashed with, as otherwise it was changed outside of the server.
+    """
+    if recorded is None or mtime is None:
+        return None
+
+    content_hash, recorded_size, recorded_mtime = recorded
+    if recorded_size != size or recorded_mtime is None or int(recorded_mtime) != int(mtime):
+        return None
+
+    return content_hash
+
 def is_file_owner(path: Path, user: Credentials) -> bool:
     global file_owner_db
 
     result = file_owner_db.get_file_owner(path)
-    return result is not None and result == user
+    return result is not None and user is not None and result == user.getUsername()
 
 # Directory Managment
-def contents_to_list(path: Path) -> list[DirectoryInfo | FileInfo]:
+max_dir_page_size = 1000
+
+walker_pool: ThreadPoolExecutor | None = None
+
+def set_walker_threads(count: int):
+    """
+    Sets how many threads a directory walk may fan its subtrees out to. Zero disables the pool, so walks are done entirely on the calling thread.
+    """
+    global walker_pool
+
+    old_pool = walker_pool
+    walker_pool = ThreadPoolExecutor(max_workers=count, thread_name_prefix="walker") if count > 0 else None
+    if old_pool is not None:
+        old_pool.shutdown(wait=False)
+
+def relative_prefix(path: Path) -> str:
+    """
+    Returns the path relative to the root, in the form used for FileOwnerDB keys, ending with a '/' (or empty for the root) so that names can be appended.
+    """
+    relative = make_relative(path)
+    if relative is None or relative.as_posix() == ".":
+        return ""
+    
+    return relative.as_posix() + "/"
+
+def scan_entry(entry: os.DirEntry, prefix: str) -> DirectoryInfo | FileInfo | None:
+    """
+    Converts a single directory entry into an empty DirectoryInfo, or a FileInfo. Only the type & stat information cached by the entry is used, so directories cost no extra system calls, and files at most one.
+    Symbolic links to directories are not followed, so a link cannot make a walk loop forever or leave the root.
+    """
     global file_owner_db
+
+    if entry.is_dir(follow_symlinks=False):
+        return DirectoryInfo(entry.name)
+    elif entry.is_file():
+        owner = file_owner_db.get_file_owner(prefix + entry.name, is_absolute=False)
+        if owner is None:
+            owner = ""
+
+        info = entry.stat()
+        return FileInfo(entry.name, owner, get_suffix_type(os.path.splitext(entry.name)[1]), info.st_size, mtime=info.st_mtime)
+    else:
+        return None
+
+def walk_directory(path: Path, depth: int | None = None, prefix: str | None = None) -> list[DirectoryInfo | FileInfo]:
+    """
+    Lists the contents of the path. This uses an explicit stack instead of recursion, so very deep trees cannot hit the recursion limit. If depth is provided, only that many levels are listed, and deeper directories are left empty.
+    """
+    if prefix is None:
+        prefix = relative_prefix(path)
+
     result = []
+    stack = [(path, prefix, result, 1)]
+    while len(stack) != 0:
+        dir_path, dir_prefix, contents, level = stack.pop()
 
-    for entry in os.listdir(path):
         try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        target = scan_entry(entry, dir_prefix)
+                    except OSError:
+                        continue
 
-            full_path = (path / entry).resolve()
-            if full_path.is_dir():
-                target = DirectoryInfo(entry)
-                target.set_contents(contents_to_list(full_path))
-
-                result.append(target)
-            elif full_path.is_file():
-                raw_owner = file_owner_db.get_file_owner(full_path)
-                if raw_owner is None:
-                    owner = ""
-                else:
-                    owner = raw_owner.getUsername()
-                result.append(
+                    if target is None:
+                        continue
                     
-                    FileInfo(entry, owner, get_file_type(full_path), get_file_total_size(full_path))
-                )
-        except:
+                    contents.append(target)
+                    if isinstance(target, DirectoryInfo) and (depth is None or level < depth):
+                        sub_contents = []
+                        target.set_contents(sub_contents)
+                        stack.append((entry.path, dir_prefix + entry.name + "/", sub_contents, level + 1))
+        except OSError:
             continue
 
     return result
 
-def create_directory_info(start_path: Path = None) -> DirectoryInfo:
+def contents_to_list(path: Path, depth: int | None = None) -> list[DirectoryInfo | FileInfo]:
+    """
+    Lists the contents of the path. If depth is provided, only that many levels are listed, and deeper directories are left empty.
+    If the walker pool is enabled, each subdirectory of the path is walked on its own thread.
+    """
+    global walker_pool
+
+    pool = walker_pool
+    if pool is None or (depth is not None and depth <= 1):
+        return walk_directory(path, depth)
+
+    prefix = relative_prefix(path)
+    result = walk_directory(path, 1, prefix)
+    walks = [
+        (target, pool.submit(walk_directory, path / target.name(), depth - 1 if depth is not None else None, prefix + target.name() + "/"))
+        for target in result if isinstance(target, DirectoryInfo)
+    ]
+    for target, walk in walks:
+        target.set_contents(walk.result())
+
+    return result
+
+def stream_directory(path: Path, depth: int | None = None) -> Iterator[dict]:
+    """
+    Yields the entries below path as the walk finds them, so the first can be sent before the rest of the tree is read. Each is the entry's dictionary (without contents, for directories), along with 'dir': the path of the directory it is in, relative to path ("" for path itself).
+    A directory is always yielded before anything inside of it.
+    """
+    stack = [(path, relative_prefix(path), "", 1)]
+    while len(stack) != 0:
+        dir_path, dir_prefix, relative, level = stack.pop()
+
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        target = scan_entry(entry, dir_prefix)
+                    except OSError:
+                        continue
+
+                    if target is None:
+                        continue
+
+                    if isinstance(target, DirectoryInfo):
+                        record = {
+                            "kind": "directory",
+                            "name": target.name()
+                        }
+                        if depth is None or level < depth:
+                            stack.append((entry.path, dir_prefix + entry.name + "/", relative + entry.name + "/", level + 1))
+                    else:
+                        record = target.to_dict()
+
+                    record["dir"] = relative.rstrip("/")
+                    yield record
+        except OSError:
+            continue
+
+def create_directory_info(start_path: Path = None, depth: int | None = None) -> DirectoryInfo:
     """Create directory info starting from specified path"""
     global root_directory
     
@@ -159,5 +651,109 @@ def create_directory_info(start_path: Path = None) -> DirectoryInfo:
     
     base_name = start_path.name if start_path != root_directory else "root"
     result = DirectoryInfo(base_name)
-    result.set_contents(contents_to_list(start_path))
+    result.set_contents(contents_to_list(start_path, depth))
     return result
+
+def sort_key(name: str, is_dir: bool, size: int, sort: DirSort) -> tuple:
+    """
+    Determines the key used to order & page the entries of a directory. The name is always last, so that the keys are unique.
+    """
+    match sort:
+        case DirSort.Size:
+            return (size if not is_dir else 0, name)
+        case DirSort.Kind:
+            return ("directory" if is_dir else get_suffix_type(os.path.splitext(name)[1]).value, name)
+        case _:
+            return (name,)
+
+def dir_sort_key(entry: os.DirEntry, sort: DirSort) -> tuple:
+    is_dir = entry.is_dir(follow_symlinks=False)
+    return sort_key(entry.name, is_dir, entry.stat().st_size if sort == DirSort.Size and not is_dir else 0, sort)
+
+def select_page(keyed: list[tuple[tuple, object]], page_size: int | None, cursor: str | None, descending: bool) -> tuple[list, str | None]:
+    """
+    Takes a list of (sort key, item), and returns the items of the page that starts after the cursor, and the cursor of the next page (None if this is the last page).
+    """
+    global max_dir_page_size
+
+    if page_size is None or page_size > max_dir_page_size:
+        page_size = max_dir_page_size
+
+    if cursor is not None:
+        try:
+            after = tuple(json.loads(cursor))
+        except:
+            raise ValueError("The cursor is not valid")
+
+        try:
+            if descending:
+                keyed = [item for item in keyed if item[0] < after]
+            else:
+                keyed = [item for item in keyed if item[0] > after]
+        except TypeError:
+            raise ValueError("The cursor does not match the sort order")
+
+    keyed.sort(key=lambda item: item[0], reverse=descending)
+
+    if len(keyed) > page_size:
+        next_cursor = json.dumps(list(keyed[page_size - 1][0]))
+    else:
+        next_cursor = None
+
+    return [item for key, item in keyed[:page_size]], next_cursor
+
+def create_directory_page(start_path: Path, depth: int | None, page_size: int | None, cursor: str | None = None, sort: DirSort = DirSort.Name, descending: bool = False) -> tuple[DirectoryInfo, str | None]:
+    """
+    Creates a directory info containing one page of the entries directly inside start_path, ordered by sort. Each entry is filled to depth. This returns the info, and the cursor of the next page (None if this is the last page).
+    Only the current directory is looked at to order the entries, so the cost depends on the page size & depth, not the size of the whole tree below it.
+    """
+    global root_directory
+
+    keyed = []
+    with os.scandir(start_path) as entries:
+        for entry in entries:
+            try:
+                keyed.append((dir_sort_key(entry, sort), entry))
+            except OSError:
+                continue
+
+    page, next_cursor = select_page(keyed, page_size, cursor, descending)
+
+    result = DirectoryInfo(start_path.name if start_path != root_directory else "root")
+    prefix = relative_prefix(start_path)
+    contents = []
+    for entry in page:
+        try:
+            target = scan_entry(entry, prefix)
+        except OSError:
+            continue
+
+        if target is None:
+            continue
+
+        if isinstance(target, DirectoryInfo) and (depth is None or depth > 1):
+            target.set_contents(contents_to_list(Path(entry.path), depth - 1 if depth is not None else None))
+        contents.append(target)
+    result.set_contents(contents)
+
+    return result, next_cursor
+
+def attach_file_hashes(info: DirectoryInfo, path: Path):
+    """
+    Fills in the content hash of every file in info (the listing of path) that has a recorded hash.
+    """
+    global file_owner_db
+
+    files = []
+    stack = [(info, relative_prefix(path))]
+    while len(stack) != 0:
+        directory, prefix = stack.pop()
+        for item in directory.contents():
+            if isinstance(item, DirectoryInfo):
+                stack.append((item, prefix + item.name() + "/"))
+            else:
+                files.append((prefix + item.name(), item))
+
+    hashes = file_owner_db.file_hashes([key for key, _ in files])
+    for key, item in files:
+        item.set_content_hash(known_hash(hashes.get(key), item.size(), item.mtime()))
@@ -0,0 +1,88 @@
+from pathlib import Path
+import json
+import os
+
+class AppendJournal:
+    """
+    An append only log of JSON records, one per line. Every append is flushed & synced to disk before it returns, so a record that was appended survives a crash.
+    """
+
+    def __init__(self, path: Path):
+        if path is None:
+            raise ValueError("Path must not be none")
+
+        self.__path = path
+        self.__file = None
+        self.__count = 0
+
+    def path(self) -> Path:
+        return self.__path
+
+    def open(self) -> list[dict]:
+        """
+        Opens the journal for appending, and returns every record already stored in it. A partially written final line (from a crash mid-append) is dropped from the file. Any other line that cannot be read is skipped, but left in place, so the records after it are kept.
+        """
+        if self.__file is not None:
+            raise RuntimeError("The journal is already open")
+
+        records = []
+        good_length = 0
+        if self.__path.exists():
+            with open(self.__path, "rb") as f:
+                for number, line in enumerate(f, start=1):
+                    if not line.endswith(b"\n"):
+                        break # Only the last line can be missing its newline
+
+                    good_length += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        print(f"[IO] Skipping unreadable record on line {number} of {self.__path.name}")
+
+        self.__file = open(self.__path, "ab")
+        if self.__file.tell() != good_length:
+            self.__file.truncate(good_length)
+
+        self.__count = len(records)
+        return records
+
+    def append(self, record: dict):
+        if self.__file is None:
+            raise RuntimeError("The journal is not open")
+
+        self.__file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__count += 1
+
+    def truncate(self):
+        """
+        Removes every record from the journal. This is used once the records have been folded into a snapshot.
+        """
+        if self.__file is None:
+            raise RuntimeError("The journal is not open")
+
+        self.__file.truncate(0)
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__count = 0
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __len__(self) -> int:
+        return self.__count
+
+def write_snapshot(path: Path, data) -> None:
+    """
+    Atomically replaces the file at path with the JSON encoding of data. Readers will either see the old contents, or the new ones, never a mix.
+    """
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, path)
@@ -0,0 +1,103 @@
+from pathlib import Path
+from typing import Iterator
+import mmap
+import os
+
+from Common.file_io import file_buffer_size
+from Common.tracing import tracer
+
+class MappedFrames:
+    """
+    The contents of a large file, memory mapped and split into frames for the network as they are sent. Nothing is read into Python, so every download of the same file is sent from the same pages of the OS's page cache, and the OS is told the file is read in order, so it reads ahead.
+    Frames are handed out window_frames at a time, as views into the mapping; only the padding of the last frame is copied. len() is the number of frames, as with the lists of frames returned by read_file_for_network.
+    If ranges (as resolved by resolve_ranges) are given, only those bytes of the file are sent, one after another, as if they were the whole file.
+    """
+
+    window_frames = 64
+    read_ahead_windows = 4 # How far ahead of the window being sent the OS is asked to read
+
+    def __init__(self, path: Path, ranges: list[tuple[int, int]] | None = None, buff_size: int = file_buffer_size):
+        self.__buff_size = buff_size
+        with tracer.span("map", "disk", path=str(path)), open(path, "rb") as f:
+            self.__size = os.fstat(f.fileno()).st_size
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # Keeps its own handle, so the file can be closed
+
+        # The file may have shrunk since the ranges were resolved, so they are cut down to what was mapped
+        self.__ranges = [(min(start, self.__size), min(end, self.__size)) for start, end in ranges] if ranges is not None else None
+        self.__spans = self.__ranges if self.__ranges is not None else [(0, self.__size)]
+        self.__length = sum(end - start for start, end in self.__spans)
+
+        self.__advise = hasattr(self.__map, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL") and hasattr(mmap, "MADV_WILLNEED")
+        if self.__advise:
+            self.__map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __len__(self) -> int:
+        return (self.__length + self.__buff_size - 1) // self.__buff_size
+
+    def size(self) -> int:
+        """
+        Returns the size of the whole file, in bytes
+        """
+        return self.__size
+    def ranges(self) -> list[tuple[int, int]] | None:
+        """
+        Returns the byte ranges sent, or None if it is the whole file
+        """
+        return self.__ranges
+
+    def __iter__(self) -> Iterator[memoryview | bytes]:
+        window = self.__buff_size * MappedFrames.window_frames
+
+        with memoryview(self.__map) as view:
+            for span_start, span_end in self.__spans:
+                for start in range(span_start, span_end, window):
+                    self.__read_ahead(start + window, min(window * MappedFrames.read_ahead_windows, span_end - start - window))
+                    with view[start:min(start + window, span_end)] as chunk: # Released once sent, so the mapping can be closed
+                        yield chunk
+
+        if self.__length % self.__buff_size != 0:
+            yield bytes(self.__buff_size - self.__length % self.__buff_size) # Padding for the last frame, as split_binary_for_network does
+
+    def __read_ahead(self, start: int, length: int):
+        if not self.__advise or start >= self.__size or length <= 0:
+            return
+
+        aligned = start - start % mmap.PAGESIZE
+        try:
+            self.__map.madvise(mmap.MADV_WILLNEED, aligned, min(length + start - aligned, self.__size - aligned))
+        except OSError:
+            self.__advise = False # Only a hint, so it is not worth failing the download over
+
+    def close(self):
+        try:
+            self.__map.close()
+        except BufferError:
+            pass # A send failed partway, so a frame is still being referenced; the mapping is closed once it is collected
+
+def resolve_ranges(ranges: list[tuple[int, int | None]], size: int) -> list[tuple[int, int]] | None:
+    """
+    Sorts the ranges, cuts them down to the size of the file (filling in the open ends), and merges those that overlap or touch. Returns None if none of them are in the file.
+    """
+    resolved = []
+    for start, end in sorted((start, end if end is not None else size) for start, end in ranges):
+        end = min(end, size)
+        if start >= end:
+            continue
+
+        if len(resolved) != 0 and start <= resolved[-1][1]:
+            resolved[-1] = (resolved[-1][0], max(resolved[-1][1], end))
+        else:
+            resolved.append((start, end))
+
+    return resolved if len(resolved) != 0 else None
+
+def map_file_for_network(path: Path) -> MappedFrames | None:
+    """
+    Maps the file for sending, if it can be (ex. empty files cannot be mapped)
+    """
+    try:
+        return MappedFrames(path)
+    except (OSError, ValueError):
+        return None
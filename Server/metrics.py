@@ -0,0 +1,198 @@
+import shutil
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+from .dir_cache import directory_cache
+from .read_cache import read_cache
+from .network_analysis import network_analyzer, StatMetric
+from .handler_timing import handler_timings, Phase
+from Common.tracing import tracer
+
+class CountingSocket:
+    """
+    Wraps a socket, counting the bytes sent and received through it in the server metrics, and the time taken in the handler timings. Everything else is passed to the socket.
+    """
+
+    def __init__(self, conn):
+        self.__conn = conn
+
+    def recv(self, *args, **kwargs) -> bytes:
+        with handler_timings.phase(Phase.Receive), tracer.span("recv", "socket"):
+            data = self.__conn.recv(*args, **kwargs)
+        server_metrics.count_bytes(received=len(data))
+        return data
+    def send(self, data, *args, **kwargs) -> int:
+        with handler_timings.phase(Phase.Send), tracer.span("send", "socket", bytes=len(data)):
+            sent = self.__conn.send(data, *args, **kwargs)
+        server_metrics.count_bytes(sent=sent)
+        return sent
+    def sendall(self, data, *args, **kwargs):
+        with handler_timings.phase(Phase.Send), tracer.span("send", "socket", bytes=len(data)):
+            self.__conn.sendall(data, *args, **kwargs)
+        server_metrics.count_bytes(sent=len(data))
+
+    def __getattr__(self, name):
+        return getattr(self.__conn, name)
+
+class ServerMetrics:
+    """
+    Counts what the server does, and serves it (along with the state of the connections, the Dir cache, the disk, and the transfer percentiles) in the Prometheus text format, from an optional HTTP listener.
+    """
+
+    # The names the NetworkAnalyzer's histograms are exposed under
+    histogram_names = {
+        StatMetric.Throughput: ("cnt_transfer_throughput_mbps", "Transfer throughput over the last 5 minutes, in MB/s"),
+        StatMetric.Duration: ("cnt_transfer_duration_seconds", "Transfer duration over the last 5 minutes"),
+        StatMetric.Latency: ("cnt_request_latency_seconds", "Time from receiving a request to sending its response, over the last 5 minutes")
+    }
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__bytes_received = 0
+        self.__bytes_sent = 0
+        self.__requests: dict[tuple[str, str], int] = {}
+        self.__status = threading.local()
+        self.__server = None
+        self.__thread = None
+        self.__pool = None
+        self.__root = None
+
+    def count_bytes(self, received: int = 0, sent: int = 0):
+        with self.__lock:
+            self.__bytes_received += received
+            self.__bytes_sent += sent
+
+    def note_status(self, code: int | None):
+        """
+        Remembers the status code of the response the current thread sent, to count with its request
+        """
+        self.__status.code = code
+    def count_request(self, kind: str):
+        """
+        Counts a handled request, along with the status code noted for it (if any) by this thread
+        """
+        code = getattr(self.__status, "code", None)
+        self.__status.code = None
+
+        key = (kind, str(code) if code is not None else "none")
+        with self.__lock:
+            self.__requests[key] = self.__requests.get(key, 0) + 1
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text format
+        """
+        lines = []
+        def metric(name: str, kind: str, description: str, samples: list[tuple[dict, float]]):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{ServerMetrics.__escape(str(label))}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        with self.__lock:
+            bytes_received, bytes_sent = self.__bytes_received, self.__bytes_sent
+            requests = dict(self.__requests)
+
+        if self.__pool is not None:
+            metric("cnt_active_connections", "gauge", "Clients currently connected", [({}, self.__pool.active_connections())])
+        metric("cnt_bytes_received_total", "counter", "Bytes received from clients", [({}, bytes_received)])
+        metric("cnt_bytes_sent_total", "counter", "Bytes sent to clients", [({}, bytes_sent)])
+        metric("cnt_requests_total", "counter", "Requests handled, by message type and response status", [
+            ({"type": kind, "code": code}, count) for (kind, code), count in sorted(requests.items())
+        ])
+
+        summaries = network_analyzer.summaries()
+        for stat_metric, (name, description) in ServerMetrics.histogram_names.items():
+            samples = []
+            counts = []
+            for (key_metric, operation), summary in sorted(summaries.items(), key=lambda item: str(item[0][1])):
+                if key_metric != stat_metric:
+                    continue
+
+                operation = operation if operation is not None else "all"
+                for quantile in ["50", "90", "99"]:
+                    samples.append(({"operation": operation, "quantile": f"0.{quantile}"}, summary[f"p{quantile}"]))
+                samples.append(({"operation": operation, "quantile": "1"}, summary["max"]))
+                counts.append(({"operation": operation}, summary["count"]))
+
+            metric(name, "gauge", description, samples)
+            metric(f"{name}_window_count", "gauge", "Measurements in the window", counts)
+
+        if handler_timings.enabled:
+            timings = handler_timings.summary()
+            metric("cnt_handler_seconds_total", "counter", "Seconds spent handling requests, by message type and phase", [
+                ({"type": kind, "phase": phase}, summary["total_seconds"]) for kind, phases in sorted(timings.items()) for phase, summary in phases.items()
+            ])
+            metric("cnt_handler_phase_seconds", "gauge", "Seconds spent in each phase of a request, over the last 5 minutes", [
+                ({"type": kind, "phase": phase, "quantile": quantile}, summary[key]) for kind, phases in sorted(timings.items()) for phase, summary in phases.items()
+                for quantile, key in [("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"), ("1", "max")]
+            ])
+
+        hits, misses = directory_cache.hits, directory_cache.misses
+        metric("cnt_dir_cache_hits_total", "counter", "Dir responses served from the cache", [({}, hits)])
+        metric("cnt_dir_cache_misses_total", "counter", "Dir responses that had to be built", [({}, misses)])
+        metric("cnt_dir_cache_hit_ratio", "gauge", "Share of Dir responses served from the cache", [({}, hits / (hits + misses) if hits + misses != 0 else 0)])
+
+        hits, misses = read_cache.hits, read_cache.misses
+        metric("cnt_read_cache_hits_total", "counter", "Downloads served from the read cache", [({}, hits)])
+        metric("cnt_read_cache_misses_total", "counter", "Downloads that had to read the disk", [({}, misses)])
+        metric("cnt_read_cache_bytes", "gauge", "Bytes of file contents held in the read cache", [({}, read_cache.cached_bytes())])
+
+        if self.__root is not None:
+            try:
+                usage = shutil.disk_usage(self.__root)
+                metric("cnt_disk_total_bytes", "gauge", "Size of the disk holding the stored files", [({}, usage.total)])
+                metric("cnt_disk_used_bytes", "gauge", "Bytes used on the disk holding the stored files", [({}, usage.used)])
+                metric("cnt_disk_free_bytes", "gauge", "Bytes free on the disk holding the stored files", [({}, usage.free)])
+            except OSError:
+                pass
+
+        return "\n".join(lines) + "\n"
+
+    def __escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def start(self, port: int, pool = None, root: Path | None = None, address: str = "127.0.0.1") -> int:
+        """
+        Starts serving the metrics at /metrics on the port (0 picks a free one), and returns the port used. pool is the ThreadPool whose connections are counted, and root is the directory whose disk is reported.
+        """
+        self.stop()
+        self.__pool = pool
+        self.__root = root
+
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Scrapes would flood the server's output
+
+        self.__server = ThreadingHTTPServer((address, port), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True, name="metrics")
+        self.__thread.start()
+        print(f"[METRICS] Serving metrics on http://{address}:{self.__server.server_address[1]}/metrics")
+        return self.__server.server_address[1]
+
+    def stop(self):
+        if self.__server is None:
+            return
+
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+        self.__server = None
+        self.__thread = None
+
+server_metrics = ServerMetrics()
@@ -0,0 +1,697 @@
+from pathlib import Path
+from typing import Callable
+from collections import deque
+from bisect import bisect_left
+import ctypes
+import ctypes.util
+import threading
+import select
+import struct
+import stat
+import json
+import os
+
+from Common.file_io import FileInfo, DirectoryInfo, FileType, get_suffix_type
+from Common.message_handler import DirSort, SearchMatch
+from .io_tools import file_owner_db, sort_key, select_page, max_dir_page_size
+from .search_index import SearchIndex
+
+# inotify event flags, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+event_header = struct.Struct("iIII")
+
+class IndexNode:
+    """
+    A single file or directory held by the NamespaceIndex. For directories, version is the change sequence of the last change to its direct children, and created is the sequence it was added to the index at.
+    """
+    __slots__ = ("name", "parent", "is_dir", "size", "mtime", "children", "version", "created")
+
+    def __init__(self, name: str, parent, is_dir: bool, size: int = 0, mtime: float = 0.0, sequence: int = 0):
+        self.name = name
+        self.parent = parent
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.children: dict[str, IndexNode] | None = {} if is_dir else None
+        self.version = sequence
+        self.created = sequence
+
+    def relative_path(self) -> str:
+        """
+        Returns the path of the node relative to the root, in the form used by the FileOwnerDB
+        """
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+
+        return "/".join(reversed(parts))
+
+class Inotify:
+    """
+    A minimal wrapper around the Linux inotify API, using libc directly.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        self.__libc = ctypes.CDLL(libc_name if libc_name is not None else "libc.so.6", use_errno=True)
+        self.__libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.__libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not start inotify")
+
+    def add_watch(self, path: Path, mask: int = watch_mask) -> int:
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Could not watch '{path}'")
+        return wd
+    def rm_watch(self, wd: int):
+        self.__libc.inotify_rm_watch(self.__fd, wd)
+
+    def read_events(self, timeout: float) -> list[tuple[int, int, str]]:
+        """
+        Waits up to timeout seconds for events, and returns them as (watch descriptor, mask, name)
+        """
+        ready, _, _ = select.select([self.__fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+
+        try:
+            buffer = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + event_header.size <= len(buffer):
+            wd, mask, _, name_len = event_header.unpack_from(buffer, offset)
+            offset += event_header.size
+            name = os.fsdecode(buffer[offset:offset + name_len].rstrip(b"\x00"))
+            offset += name_len
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+class NamespaceIndex:
+    """
+    A live, in memory copy of the names, sizes and modification times of everything in the root directory. It is built once on a background thread, and then kept up to date by inotify (on Linux), and by the server's own changes through refresh.
+    Listeners are told about every changed path, as (path, removed).
+
+    Every change to the children of a directory is given a number from one increasing sequence, and kept in a bounded change log. This lets a client that presents the token of an earlier listing get only what changed since.
+    The names of the files are also kept in a SearchIndex, so they can be searched without walking the tree. Searches of a small subtree walk it instead, and no page of a search looks at more than search_scan_limit files, so the lock is never held for long.
+    """
+
+    search_scan_limit = 10_000
+
+    def __init__(self, change_log_size: int = 4096):
+        self.__root_path = None
+        self.__root = None
+        self.__lock = threading.RLock()
+        self.__ready = threading.Event()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__inotify = None
+        self.__watches: dict[int, Path] = {}
+        self.__listeners: list[Callable[[Path, bool], None]] = []
+        self.__epoch = None
+        self.__sequence = 0
+        self.__changes: deque[tuple[int, IndexNode, str, str]] = deque(maxlen=change_log_size)
+        self.__search_index = SearchIndex()
+
+    def add_listener(self, listener: Callable[[Path, bool], None]):
+        self.__listeners.append(listener)
+    def __notify(self, path: Path, removed: bool):
+        for listener in self.__listeners:
+            try:
+                listener(path, removed)
+            except Exception as e:
+                print(f"[INDEX] Listener failed with '{str(e)}'")
+
+    def start(self, root: Path, use_inotify: bool = True):
+        """
+        Starts building the index of root on a background thread. Until it is ready, callers should fall back to the disk.
+        """
+        if self.__thread is not None:
+            raise RuntimeError("The index is already running")
+
+        self.__root_path = root
+        self.__stop.clear()
+        self.__ready.clear()
+        self.__thread = threading.Thread(target=self.__run, args=[use_inotify], daemon=True, name="namespace-index")
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+        if self.__inotify is not None:
+            self.__inotify.close()
+            self.__inotify = None
+        self.__watches.clear()
+        self.__ready.clear()
+
+    def is_ready(self) -> bool:
+        return self.__ready.is_set()
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        return self.__ready.wait(timeout)
+
+    def __run(self, use_inotify: bool):
+        if use_inotify:
+            try:
+                self.__inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                print(f"[INDEX] inotify is not available ('{str(e)}'), only the server's own changes will be tracked")
+                self.__inotify = None
+
+        # Nothing else touches the index until it is ready, so the first build does not need the lock
+        self.__new_epoch()
+        self.__search_index = SearchIndex()
+        root = IndexNode("", None, True, sequence=self.__sequence)
+        self.__scan_into(root, self.__root_path)
+        self.__search_index.prepare()
+        with self.__lock:
+            self.__root = root
+            self.__ready.set()
+        print(f"[INDEX] Namespace index ready")
+
+        while not self.__stop.is_set():
+            if self.__inotify is None:
+                self.__stop.wait(1.0)
+                continue
+
+            try:
+                events = self.__inotify.read_events(0.5)
+            except OSError as e:
+                print(f"[INDEX] Could not read inotify events ('{str(e)}')")
+                continue
+
+            for wd, mask, name in events:
+                self.__handle_event(wd, mask, name)
+
+    def __rebuild(self):
+        with self.__lock:
+            if self.__inotify is not None:
+                for wd in self.__watches:
+                    self.__inotify.rm_watch(wd)
+            self.__watches.clear()
+
+            self.__new_epoch()
+            self.__search_index = SearchIndex()
+            self.__root = IndexNode("", None, True, sequence=self.__sequence)
+            self.__scan_into(self.__root, self.__root_path)
+            self.__search_index.prepare()
+
+    def __new_epoch(self):
+        """
+        Starts a new change sequence. Tokens handed out before this are no longer accepted, since changes may have been missed.
+        """
+        self.__epoch = os.urandom(4).hex()
+        self.__sequence = 0
+        self.__changes.clear()
+
+    def __record(self, parent: IndexNode, name: str, action: str):
+        """
+        Records that the child 'name' of parent was added, removed, or changed. The lock must be held.
+        """
+        self.__sequence += 1
+        parent.version = self.__sequence
+        self.__changes.append((self.__sequence, parent, name, action))
+
+    def __watch(self, path: Path):
+        if self.__inotify is None:
+            return
+
+        try:
+            wd = self.__inotify.add_watch(path)
+            self.__watches[wd] = path
+        except OSError as e:
+            print(f"[INDEX] {str(e)}, changes made outside of the server will not be seen there")
+
+    def __scan_into(self, node: IndexNode, path: Path):
+        """
+        Fills node (a directory) with the tree at path. Each directory is watched before it is listed, so that nothing created during the scan is missed.
+        """
+        stack = [(node, path)]
+        while len(stack) != 0:
+            dir_node, dir_path = stack.pop()
+            self.__watch(dir_path)
+
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        try:
+                            child = self.__entry_node(entry.name, dir_node, entry.stat(follow_symlinks=False))
+                        except OSError:
+                            continue
+
+                        if child is None:
+                            continue
+
+                        dir_node.children[entry.name] = child
+                        if child.is_dir:
+                            stack.append((child, Path(entry.path)))
+                        else:
+                            self.__search_index.add(child)
+            except OSError:
+                continue
+
+    def __entry_node(self, name: str, parent: IndexNode, info: os.stat_result) -> IndexNode | None:
+        if stat.S_ISDIR(info.st_mode):
+            return IndexNode(name, parent, True, 0, info.st_mtime, self.__sequence)
+        elif stat.S_ISREG(info.st_mode) or stat.S_ISLNK(info.st_mode):
+            if stat.S_ISLNK(info.st_mode):
+                try:
+                    info = os.stat(parent_path_join(self.__root_path, parent, name))
+                except OSError:
+                    return None
+                if not stat.S_ISREG(info.st_mode):
+                    return None # Links to directories are not followed, just like the directory walker
+
+            return IndexNode(name, parent, False, info.st_size, info.st_mtime, self.__sequence)
+        else:
+            return None
+
+    def __find(self, path: Path) -> IndexNode | None:
+        """
+        Finds the node for an absolute path. The lock must be held.
+        """
+        if self.__root is None or path is None:
+            return None
+
+        try:
+            parts = path.relative_to(self.__root_path).parts
+        except ValueError:
+            return None
+
+        node = self.__root
+        for part in parts:
+            if not node.is_dir:
+                return None
+            node = node.children.get(part)
+            if node is None:
+                return None
+
+        return node
+
+    def __update(self, path: Path, changed: bool = False) -> bool:
+        """
+        Brings the node of path up to date with the disk. Returns true if the path was removed. If changed is true, the path is recorded as changed even if its size & time are the same (ex. its owner changed). The lock must be held.
+        """
+        if not self.is_ready() or path == self.__root_path:
+            return False
+
+        parent = self.__find(path.parent)
+        while parent is None:
+            # The parent is new as well (ex. made by mkdir with parents), so the highest new directory is added instead, along with everything below it
+            path = path.parent
+            if path == self.__root_path or not path.is_relative_to(self.__root_path):
+                return False
+            parent = self.__find(path.parent)
+
+        if not parent.is_dir:
+            return False
+
+        try:
+            info = os.stat(path, follow_symlinks=False)
+            node = self.__entry_node(path.name, parent, info)
+        except OSError:
+            node = None
+
+        old = parent.children.get(path.name)
+        if node is None:
+            if old is not None:
+                self.__forget(old, path)
+                self.__search_index.remove_tree(old)
+                del parent.children[path.name]
+                self.__record(parent, path.name, "remove")
+            return True
+
+        if old is not None and old.is_dir and node.is_dir:
+            old.mtime = node.mtime # Keep the children, they are updated on their own
+            if changed:
+                self.__record(parent, path.name, "change")
+            return False
+        
+        if old is not None and not old.is_dir and not node.is_dir and old.size == node.size and old.mtime == node.mtime and not changed:
+            return False # Nothing that is listed changed
+
+        if old is not None:
+            self.__forget(old, path)
+            self.__search_index.remove_tree(old)
+        parent.children[path.name] = node
+        self.__record(parent, path.name, "add" if old is None else "change")
+        if node.is_dir:
+            self.__scan_into(node, path)
+        else:
+            self.__search_index.add(node)
+
+        return False
+
+    def __forget(self, node: IndexNode, path: Path):
+        """
+        Stops watching the directories at or below node. The lock must be held.
+        """
+        if not node.is_dir or self.__inotify is None:
+            return
+
+        for wd in [wd for wd, watched in self.__watches.items() if watched.is_relative_to(path)]:
+            self.__inotify.rm_watch(wd)
+            del self.__watches[wd]
+
+    def __handle_event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            print("[INDEX] inotify queue overflowed, rebuilding the index")
+            self.__rebuild()
+            self.__notify(self.__root_path, False)
+            return
+
+        with self.__lock:
+            directory = self.__watches.get(wd)
+            if mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                return
+            if directory is None:
+                return
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF) or name == "":
+                path = directory
+            else:
+                path = directory / name
+            removed = self.__update(path)
+
+        self.__notify(path, removed)
+
+    def refresh(self, path: Path, changed: bool = False):
+        """
+        Updates the index for a path the server just changed, and tells the listeners. If changed is true, the path is recorded as changed even if nothing on disk did (ex. its owner changed).
+        """
+        if self.is_ready():
+            with self.__lock:
+                removed = self.__update(path, changed)
+        else:
+            removed = not os.path.lexists(path)
+
+        self.__notify(path, removed)
+
+    def lookup(self, path: Path) -> IndexNode | None:
+        """
+        Returns the node for an absolute path, or None if the index is not ready, or the path is not in it. The node should not be modified.
+        """
+        if not self.is_ready():
+            return None
+
+        with self.__lock:
+            return self.__find(path)
+
+    def __to_infos(self, node: IndexNode, prefix: str, depth: int | None) -> list[DirectoryInfo | FileInfo]:
+        """
+        Converts the children of node into info structures, down to depth. The lock must be held.
+        """
+        result = []
+        stack = [(node, prefix, result, 1)]
+        while len(stack) != 0:
+            dir_node, dir_prefix, contents, level = stack.pop()
+            for child in dir_node.children.values():
+                target = self.__to_info(child, dir_prefix)
+                contents.append(target)
+
+                if child.is_dir and (depth is None or level < depth):
+                    sub_contents = []
+                    target.set_contents(sub_contents)
+                    stack.append((child, dir_prefix + child.name + "/", sub_contents, level + 1))
+
+        return result
+    def __to_info(self, node: IndexNode, prefix: str) -> DirectoryInfo | FileInfo:
+        global file_owner_db
+
+        if node.is_dir:
+            return DirectoryInfo(node.name)
+
+        owner = file_owner_db.get_file_owner(prefix + node.name, is_absolute=False)
+        return FileInfo(node.name, owner if owner is not None else "", get_suffix_type(os.path.splitext(node.name)[1]), node.size, mtime=node.mtime)
+
+    def directory_info(self, path: Path, depth: int | None = None) -> DirectoryInfo | None:
+        """
+        Creates the directory info for path from memory. This returns None if the index cannot answer, so the caller should read the disk instead.
+        """
+        if not self.is_ready():
+            return None
+
+        with self.__lock:
+            node = self.__find(path)
+            if node is None or not node.is_dir:
+                return None
+
+            prefix = node.relative_path()
+            result = DirectoryInfo(path.name if path != self.__root_path else "root")
+            result.set_contents(self.__to_infos(node, prefix + "/" if prefix != "" else "", depth))
+            return result
+
+    def directory_page(self, path: Path, depth: int | None, page_size: int | None, cursor: str | None = None, sort: DirSort = DirSort.Name, descending: bool = False) -> tuple[DirectoryInfo, str | None] | None:
+        """
+        The in memory version of create_directory_page. This returns None if the index cannot answer, so the caller should read the disk instead.
+        """
+        if not self.is_ready():
+            return None
+
+        with self.__lock:
+            node = self.__find(path)
+            if node is None or not node.is_dir:
+                return None
+
+            keyed = [(sort_key(child.name, child.is_dir, child.size, sort), child) for child in node.children.values()]
+            page, next_cursor = select_page(keyed, page_size, cursor, descending)
+
+            prefix = node.relative_path()
+            prefix = prefix + "/" if prefix != "" else ""
+            contents = []
+            for child in page:
+                target = self.__to_info(child, prefix)
+                if child.is_dir and (depth is None or depth > 1):
+                    target.set_contents(self.__to_infos(child, prefix + child.name + "/", depth - 1 if depth is not None else None))
+                contents.append(target)
+
+            result = DirectoryInfo(path.name if path != self.__root_path else "root")
+            result.set_contents(contents)
+            return result, next_cursor
+
+    def token(self, path: Path) -> str | None:
+        """
+        Returns the token describing the current state of the directory at path, or None if the index cannot track it. Since the token is taken first, it should be taken before the listing it is sent with is built.
+        """
+        if not self.is_ready():
+            return None
+
+        with self.__lock:
+            node = self.__find(path)
+            if node is None or not node.is_dir:
+                return None
+
+            return f"{self.__epoch}:{self.__sequence}:{node.relative_path()}"
+
+    def changes_since(self, path: Path, token: str) -> tuple[str, dict | None] | None:
+        """
+        Determines what changed in the direct children of the directory at path since the token was handed out. This returns (new token, None) if nothing changed, and (new token, changes) if the changes are known. The changes contain the 'added' and 'changed' entries (as dictionaries), and the 'removed' names.
+        If the changes cannot be determined (the token is unknown, too old, or for another directory), None is returned, and a full listing must be sent.
+        """
+        if not self.is_ready() or token is None:
+            return None
+
+        try:
+            epoch, raw_sequence, relative = token.split(":", 2)
+            since = int(raw_sequence)
+        except ValueError:
+            return None
+
+        with self.__lock:
+            node = self.__find(path)
+            if node is None or not node.is_dir or epoch != self.__epoch or relative != node.relative_path() or since > self.__sequence:
+                return None
+            if node.created > since:
+                return None # The directory was (re)made after the token, so the log does not describe its contents
+
+            new_token = f"{self.__epoch}:{self.__sequence}:{relative}"
+            if node.version <= since:
+                return new_token, None
+
+            if len(self.__changes) == 0 or self.__changes[0][0] > since + 1:
+                return None # Some of the changes have already left the log
+
+            first_actions = {}
+            for sequence, parent, name, action in reversed(self.__changes):
+                if sequence <= since:
+                    break
+                if parent is node:
+                    first_actions[name] = action # Walking backwards, so the earliest action is written last
+
+            prefix = relative + "/" if relative != "" else ""
+            changes = {
+                "added": [],
+                "changed": [],
+                "removed": []
+            }
+            for name, action in first_actions.items():
+                child = node.children.get(name)
+                existed = action != "add"
+                if child is None:
+                    if existed:
+                        changes["removed"].append(name)
+                else:
+                    changes["changed" if existed else "added"].append(self.__to_info(child, prefix).to_dict())
+
+            return new_token, changes
+
+    def search(self, path: Path, query: str, match: SearchMatch = SearchMatch.Substring, kind: FileType | None = None, min_size: int | None = None, max_size: int | None = None, owner: str | None = None, page_size: int | None = None, cursor: str | None = None) -> tuple[list[dict], str | None] | None:
+        """
+        Finds the files below the directory at path whose name matches query (ignoring case), and that pass the filters. The results are ordered by name, then path, and returned one page at a time, along with the cursor of the next page (None if this is the last).
+        At most search_scan_limit files are looked at for a page, so a page can hold fewer results than page_size (even none) and still have a cursor to carry on from.
+        Each result is the file's entry (as in a Dir listing) with its 'path' relative to the directory searched. This returns None if the index is not ready, and raises ValueError if the cursor is not valid.
+        """
+        global file_owner_db
+
+        if not self.is_ready():
+            return None
+
+        page_size = max_dir_page_size if page_size is None else min(page_size, max_dir_page_size)
+        start_name, after_path = "", None
+        if cursor is not None:
+            try:
+                start_name, after_path = json.loads(cursor)
+                if not isinstance(start_name, str) or not isinstance(after_path, str):
+                    raise ValueError()
+            except (ValueError, TypeError):
+                raise ValueError("The cursor is not valid")
+
+        with self.__lock:
+            scope = self.__find(path)
+            if scope is None or not scope.is_dir:
+                return [], None
+
+            scope_prefix = scope.relative_path()
+            scope_prefix = scope_prefix + "/" if scope_prefix != "" else ""
+
+            # A small subtree is walked, rather than going through every match in the share for the few inside of it
+            candidates = self.__scope_candidates(scope, scope_prefix, query.lower(), match, start_name) if scope.parent is not None else None
+            if candidates is None:
+                candidates = self.__candidates(query.lower(), match, owner, start_name)
+
+            results = []
+            last = None # The last result
+            looked_at = None # The last file looked at
+            scanned = 0
+            for name, relative, node in candidates:
+                if name == start_name and after_path is not None and relative <= after_path:
+                    continue
+                if scanned == NamespaceIndex.search_scan_limit:
+                    return results, json.dumps([looked_at[0], looked_at[1]]) # Carries on after the last file looked at
+                scanned += 1
+                looked_at = (name, relative)
+
+                if not relative.startswith(scope_prefix):
+                    continue
+                if (min_size is not None and node.size < min_size) or (max_size is not None and node.size > max_size):
+                    continue
+                if kind is not None and get_suffix_type(os.path.splitext(node.name)[1]) != kind:
+                    continue
+
+                file_owner = file_owner_db.get_file_owner(relative, is_absolute=False)
+                if owner is not None and file_owner != owner:
+                    continue
+
+                if len(results) == page_size:
+                    return results, json.dumps([last[0], last[1]])
+
+                entry = FileInfo(node.name, file_owner if file_owner is not None else "", get_suffix_type(os.path.splitext(node.name)[1]), node.size, mtime=node.mtime).to_dict()
+                entry["path"] = relative[len(scope_prefix):]
+                results.append(entry)
+                last = (name, relative)
+
+            return results, None
+
+    def __scope_candidates(self, scope: IndexNode, scope_prefix: str, query: str, match: SearchMatch, start_name: str) -> list[tuple[str, str, IndexNode]] | None:
+        """
+        Walks the directory scope, and returns (lower case name, relative path, node) for every file below it whose name matches query, from start_name on, in order. Returns None if the subtree holds more than search_scan_limit entries, as searching the whole index is then cheaper. The lock must be held.
+        """
+        found = []
+        visited = 0
+        stack = [(scope, scope_prefix)]
+        while len(stack) != 0:
+            directory, prefix = stack.pop()
+            visited += len(directory.children)
+            if visited > NamespaceIndex.search_scan_limit:
+                return None
+
+            for child in directory.children.values():
+                if child.is_dir:
+                    stack.append((child, prefix + child.name + "/"))
+                    continue
+
+                name = child.name.lower()
+                if name >= start_name and (name.startswith(query) if match == SearchMatch.Prefix else query in name):
+                    found.append((name, prefix + child.name, child))
+
+        found.sort(key=lambda item: (item[0], item[1]))
+        return found
+
+    def __candidates(self, query: str, match: SearchMatch, owner: str | None, start_name: str):
+        """
+        Yields (lower case name, relative path, node) for every file whose name matches query, starting at start_name, in order. The lock must be held.
+        """
+        global file_owner_db
+
+        if query == "" and owner is not None:
+            # Only the owner's files can match, and the database finds those without visiting every name
+            found = []
+            for relative in file_owner_db.files_owned_by(owner):
+                node = self.__find(self.__root_path / relative)
+                if node is not None and not node.is_dir:
+                    found.append((node.name.lower(), relative, node))
+            found.sort(key=lambda item: (item[0], item[1]))
+
+            yield from found[bisect_left(found, start_name, key=lambda item: item[0]):]
+            return
+
+        if match == SearchMatch.Prefix:
+            names = self.__search_index.prefix_names(query, start_name)
+        else:
+            names = self.__search_index.substring_names(query, start_name)
+
+        for name in names:
+            nodes = self.__search_index.nodes(name)
+            if len(nodes) == 1:
+                node = next(iter(nodes))
+                yield name, node.relative_path(), node
+            else:
+                for relative, node in sorted(((node.relative_path(), node) for node in nodes), key=lambda item: item[0]):
+                    yield name, relative, node
+
+def parent_path_join(root: Path, parent: IndexNode, name: str) -> Path:
+    relative = parent.relative_path()
+    return root / relative / name if relative != "" else root / name
+
+namespace_index = NamespaceIndex()
@@ -1,71 +1,265 @@
 import json
+import time
+import threading
+from collections import OrderedDict, deque
+from enum import Enum
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 
-@dataclass
+from .histogram import Histogram, WindowedHistogram
+from .stats_log import StatsLog
+
+@dataclass(slots=True)
 class TransferStats:
     file_size: int
     transfer_time: float
     data_rate: float
-    latency: float
+    latency: float # The smoothed round trip time of the connection at the time, or 0 if it was not measured
     ip: str
+    user: str | None = None
+    time: float = 0.0 # When the transfer finished, in seconds since the epoch
+    operation: str | None = None
+
+class RttEstimator:
+    """
+    Smooths the round trip times measured on a connection the way TCP does: the smoothed RTT moves an eighth of the way to each sample, and the jitter (the mean deviation) a quarter of the way to how far the sample was from it.
+    """
+
+    def __init__(self, alpha: float = 1 / 8, beta: float = 1 / 4):
+        self.__alpha = alpha
+        self.__beta = beta
+        self.__srtt = None
+        self.__jitter = 0.0
+        self.__samples = 0
+
+    def add(self, sample: float):
+        if sample < 0:
+            return # Not a real round trip (e.g. a bad echo)
+
+        if self.__srtt is None:
+            self.__srtt = sample
+            self.__jitter = sample / 2
+        else:
+            self.__jitter += self.__beta * (abs(self.__srtt - sample) - self.__jitter)
+            self.__srtt += self.__alpha * (sample - self.__srtt)
+        self.__samples += 1
+
+    def srtt(self) -> float | None:
+        return self.__srtt
+    def jitter(self) -> float | None:
+        return self.__jitter if self.__srtt is not None else None
+    def samples(self) -> int:
+        return self.__samples
+
+class StatMetric(Enum):
+    """
+    The measurements kept as histograms
+    """
+    Throughput = "throughput" # MB/s of a transfer
+    Duration = "duration" # Seconds a transfer took
+    Latency = "latency" # Seconds from a request being received to its response being sent
 
 class NetworkAnalyzer:
-    def __init__(self):
+    """
+    Keeps the most recent transfer statistics of each IP and each user. Every IP and user gets a ring buffer of at most per_key_limit records, and at most max_keys IPs (and users) are kept, dropping the least recently active once there are more. This bounds the memory used, no matter how long the server runs.
+    Every record is also appended to a StatsLog as it is made, so they survive a crash. On open, only the records of the last load_window seconds are read back.
+
+    Every measurement is also counted in windowed histograms, for the operation, for every operation together, and the same two for the user, so percentiles over the last few minutes can be asked for. These are not saved.
+    """
+
+    def __init__(self, per_key_limit: int = 256, max_keys: int = 1024, load_window: float = 24 * 60 * 60):
         self.stats_file = None
-        self.stats: list[TransferStats] = None
+        self.__log = None
+        self.__load_window = load_window
+        self.__lock = threading.Lock()
+        self.__per_key_limit = per_key_limit
+        self.__max_keys = max_keys
+        self.__by_ip: OrderedDict[str, deque[TransferStats]] = OrderedDict()
+        self.__by_user: OrderedDict[str, deque[TransferStats]] = OrderedDict()
+        # Keyed by metric and operation, where an operation of None is every operation
+        self.__histograms: dict[tuple[StatMetric, str | None], WindowedHistogram] = {}
+        self.__user_histograms: OrderedDict[str, dict[tuple[StatMetric, str | None], WindowedHistogram]] = OrderedDict()
 
     def open(self, path: Path):
+        """
+        Opens the stats log in the directory at path. If the stats file of an older version of the server (path with a .json suffix) is there, its records are moved into the log.
+        """
+        self.save()
         self.stats_file = path
-        
+        self.__log = StatsLog(path)
+        records = self.__log.open(time.time() - self.__load_window)
+
+        legacy_path = path.with_suffix(".json")
+        if legacy_path.is_file():
+            legacy = NetworkAnalyzer.__read_legacy(legacy_path)
+            for record in legacy:
+                self.__log.append(record)
+            self.__log.flush()
+
+            records.extend(legacy)
+            legacy_path.unlink()
+
+        stats = []
+        for record in records:
+            try:
+                stats.append(TransferStats(**record))
+            except TypeError: # Not a record we know how to read
+                continue
+
+        stats.sort(key=lambda stat: stat.time)
+        with self.__lock:
+            self.__by_ip.clear()
+            self.__by_user.clear()
+            for stat in stats:
+                self.__add(stat)
+
+    def __read_legacy(path: Path) -> list[dict]:
+        """
+        Reads the records of a stats file from an older version of the server, which did not record when each transfer happened; the time the file was written is used instead.
+        """
         try:
-            with open(self.stats_file, 'r') as f:
+            with open(path, 'r') as f:
                 contents = f.read()
                 if contents is None or len(contents) == 0:
                     contents = "[]"
 
                 data = json.loads(contents)
-                self.stats = data
-        except (FileNotFoundError, json.JSONDecodeError):
-            self.stats = []
+            written = path.stat().st_mtime
+        except (OSError, json.JSONDecodeError):
+            return []
 
-    # Saves statistics to file
+        records = [record for record in data if isinstance(record, dict)] if isinstance(data, list) else []
+        for record in records:
+            record.setdefault("time", written)
+        return records
+
+    # Writes any statistics not yet written, and closes the log
     def save(self):
-        with open(self.stats_file, 'w') as f:
-            # Convert TransferStats objects to dictionaries
-            data =  [
-                        {
-                            "file_size": stat.file_size,
-                            "transfer_time": stat.transfer_time,
-                            "data_rate": stat.data_rate,
-                            "latency": stat.latency,
-                            "ip": stat.ip,
-                        }
-                        for stat in self.stats
-                    ]
-            json.dump(data, f)
-
-    # Records statistics for a file transfer
-    def record_transfer(self, file_size: int, start_time: float, end_time: float, ip: str) -> None:
-        time = end_time - start_time
-        rate = NetworkAnalyzer._calculate_data_rate(file_size, time)
-        latency = 1 / time
+        if self.__log is None:
+            return
+
+        self.__log.close()
+        self.__log = None
+
+    def rollups(self) -> list[dict]:
+        """
+        Returns the hourly totals of the transfers that were compacted out of the log (see StatsLog.roll_up)
+        """
+        return self.__log.rollups() if self.__log is not None else []
+
+    def record_transfer(self, file_size: int, start_time: float, end_time: float, ip: str, user: str | None = None, operation: str = "transfer", latency: float | None = None) -> None:
+        """
+        Records a transfer. latency is the smoothed round trip time of the connection, if it has been measured.
+        """
+        time_taken = end_time - start_time
+        rate = NetworkAnalyzer._calculate_data_rate(file_size, time_taken)
+        latency = latency if latency is not None else 0.0
 
         stat = TransferStats(
             file_size = file_size,
-            transfer_time = time,
+            transfer_time = time_taken,
             data_rate = rate,
             latency = latency,
-            ip = ip
+            ip = ip,
+            user = user,
+            time = time.time(),
+            operation = operation
         )
 
-        self.stats.append(stat)
+        with self.__lock:
+            self.__add(stat)
+            if self.__log is not None:
+                self.__log.append(asdict(stat))
+            self.__measure(StatMetric.Throughput, rate, operation, user, stat.time)
+            self.__measure(StatMetric.Duration, time_taken, operation, user, stat.time)
+
+    def record_latency(self, operation: str, latency: float, user: str | None = None) -> None:
+        """
+        Records how long, in seconds, the server took to handle a request
+        """
+        with self.__lock:
+            self.__measure(StatMetric.Latency, latency, operation, user, time.time())
+
+    def percentiles(self, metric: StatMetric, operation: str | None = None, user: str | None = None, window: float = 300.0) -> dict:
+        """
+        Returns the count, p50, p90, p99, and max of metric over the last window seconds. This covers one operation, or every operation if it is None, and one user, or the whole server if it is None.
+        """
+        with self.__lock:
+            if user is None:
+                histograms = self.__histograms
+            else:
+                histograms = self.__user_histograms.get(user, {})
+
+            histogram = histograms.get((metric, operation))
+            if histogram is None:
+                return Histogram().summary()
+            return histogram.window(window).summary()
+
+    def summaries(self, window: float = 300.0) -> dict[tuple[StatMetric, str | None], dict]:
+        """
+        Returns the summary (see percentiles) of every server wide histogram over the last window seconds, keyed by metric and operation.
+        """
+        with self.__lock:
+            return { key: histogram.window(window).summary() for key, histogram in self.__histograms.items() }
+
+    def __measure(self, metric: StatMetric, value: float, operation: str, user: str | None, now: float):
+        """
+        Counts value in the histograms it belongs to. The lock must be held.
+        """
+        scopes = [self.__histograms]
+        if user is not None:
+            histograms = self.__user_histograms.get(user)
+            if histograms is None:
+                histograms = {}
+                self.__user_histograms[user] = histograms
+                while len(self.__user_histograms) > self.__max_keys:
+                    self.__user_histograms.popitem(last=False)
+            else:
+                self.__user_histograms.move_to_end(user)
+            scopes.append(histograms)
+
+        for histograms in scopes:
+            for key in [(metric, operation), (metric, None)]:
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = WindowedHistogram()
+                    histograms[key] = histogram
+                histogram.record(value, now)
+
+    def __add(self, stat: TransferStats):
+        """
+        Appends the record to the buffers of its IP and user. The lock must be held.
+        """
+        self.__append(self.__by_ip, stat.ip, stat)
+        if stat.user is not None:
+            self.__append(self.__by_user, stat.user, stat)
+    def __append(self, buffers: OrderedDict[str, deque[TransferStats]], key: str, stat: TransferStats):
+        buffer = buffers.get(key)
+        if buffer is None:
+            buffer = deque(maxlen=self.__per_key_limit)
+            buffers[key] = buffer
+            while len(buffers) > self.__max_keys:
+                buffers.popitem(last=False)
+        else:
+            buffers.move_to_end(key)
+
+        buffer.append(stat)
 
     def get_ip_stats(self, ip: str) -> list[TransferStats]:
-        return [stat for stat in self.stats if stat.ip == ip]
+        with self.__lock:
+            return list(self.__by_ip.get(ip, ()))
     def get_last_ip_stats(self, ip: str) -> TransferStats | None:
-        ip_stats = self.get_ip_stats(ip)
-        return ip_stats[-1] if ip_stats else None
+        with self.__lock:
+            stats = self.__by_ip.get(ip)
+            return stats[-1] if stats else None
+
+    def get_user_stats(self, user: str) -> list[TransferStats]:
+        with self.__lock:
+            return list(self.__by_user.get(user, ()))
+    def get_last_user_stats(self, user: str) -> TransferStats | None:
+        with self.__lock:
+            stats = self.__by_user.get(user)
+            return stats[-1] if stats else None
 
     # Calculates data rate in MB/s
     def _calculate_data_rate(file_size: int, transfer_time: float) -> float:
@@ -74,4 +268,4 @@ class NetworkAnalyzer:
         return 0.0
 
 # Global instance
-network_analyzer = NetworkAnalyzer()
\ No newline at end of file
+network_analyzer = NetworkAnalyzer()
@@ -1,5 +1,6 @@
 from .credentials import *
 from socket import socket as soc
+import threading
 import socket 
 
 from .connection import Connection
@@ -9,6 +10,7 @@ class ThreadPool:
         self.__socket = soc(socket.AF_INET, socket.SOCK_STREAM)
         self.__bound = False
         self.__cons = [Connection() for x in range(4)]
+        self.__cons_lock = threading.Lock() # The connections are also read by the metrics endpoint's thread
 
     def bind(self, port: int, address: str = None):
         self.__socket.bind((address, port))
@@ -24,26 +26,35 @@ class ThreadPool:
     def kill(self):
         self.__socket.close()
         
-        for conn in self.__cons:
+        with self.__cons_lock:
+            cons = self.__cons
+            self.__cons = None
+        for conn in cons:
             conn.kill()
-        self.__cons.clear()
-        self.__cons = None
         self.__socket.close()
         self.__socket = None
         self.__bound = False
 
+    def active_connections(self) -> int:
+        """
+        Returns the number of connections being served. Unlike is_connected, is_alive does not clear out finished connections, so this can be called from any thread.
+        """
+        with self.__cons_lock:
+            return sum(1 for con in self.__cons if con.is_alive()) if self.__cons is not None else 0
+
     def __get_next_open(self) -> Connection:
         if not self.__bound:
             return None
         
-        for con in self.__cons:
-            if not con.is_connected():
-                return con
-            
-        # at this point, there are no open ones, so we add one.
-        newConn = Connection()
-        self.__cons.append(newConn)
-        return newConn
+        with self.__cons_lock:
+            for con in self.__cons:
+                if not con.is_connected():
+                    return con
+                
+            # at this point, there are no open ones, so we add one.
+            newConn = Connection()
+            self.__cons.append(newConn)
+            return newConn
     
     def mainLoop(self):
         print("[CONTROL] Entering main loop, accepting connections")
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from pathlib import Path
+import threading
+import os
+
+from Common.file_io import file_buffer_size, read_file_for_network
+from Common.tracing import tracer
+from .namespace_index import namespace_index
+from .mapped_file import MappedFrames, map_file_for_network
+
+class CachedFile:
+    """
+    The contents of a file, split into frames for the network. The frames are views into one buffer, so handing them to any number of requests copies nothing.
+    """
+
+    __slots__ = ("mtime", "inode", "size", "frames")
+
+    def __init__(self, mtime: int, inode: int, size: int, frames: list[memoryview]):
+        self.mtime = mtime
+        self.inode = inode
+        self.size = size
+        self.frames = frames
+
+    def held(self) -> int:
+        """
+        Returns the bytes held in memory, which includes the padding of the last frame
+        """
+        return len(self.frames) * file_buffer_size
+
+    def matches(self, info: os.stat_result) -> bool:
+        return self.mtime == info.st_mtime_ns and self.inode == info.st_ino and self.size == info.st_size
+
+class ReadCache:
+    """
+    Caches the network ready contents of small files, so downloads of popular files are served from memory. Files larger than max_file_bytes are never cached, and the least recently used files are dropped once the cached contents total more than max_bytes.
+    Every read checks the file's modification time, inode, and size against the cached ones, so a file changed behind the server's back (or replaced by an upload, which gives it a new inode) is read again.
+    Files too large to cache are memory mapped instead (see MappedFrames), so they are sent from the page cache rather than copied into memory for each download.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_file_bytes: int = 1024 * 1024):
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[Path, CachedFile] = OrderedDict()
+        self.__max_bytes = max_bytes
+        self.__max_file_bytes = max_file_bytes
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def cached_bytes(self) -> int:
+        return self.__bytes
+
+    def read(self, path: Path) -> list[memoryview] | list[bytes] | MappedFrames | None:
+        """
+        Returns the contents of the file split into frames, as read_file_for_network does, from the cache if they are there and still current. Returns None if the file cannot be read.
+        The frames of a large file are a MappedFrames, which should be closed once sent.
+        """
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+
+        with self.__lock:
+            entry = self.__entries.get(path)
+            if entry is not None and entry.matches(info):
+                self.hits += 1
+                self.__entries.move_to_end(path)
+                return entry.frames
+            self.misses += 1
+
+        if info.st_size > self.__max_file_bytes:
+            mapped = map_file_for_network(path)
+            return mapped if mapped is not None else read_file_for_network(path)
+
+        try:
+            with tracer.span("read", "disk", path=str(path)), open(path, "rb") as f:
+                contents = f.read()
+                info = os.fstat(f.fileno()) # What was actually read, in case it was replaced since the stat above
+        except OSError:
+            return None
+
+        if len(contents) != info.st_size:
+            return ReadCache.__split(contents) # Changed while it was read, so it is not kept
+
+        entry = CachedFile(info.st_mtime_ns, info.st_ino, info.st_size, ReadCache.__split(contents))
+        self.__put(path, entry)
+        return entry.frames
+
+    def __split(contents: bytes, buff_size: int = file_buffer_size) -> list[memoryview]:
+        """
+        Pads the contents to a whole number of frames (with zeroes, as split_binary_for_network does), and splits it into views of buff_size
+        """
+        if len(contents) % buff_size != 0:
+            contents = contents.ljust(len(contents) + buff_size - len(contents) % buff_size, b'\x00')
+
+        view = memoryview(contents)
+        return [view[i:i + buff_size] for i in range(0, len(contents), buff_size)]
+
+    def __put(self, path: Path, entry: CachedFile):
+        with self.__lock:
+            old = self.__entries.pop(path, None)
+            if old is not None:
+                self.__bytes -= old.held()
+
+            self.__entries[path] = entry
+            self.__bytes += entry.held()
+            while self.__bytes > self.__max_bytes:
+                _, dropped = self.__entries.popitem(last=False)
+                self.__bytes -= dropped.held()
+
+    def invalidate(self, path: Path, subtree: bool = False):
+        """
+        Drops the cached contents of path. If subtree is true, those of everything below path are dropped as well (used when a directory is removed).
+        """
+        if path is None:
+            return
+
+        with self.__lock:
+            dropped = self.__entries.pop(path, None)
+            if dropped is not None:
+                self.__bytes -= dropped.held()
+
+            if subtree:
+                for key in [key for key in self.__entries if key.is_relative_to(path)]:
+                    self.__bytes -= self.__entries.pop(key).held()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+read_cache = ReadCache()
+namespace_index.add_listener(lambda path, removed: read_cache.invalidate(path, subtree=removed))
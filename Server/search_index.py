@@ -0,0 +1,209 @@
+from bisect import bisect_left, insort
+from itertools import accumulate
+from typing import Iterator
+
+class SearchIndex:
+    """
+    An index of the names of the files in the NamespaceIndex, for searching by prefix or by substring. Names are kept lower case and sorted, so both kinds of search visit the matches in name order, and can stop as soon as a page is full.
+
+    The sorted names are split into chunks, so adding or removing a name only touches one chunk. To search a chunk for a substring, its names are joined into one string (separated by NUL, which cannot be in a file name) and scanned with str.find. Each chunk also has a small bloom filter of the trigrams (runs of three characters) in its names, so chunks that cannot contain the query are skipped without being scanned.
+    This keeps the memory used close to the size of the names themselves, where a full trigram table would take many times that on a large share.
+    The index does not lock; the NamespaceIndex's lock must be held.
+    """
+
+    separator = "\x00"
+    chunk_size = 512 # Chunks are split once they reach twice this
+    bloom_bits = 32768
+
+    def __init__(self):
+        self.__nodes: dict[str, set] = {}
+        self.__count = 0
+        # Built when first needed, as keeping the chunks sorted while the first scan inserts every name would be much slower than sorting once
+        self.__chunks: list[list[str]] | None = None
+        self.__maxes: list[str] = []
+        self.__scans: list[tuple[str, list[int], bytearray] | None] = []
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def add(self, node):
+        """
+        Adds a file node to the index. Directories are not indexed.
+        """
+        if node.is_dir:
+            return
+
+        name = node.name.lower()
+        nodes = self.__nodes.get(name)
+        if nodes is None:
+            nodes = set()
+            self.__nodes[name] = nodes
+            if self.__chunks is not None:
+                self.__insert(name)
+
+        if node not in nodes:
+            nodes.add(node)
+            self.__count += 1
+    def remove(self, node):
+        if node.is_dir:
+            return
+
+        name = node.name.lower()
+        nodes = self.__nodes.get(name)
+        if nodes is None or node not in nodes:
+            return
+
+        nodes.discard(node)
+        self.__count -= 1
+        if len(nodes) == 0:
+            del self.__nodes[name]
+            if self.__chunks is not None:
+                self.__delete(name)
+
+    def add_tree(self, node):
+        """
+        Adds node, and every file below it
+        """
+        self.__walk(node, self.add)
+    def remove_tree(self, node):
+        """
+        Removes node, and every file below it
+        """
+        self.__walk(node, self.remove)
+    def __walk(self, node, action):
+        stack = [node]
+        while len(stack) != 0:
+            current = stack.pop()
+            if current.is_dir:
+                stack.extend(current.children.values())
+            else:
+                action(current)
+
+    def nodes(self, name: str) -> set:
+        """
+        Returns the nodes of the files with the (lower case) name. The set should not be modified.
+        """
+        return self.__nodes.get(name, set())
+
+    def prepare(self):
+        """
+        Sorts the names, and builds the search data of every chunk, so that the first searches do not have to.
+        """
+        chunks = self.__sorted_chunks()
+        for i in range(len(chunks)):
+            self.__scan(i)
+
+    def prefix_names(self, prefix: str, start: str = "") -> Iterator[str]:
+        """
+        Yields, in order, every (lower case) name that starts with prefix, and is not before start.
+        """
+        chunks = self.__sorted_chunks()
+        key = max(prefix, start)
+        i = bisect_left(self.__maxes, key)
+        j = bisect_left(chunks[i], key) if i < len(chunks) else 0
+        while i < len(chunks):
+            chunk = chunks[i]
+            while j < len(chunk):
+                if not chunk[j].startswith(prefix):
+                    return
+                yield chunk[j]
+                j += 1
+
+            i += 1
+            j = 0
+
+    def substring_names(self, query: str, start: str = "") -> Iterator[str]:
+        """
+        Yields, in order, every (lower case) name that contains query, and is not before start.
+        """
+        chunks = self.__sorted_chunks()
+        i = bisect_left(self.__maxes, start)
+        j = bisect_left(chunks[i], start) if i < len(chunks) else 0
+        trigrams = [hash(query[k:k + 3]) & (SearchIndex.bloom_bits - 1) for k in range(len(query) - 2)]
+
+        while i < len(chunks):
+            chunk = chunks[i]
+            if query == "":
+                for k in range(j, len(chunk)):
+                    yield chunk[k]
+            else:
+                blob, offsets, bloom = self.__scan(i)
+                if all(bloom[bit >> 3] & (1 << (bit & 7)) for bit in trigrams):
+                    position = offsets[j] if j < len(offsets) else len(blob)
+                    while True:
+                        position = blob.find(query, position)
+                        if position == -1:
+                            break
+
+                        k = bisect_left(offsets, position + 1) - 1
+                        end = offsets[k] + len(chunk[k])
+                        if position + len(query) <= end: # Otherwise the match runs over the separator
+                            yield chunk[k]
+                        position = end + 1 # Each name is given once, even if the query is in it more than once
+
+            i += 1
+            j = 0
+
+    def __sorted_chunks(self) -> list[list[str]]:
+        if self.__chunks is None:
+            names = sorted(self.__nodes)
+            self.__chunks = [names[i:i + SearchIndex.chunk_size] for i in range(0, len(names), SearchIndex.chunk_size)]
+            self.__maxes = [chunk[-1] for chunk in self.__chunks]
+            self.__scans = [None] * len(self.__chunks)
+        return self.__chunks
+
+    def __scan(self, i: int) -> tuple[str, list[int], bytearray]:
+        """
+        Returns the joined names, the offset of each name in them, and the trigram bloom filter of chunk i, building them if the chunk changed.
+        """
+        scan = self.__scans[i]
+        if scan is None:
+            chunk = self.__chunks[i]
+            blob = SearchIndex.separator.join(chunk)
+            offsets = [0] + list(accumulate(len(name) + 1 for name in chunk[:-1]))
+
+            bloom = bytearray(SearchIndex.bloom_bits // 8)
+            for trigram in {blob[k:k + 3] for k in range(len(blob) - 2)}:
+                bit = hash(trigram) & (SearchIndex.bloom_bits - 1)
+                bloom[bit >> 3] |= 1 << (bit & 7)
+
+            scan = (blob, offsets, bloom)
+            self.__scans[i] = scan
+        return scan
+
+    def __insert(self, name: str):
+        if len(self.__chunks) == 0:
+            self.__chunks.append([name])
+            self.__maxes.append(name)
+            self.__scans.append(None)
+            return
+
+        i = min(bisect_left(self.__maxes, name), len(self.__chunks) - 1)
+        chunk = self.__chunks[i]
+        insort(chunk, name)
+        self.__maxes[i] = chunk[-1]
+        self.__scans[i] = None
+
+        if len(chunk) >= 2 * SearchIndex.chunk_size:
+            half = len(chunk) // 2
+            self.__chunks[i:i + 1] = [chunk[:half], chunk[half:]]
+            self.__maxes[i:i + 1] = [chunk[half - 1], chunk[-1]]
+            self.__scans[i:i + 1] = [None, None]
+    def __delete(self, name: str):
+        i = bisect_left(self.__maxes, name)
+        if i == len(self.__chunks):
+            return
+
+        chunk = self.__chunks[i]
+        j = bisect_left(chunk, name)
+        if j == len(chunk) or chunk[j] != name:
+            return
+
+        del chunk[j]
+        if len(chunk) == 0:
+            del self.__chunks[i]
+            del self.__maxes[i]
+            del self.__scans[i]
+        else:
+            self.__maxes[i] = chunk[-1]
+            self.__scans[i] = None
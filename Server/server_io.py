@@ -1,17 +1,49 @@
 import os
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
 from pathlib import Path
 from socket import socket
 
-from Common.http_codes import HTTPErrorBasis, NotFoundError, UnauthorizedError, ForbiddenError, ConflictError
-from Common.message_handler import SubfolderAction
-from Common.file_io import receive_network_file, read_file_for_network
+from Common.http_codes import HTTPErrorBasis, NotFoundError, UnauthorizedError, ForbiddenError, ConflictError, ServiceUnavailableError, InsufficientStorageError, RangeNotSatisfiableError
+from Common.message_handler import SubfolderAction, SearchMessage, RelocateAction
+from Common.file_io import receive_network_file, split_binary_for_network, file_buffer_size, SyncPolicy
+from Common.tracing import tracer
 from .credentials import Credentials
-from .io_tools import is_path_valid, is_file_owner, file_owner_db
+from .io_tools import is_path_valid, is_file_owner, file_owner_db, make_relative, known_hash
+from .server_paths import staging_path, root_directory
+from .file_copy import copy_file, copy_tree, rename_no_replace, make_parents, remove_parents
+from .read_cache import read_cache
+from .mapped_file import MappedFrames, resolve_ranges
+from .namespace_index import namespace_index
+
+upload_sync = SyncPolicy.End # How uploads are synced to disk before they are published
+max_download_ranges = 16
+
+# The paths being uploaded to. Uploads are only published once received, so this is what stops a second upload to a path that is not there yet.
+uploading: set[Path] = set()
+uploading_lock = threading.Lock()
 
 class UploadHandle:
-    def __init__(self, path: Path, owner: Credentials):
+    """
+    An upload allowed by RequestUpload. It holds a reservation of the owner's quota for the declared size, and the path it is uploading to, which are given back by release (UploadFile does so once the file is written).
+    """
+    def __init__(self, path: Path, owner: Credentials, reserved: int = 0):
         self.path = path
         self.owner = owner
+        self.reserved = reserved
+        self.claimed = True
+
+    def release(self):
+        if self.reserved != 0:
+            file_owner_db.release(self.owner.getUsername(), self.reserved)
+            self.reserved = 0
+        if self.claimed:
+            with uploading_lock:
+                uploading.discard(self.path)
+            self.claimed = False
 
 def RequestUpload(path: Path, size: int, curr_user: Credentials) -> UploadHandle | HTTPErrorBasis: 
     if path is None or curr_user is None:
@@ -24,37 +56,60 @@ def RequestUpload(path: Path, size: int, curr_user: Credentials) -> UploadHandle
     if size is None or size == 0:
         return ConflictError("The file size is zero")
 
+    with uploading_lock:
+        if path in uploading:
+            return ConflictError("File is already being uploaded")
+        uploading.add(path)
+    handle = UploadHandle(path, curr_user)
+
+    # The size is given in frames, so the most the file can take up is reserved
+    reserved = size * file_buffer_size
+    if not file_owner_db.reserve(curr_user.getUsername(), reserved):
+        handle.release()
+        return InsufficientStorageError("The file would put you over your storage quota")
+    handle.reserved = reserved
+
     # At this point, we are ok for writing. Send a response back to the front end.
     try:
-        path.parent.mkdir(parents=True, exist_ok=True)
-        return UploadHandle(path, curr_user)
+        with tracer.span("mkdir", "disk"):
+            path.parent.mkdir(parents=True, exist_ok=True)
+        namespace_index.refresh(path.parent)
+        return handle
     except PermissionError:
+        handle.release()
         return UnauthorizedError("The system does not have access to the resource specified")
     except:
+        handle.release()
         return ConflictError("File aready exists")
     
 def UploadFile(handle: UploadHandle, socket: socket, frame_size: int) -> bool:
     global file_owner_db
+    global namespace_index
     if handle is None:
         return False
     
     print(f"[IO] Writing file of size {frame_size}")
 
     try:
-        if not receive_network_file(handle.path, socket, frame_size):
-            try:
-                os.remove(handle.path)
-            except: # We dont really care, its just to make sure the old file isn't kept.
-                pass
-
-            return False
+        digest = hashlib.sha256()
+        # Published without replacing, so a file put at the path some other way (ex. by a move) while this was received is kept
+        if not receive_network_file(handle.path, socket, frame_size, digest=digest, staging=staging_path, sync=upload_sync, publish=rename_no_replace):
+            return False # Nothing was written to the path, so there is nothing to clean up
 
-        file_owner_db.set_file_owner(handle.path, handle.owner)
+        info = os.stat(handle.path)
+        with tracer.span("set owner", "db"):
+            file_owner_db.set_file_owner(handle.path, handle.owner, size=info.st_size, content_hash=digest.hexdigest(), mtime=info.st_mtime)
         return True
     except:
         return False
+    finally:
+        handle.release() # The file's real size is counted now, if it was written
+        namespace_index.refresh(handle.path)
 
-def ExtractFileContents(path: Path, curr_user: Credentials) -> list[bytes] | HTTPErrorBasis:
+def ExtractFileContents(path: Path, curr_user: Credentials, ranges: list[tuple[int, int | None]] | None = None) -> list[bytes] | list[memoryview] | MappedFrames | HTTPErrorBasis:
+    """
+    Gets the contents of the file, split up for the network. If ranges are given, only those bytes are sent, as a MappedFrames holding the ranges that were actually served.
+    """
     if path is None or not path.exists():
         return NotFoundError()
     elif not is_path_valid(path):
@@ -63,11 +118,24 @@ def ExtractFileContents(path: Path, curr_user: Credentials) -> list[bytes] | HTT
     elif curr_user is None:
         return UnauthorizedError()
     
-    if file_owner_db.get_file_owner(path) is None:
-            file_owner_db.set_file_owner(path, curr_user)
+    with tracer.span("get owner", "db"):
+        owner = file_owner_db.get_file_owner(path)
+    if owner is None:
+        with tracer.span("claim owner", "db"):
+            file_owner_db.claim_file_owner(path, curr_user, size=os.path.getsize(path))
+        namespace_index.refresh(path, changed=True) # The owner shown in the listing changed
     
+    if ranges is not None and len(ranges) > max_download_ranges:
+        return RangeNotSatisfiableError(f"At most {max_download_ranges} ranges can be asked for")
+
     try:
-        result = read_file_for_network(path)
+        if ranges is not None:
+            resolved = resolve_ranges(ranges, os.path.getsize(path))
+            if resolved is None:
+                return RangeNotSatisfiableError("None of the ranges are in the file")
+            return MappedFrames(path, resolved)
+
+        result = read_cache.read(path)
         if result is None:
             return ConflictError("Could not read file")
         else:
@@ -91,6 +159,8 @@ def DeleteFile(path: Path, curr_user: Credentials) -> None | HTTPErrorBasis:
     
     try:
         os.remove(path)
+        file_owner_db.remove_file(path)
+        namespace_index.refresh(path)
     except PermissionError:
         return UnauthorizedError("Permission denied")
     except Exception:
@@ -108,6 +178,7 @@ def ModifySubdirectories(path: Path, action: SubfolderAction) -> None | HTTPErro
                 return ConflictError("Path does exist, but attempted to create it")
             
             os.makedirs(path, exist_ok=True)
+            namespace_index.refresh(path)
 
         case SubfolderAction.Delete:
             if not path.exists():
@@ -117,8 +188,128 @@ def ModifySubdirectories(path: Path, action: SubfolderAction) -> None | HTTPErro
                 if len(os.listdir(path)) > 0:
                     return ConflictError("Directory is not empty")
                 os.rmdir(path)
+                namespace_index.refresh(path)
             except PermissionError:
                 return ConflictError("Permission denied")
             except OSError as e:
                 return ConflictError(str(e))                
                 
+
+def RelocatePath(source: Path, destination: Path, action: RelocateAction, curr_user: Credentials) -> None | HTTPErrorBasis:
+    """
+    Moves or copies the file or directory at source to destination, without its contents leaving the server. This returns None if it was successful. Otherwise, an error is returned.
+    """
+    if source is None or destination is None or not os.path.lexists(source):
+        return NotFoundError()
+    elif curr_user is None:
+        return UnauthorizedError()
+    elif not is_path_valid(source) or not is_path_valid(destination) or source == root_directory or destination == root_directory:
+        return ForbiddenError()
+    elif os.path.lexists(destination): # Only to fail early; the rename itself never replaces anything
+        return ConflictError("The destination already exists")
+    elif destination.is_relative_to(source):
+        return ConflictError("A directory cannot be put inside of itself")
+
+    created = []
+    try:
+        with tracer.span("mkdir", "disk"):
+            created = make_parents(destination)
+
+        match action:
+            case RelocateAction.Move:
+                result = MovePath(source, destination, curr_user)
+            case RelocateAction.Copy:
+                result = CopyPath(source, destination, curr_user)
+    except FileExistsError: # Made after the check above
+        result = ConflictError("The destination already exists")
+    except PermissionError:
+        result = UnauthorizedError("Permission denied")
+    except OSError as e: # Ex. the destination is on another file system
+        result = ConflictError(str(e))
+
+    if result is not None:
+        remove_parents(created)
+    return result
+
+def MovePath(source: Path, destination: Path, curr_user: Credentials) -> None | HTTPErrorBasis:
+    """
+    Renames source to destination, in one step, along with the owner records of everything it holds. The user must own every file moved, as moving it away is as good as deleting it.
+    """
+    if source.is_dir() and not source.is_symlink():
+        for directory, _, files in os.walk(source):
+            if not all(is_file_owner(Path(directory) / name, curr_user) for name in files):
+                return UnauthorizedError("Only directories holding only your files can be moved")
+    elif not is_file_owner(source, curr_user):
+        return UnauthorizedError()
+
+    with tracer.span("rename", "disk"):
+        rename_no_replace(source, destination)
+    with tracer.span("move owners", "db"):
+        file_owner_db.move_files(source, destination)
+
+    namespace_index.refresh(source)
+    namespace_index.refresh(destination)
+
+def CopyPath(source: Path, destination: Path, curr_user: Credentials) -> None | HTTPErrorBasis:
+    """
+    Copies source to destination (see copy_file), owned by the user, and counted against their quota. The copy is made in the staging directory and moved into place once done, so it is never seen half made.
+    """
+    if source.is_symlink():
+        return ForbiddenError("Links cannot be copied")
+
+    is_dir = source.is_dir()
+    if is_dir:
+        files = [Path(directory).relative_to(source) / name for directory, _, names in os.walk(source) for name in names if not os.path.islink(os.path.join(directory, name))]
+    else:
+        files = [Path()] # So that source / name is the file itself
+    total = sum(os.path.getsize(source / name) for name in files)
+    if not file_owner_db.reserve(curr_user.getUsername(), total):
+        return InsufficientStorageError("The copy would put you over your storage quota")
+
+    staging = Path(tempfile.mkdtemp(prefix=".copy-", dir=staging_path))
+    try:
+        staged = staging / destination.name
+        with tracer.span("copy", "disk", bytes=total):
+            if is_dir:
+                files = copy_tree(source, staged)
+            else:
+                copy_file(source, staged)
+            rename_no_replace(staged, destination)
+
+        # The copies have the same contents, so the hashes of the originals still hold, if they are current
+        keys = [make_relative(source / name).as_posix() for name in files]
+        hashes = file_owner_db.file_hashes(keys)
+        owners = []
+        for name, key in zip(files, keys):
+            original, info = os.stat(source / name), os.stat(destination / name)
+            owners.append((destination / name, info.st_size, known_hash(hashes.get(key), original.st_size, original.st_mtime), info.st_mtime))
+
+        with tracer.span("set owners", "db"):
+            file_owner_db.set_file_owners(owners, curr_user)
+    finally:
+        file_owner_db.release(curr_user.getUsername(), total)
+        shutil.rmtree(staging, ignore_errors=True)
+
+    namespace_index.refresh(destination)
+
+def SearchFiles(path: Path, request: SearchMessage) -> tuple[list[bytes], str | None] | HTTPErrorBasis:
+    """
+    Searches the files below path, and returns the page of results split up for the network, along with the cursor of the next page.
+    """
+    global namespace_index
+
+    if path is None or request is None:
+        return NotFoundError()
+    if not is_path_valid(path):
+        return ForbiddenError()
+
+    try:
+        result = namespace_index.search(path, request.query(), request.match(), request.kind(), request.min_size(), request.max_size(), request.owner(), request.page_size(), request.cursor())
+    except ValueError as e:
+        return ConflictError(str(e))
+
+    if result is None:
+        return ServiceUnavailableError("The search index is still being built")
+
+    results, cursor = result
+    return split_binary_for_network(json.dumps(results).encode()), cursor
@@ -1,10 +1,14 @@
 from pathlib import Path
+import shutil
 
 host_directory = (Path.home() / "cnt").resolve()
 root_directory = host_directory / "data"
-user_database_loc = host_directory / "files.json"
-file_owner_db_path = host_directory / "files.json"
-network_analyzer_path = host_directory / "stats.json"
+user_database_loc = host_directory / "users.json"
+legacy_user_database_loc = host_directory / "files.json" # Where older versions of the server kept users, along with the owners of files
+file_owner_db_path = host_directory / "files.db"
+network_analyzer_path = host_directory / "stats" # A directory of log segments
+trace_path = host_directory / "trace.json"
+staging_path = host_directory / "staging" # Uploads being received, outside of the root but on the same file system
 
 def ensure_directories() -> bool:
     global root_directory
@@ -22,9 +26,24 @@ def ensure_directories() -> bool:
             if not file_owner_db_path.exists():
                 file_owner_db_path.touch(exist_ok=True)
 
-            if not network_analyzer_path.exists():
-                network_analyzer_path.touch(exist_ok=True)
-  
-        return True
-    except:
-        return False
\ No newline at end of file
+        network_analyzer_path.mkdir(exist_ok=True)
+        staging_path.mkdir(exist_ok=True)
+    except OSError as e:
+        print(f"[IO] Could not make the server's directories: {str(e)}")
+        return False
+
+    clear_staging()
+    return True
+
+def clear_staging():
+    """
+    Removes the uploads (files) and copies (directories) cut off when the server last stopped. Anything that cannot be removed is only reported, as it does not stop the server from working.
+    """
+    for leftover in staging_path.iterdir():
+        try:
+            if leftover.is_dir() and not leftover.is_symlink():
+                shutil.rmtree(leftover)
+            else:
+                leftover.unlink(missing_ok=True)
+        except OSError as e:
+            print(f"[IO] Could not remove {leftover.name} from the staging directory: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,210 @@
+from pathlib import Path
+import threading
+import json
+import time
+import os
+
+from .journal import write_snapshot
+
+class StatsLog:
+    """
+    An append only log of transfer records, kept as a directory of JSON lines segments. Records are queued by append, and written by a background thread every flush_interval seconds, in one write per batch, so recording a transfer never waits on the disk, and a crash loses at most the last batch.
+    A segment is closed once it grows past segment_bytes, and a new one started. Closed segments older than rollup_after seconds are compacted: their records are summed per hour, IP, user, and operation into a rollup file, and the segment is deleted. So the log only holds the raw records of recent transfers, no matter how long the server runs.
+    """
+
+    segment_prefix = "segment-"
+    rollup_prefix = "rollup-"
+
+    def __init__(self, directory: Path, segment_bytes: int = 1 << 20, flush_interval: float = 1.0, rollup_after: float = 24 * 60 * 60):
+        if directory is None:
+            raise ValueError("Directory must not be none")
+
+        self.__directory = directory
+        self.__segment_bytes = segment_bytes
+        self.__flush_interval = flush_interval
+        self.__rollup_after = rollup_after
+
+        self.__lock = threading.Lock() # Guards the pending records
+        self.__write_lock = threading.Lock() # Guards the segment being written
+        self.__pending: list[dict] = []
+        self.__file = None
+        self.__index = 0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def directory(self) -> Path:
+        return self.__directory
+
+    def open(self, since: float) -> list[dict]:
+        """
+        Starts a new segment, and the background writer. Returns the records written since the time given (in seconds since the epoch); only the segments written to since then are read.
+        """
+        if self.__thread is not None:
+            raise RuntimeError("The log is already open")
+
+        self.__directory.mkdir(parents=True, exist_ok=True)
+        segments = self.__segments()
+        self.__index = segments[-1][0] + 1 if len(segments) != 0 else 0
+
+        records = []
+        for _, path in reversed(segments):
+            try:
+                if path.stat().st_mtime < since:
+                    break # Every older segment was last written to before this one
+            except FileNotFoundError:
+                continue
+
+            records.extend(record for record in StatsLog.__read(path) if record.get("time", 0) >= since)
+
+        self.__file = open(self.__segment_path(self.__index), "ab")
+        self.compact()
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name="stats-log")
+        self.__thread.start()
+        return records
+
+    def append(self, record: dict):
+        """
+        Queues a record to be written by the background writer
+        """
+        with self.__lock:
+            self.__pending.append(record)
+
+    def flush(self):
+        """
+        Writes every queued record to the current segment, and syncs it to disk
+        """
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = []
+
+        with self.__write_lock:
+            if len(pending) == 0 or self.__file is None:
+                return
+
+            self.__file.write(b"".join(json.dumps(record, separators=(",", ":")).encode() + b"\n" for record in pending))
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+
+            if self.__file.tell() >= self.__segment_bytes:
+                self.__file.close()
+                self.__index += 1
+                self.__file = open(self.__segment_path(self.__index), "ab")
+
+    def compact(self, now: float | None = None):
+        """
+        Rolls up every closed segment last written to more than rollup_after seconds ago
+        """
+        cutoff = (time.time() if now is None else now) - self.__rollup_after
+        with self.__write_lock:
+            current = self.__index
+
+        for index, path in self.__segments():
+            if index >= current:
+                break
+
+            try:
+                if path.stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            rollup_path = self.__directory / f"{StatsLog.rollup_prefix}{index:08d}.json"
+            if not rollup_path.exists(): # Otherwise, the segment was rolled up before a crash, but not deleted
+                records = StatsLog.__read(path)
+                if len(records) != 0:
+                    write_snapshot(rollup_path, StatsLog.roll_up(records))
+            path.unlink(missing_ok=True)
+
+    def roll_up(records: list[dict]) -> list[dict]:
+        """
+        Sums the records per hour, IP, user, and operation
+        """
+        rollups = {}
+        for record in records:
+            hour = int(record.get("time", 0) // 3600 * 3600)
+            key = (hour, record.get("ip"), record.get("user"), record.get("operation"))
+
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = { "hour": hour, "ip": key[1], "user": key[2], "operation": key[3], "count": 0, "bytes": 0, "seconds": 0.0, "max_rate": 0.0 }
+                rollups[key] = rollup
+
+            rollup["count"] += 1
+            rollup["bytes"] += record.get("file_size", 0)
+            rollup["seconds"] += record.get("transfer_time", 0.0)
+            rollup["max_rate"] = max(rollup["max_rate"], record.get("data_rate", 0.0))
+
+        return sorted(rollups.values(), key=lambda rollup: rollup["hour"])
+
+    def rollups(self) -> list[dict]:
+        """
+        Returns every rollup, oldest first
+        """
+        result = []
+        for path in sorted(self.__directory.glob(f"{StatsLog.rollup_prefix}*.json")):
+            try:
+                with open(path, "r") as f:
+                    result.extend(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                continue
+
+        result.sort(key=lambda rollup: rollup["hour"])
+        return result
+
+    def close(self):
+        """
+        Stops the background writer, and writes anything still queued
+        """
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+
+        self.flush()
+        with self.__write_lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def __run(self):
+        last_compact = time.monotonic()
+        while not self.__stop.wait(self.__flush_interval):
+            try:
+                self.flush()
+                if time.monotonic() - last_compact >= 60:
+                    self.compact()
+                    last_compact = time.monotonic()
+            except OSError as e:
+                print(f"[STATS] Could not write the stats log: {str(e)}")
+
+    def __segments(self) -> list[tuple[int, Path]]:
+        segments = []
+        for path in self.__directory.glob(f"{StatsLog.segment_prefix}*.jsonl"):
+            try:
+                segments.append((int(path.stem[len(StatsLog.segment_prefix):]), path))
+            except ValueError:
+                continue
+
+        segments.sort()
+        return segments
+    def __segment_path(self, index: int) -> Path:
+        return self.__directory / f"{StatsLog.segment_prefix}{index:08d}.jsonl"
+
+    def __read(path: Path) -> list[dict]:
+        """
+        Reads the records of a segment. Lines that cannot be read (such as one cut short by a crash) are skipped.
+        """
+        records = []
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            pass
+
+        return records
@@ -1,8 +1,14 @@
 import Server.pool as pool
-from Server.server_paths import ensure_directories, file_owner_db_path, user_database_loc, network_analyzer_path
+from Server.server_paths import ensure_directories, root_directory, file_owner_db_path, user_database_loc, legacy_user_database_loc, network_analyzer_path, trace_path
 from Server.io_tools import file_owner_db, FileOwnerDB
 from Server.credentials import user_database, UserDatabase
 from Server.network_analysis import network_analyzer
+from Server.namespace_index import namespace_index
+from Server.metrics import server_metrics
+from Server.handler_timing import handler_timings
+from Common.tracing import tracer
+from Common.file_io import SyncPolicy
+import Server.server_io as server_io
 
 import socket
 
@@ -14,9 +20,11 @@ else:
     print("Root directory established/already exists")
 
 threadPool = pool.ThreadPool()
-user_database.open(user_database_loc)
-file_owner_db.open(file_owner_db_path)
+user_database.open(user_database_loc, legacy_user_database_loc)
+quota_mb = int(input("Default storage quota per user, in MB? (0 for none)"))
+file_owner_db.open(file_owner_db_path, quota_mb * 1024 * 1024 if quota_mb > 0 else None, legacy_user_database_loc)
 network_analyzer.open(network_analyzer_path)
+namespace_index.start(root_directory)
 
 hostname = socket.gethostname()
 ip = socket.gethostbyname(hostname)
@@ -27,10 +35,22 @@ if port_raw == 0:
 else:
     port = port_raw
 
+sync_raw = input("Sync uploads to disk? (none, end, periodic; blank for end)").strip().lower()
+server_io.upload_sync = SyncPolicy(sync_raw) if sync_raw else SyncPolicy.End
+
+metrics_port = int(input("Metrics port? (0 for none)"))
+trace_rate = float(input("Share of requests to trace, from 0 to 1? (0 for none)"))
+if trace_rate > 0:
+    tracer.open(trace_path, trace_rate)
+    print(f"Writing traces to {trace_path}")
+
 print(f"Setting up thread pool, binding on port {port} with IP {ip}")
 try:
     threadPool.bind(port, ip)
     threadPool.listen()
+    if metrics_port != 0:
+        server_metrics.start(metrics_port, threadPool, root_directory)
+        handler_timings.enable()
     print("Entering main loop...\n")
     threadPool.mainLoop()
 except KeyboardInterrupt:
@@ -41,9 +61,12 @@ except Exception as e:
     print(f"[CONTROL] Unknown exception caught: {str(e)}")
 finally:
     print(f"[CONTROL] Terminating thread pool")
+    server_metrics.stop()
+    tracer.close()
     threadPool.kill()
+    namespace_index.stop()
     
 user_database.save()
-file_owner_db.save()
+file_owner_db.close()
 network_analyzer.save()
 print("Goodbye!")
\ No newline at end of file
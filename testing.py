@@ -1,6 +1,7 @@
 from Common.message_handler import *
 from Common.file_io import DirectoryInfo, FileInfo, FileType, read_file_for_network, receive_network_file, receive_network_file_binary
 import socket
+import os
 
 def print_dir_structure(dir: DirectoryInfo, ts = ''):
     if dir is None:
@@ -9,7 +10,7 @@ def print_dir_structure(dir: DirectoryInfo, ts = ''):
     print(f"{ts}{dir.name()} (d)")
     for item in dir.contents():
         if isinstance(item, FileInfo):
-            print(f"{ts+'\t'}{item.name()} (f)")
+            print(f"{ts}\t{item.name()} (f)")
         else:
             print_dir_structure(item, ts + '\t')
 
@@ -163,7 +164,10 @@ def messages_tester() -> bool:
         (DirMessage(), True),
         (DirMessage(200, "OK", DirectoryInfo()), False),
         (MoveMessage("file"), True),
-        (SubfolderMessage("directory", SubfolderAction.Add), True)
+        (SubfolderMessage("directory", SubfolderAction.Add), True),
+        (RelocateMessage("file", "directory/file", RelocateAction.Copy), True),
+        (PingMessage(12.5, 3.25, 0.5), True),
+        (PingMessage(12.5, server_time=3.25, processing=0.001), False)
     ]
 
     try:
@@ -201,6 +205,947 @@ def dir_resp_test() -> bool:
     assert root == decoded
     print("\nSucessfully decoded")
 
+def walker_benchmark(entry_count: int = 100_000, threads: int = 4):
+    """
+    Builds a synthetic tree of entry_count files (100 per directory, 10 subdirectories per directory), and times listing it with a recursive os.listdir walk against the os.scandir walker, both on one thread & fanned out over a thread pool.
+    """
+    import os
+    import tempfile
+    import time
+    import shutil
+    from Server.io_tools import walk_directory, contents_to_list, set_walker_threads
+
+    def listdir_walk(path: Path) -> int:
+        # The walk the server used before the scandir walker, for comparison
+        count = 0
+        for entry in os.listdir(path):
+            full_path = (path / entry).resolve()
+            if full_path.is_dir():
+                count += listdir_walk(full_path)
+            elif full_path.is_file():
+                os.path.getsize(full_path)
+                count += 1
+        return count
+
+    def count_files(contents) -> int:
+        count = 0
+        stack = [contents]
+        while len(stack) != 0:
+            for item in stack.pop():
+                if isinstance(item, DirectoryInfo):
+                    stack.append(item.contents())
+                else:
+                    count += 1
+        return count
+
+    base = Path(tempfile.mkdtemp())
+    try:
+        print(f"Building tree of {entry_count} files in {base}...")
+        for i in range(entry_count):
+            directory = base / f"d{i // 10000}" / f"s{(i // 1000) % 10}" / f"t{(i // 100) % 10}"
+            if i % 100 == 0:
+                directory.mkdir(parents=True, exist_ok=True)
+            (directory / f"f{i}.txt").touch()
+
+        start = time.perf_counter()
+        found = listdir_walk(base)
+        print(f"listdir (recursive): {found} files in {time.perf_counter() - start:.3f}s")
+
+        start = time.perf_counter()
+        found = count_files(walk_directory(base))
+        print(f"scandir (1 thread):  {found} files in {time.perf_counter() - start:.3f}s")
+
+        set_walker_threads(threads)
+        start = time.perf_counter()
+        found = count_files(contents_to_list(base))
+        print(f"scandir ({threads} threads): {found} files in {time.perf_counter() - start:.3f}s")
+        set_walker_threads(0)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+def dir_cache_test() -> bool:
+    """
+    Checks that the directory cache keeps to its byte budget, and that the pages after the first of a paged listing are not cached.
+    """
+    import tempfile
+    from pathlib import Path
+    import Server.io_tools as io_tools
+    from Server.dir_cache import DirectoryCache, directory_cache, get_directory_listing
+
+    cache = DirectoryCache(max_entries=100, max_bytes=10_000, max_response_bytes=4000)
+    for i in range(20):
+        cache.put(Path(f"/dir/{i}"), f"listing {i}", cache.generation(), size=3000)
+    cache.put(Path("/dir/large"), "large listing", cache.generation(), size=5000)
+    if cache.cached_bytes() > 10_000 or cache.get(Path("/dir/19")) != "listing 19" or cache.get(Path("/dir/0")) is not None or cache.get(Path("/dir/large")) is not None:
+        print(f"The cache holds {cache.cached_bytes()} bytes, or kept the wrong listings")
+        return False
+
+    saved = io_tools.root_directory
+    with tempfile.TemporaryDirectory() as directory:
+        base = Path(directory).resolve()
+        for i in range(50):
+            (base / f"{i:02}.txt").write_text("x")
+        io_tools.root_directory = base
+        directory_cache.clear()
+        try:
+            first = get_directory_listing(base, DirMessage(depth=1, page_size=10))
+            cached = directory_cache.cached_bytes()
+            cursor, pages = first.cursor, 1
+            while cursor is not None:
+                cursor = get_directory_listing(base, DirMessage(depth=1, page_size=10, cursor=cursor)).cursor
+                pages += 1
+
+            if pages != 5 or cached == 0 or directory_cache.cached_bytes() != cached or get_directory_listing(base, DirMessage(depth=1, page_size=10)) is not first:
+                print(f"Only the first page should be cached: {pages} pages, {cached} then {directory_cache.cached_bytes()} bytes")
+                return False
+        finally:
+            io_tools.root_directory = saved
+            directory_cache.clear()
+
+    return True
+
+def search_benchmark(file_count: int = 1_000_000, queries: int = 100):
+    """
+    Fills a search index with file_count synthetic names (without touching the disk), and times prefix & substring lookups of one page against it, along with the cost of keeping it up to date.
+    """
+    import random
+    import time
+    from Server.namespace_index import IndexNode
+    from Server.search_index import SearchIndex
+
+    words = ["report", "holiday", "invoice", "song", "clip", "notes", "draft", "final", "scan", "photo"]
+    suffixes = [".txt", ".mp4", ".mp3", ".pdf", ".mkv"]
+    random.seed(0)
+
+    root = IndexNode("", None, True)
+    index = SearchIndex()
+    start = time.perf_counter()
+    for i in range(file_count):
+        if i % 1000 == 0:
+            directory = IndexNode(f"d{i // 1000}", root, True)
+            root.children[directory.name] = directory
+        name = f"{random.choice(words)}_{random.choice(words)}_{i}{random.choice(suffixes)}"
+        node = IndexNode(name, directory, False, i)
+        directory.children[name] = node
+        index.add(node)
+    print(f"Indexed {len(index)} names in {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    index.prepare()
+    print(f"Prepared the search data in {time.perf_counter() - start:.3f}s")
+
+    def first_page(lookup, query: str) -> int:
+        found = 0
+        for _ in lookup(query):
+            found += 1
+            if found == 100:
+                break
+        return found
+
+    for label, lookup in [("prefix", index.prefix_names), ("substring", index.substring_names)]:
+        start = time.perf_counter()
+        for _ in range(queries):
+            query = random.choice(words) + "_" + random.choice(words)[:3]
+            first_page(lookup, query if label == "prefix" else query[2:])
+        print(f"{label}: {(time.perf_counter() - start) * 1000 / queries:.3f}ms per page of 100")
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        first_page(index.substring_names, f"_{random.randrange(file_count)}.")
+    print(f"substring (rare): {(time.perf_counter() - start) * 1000 / queries:.3f}ms per query")
+
+    # Every change dirties one chunk, so a search right after a change rebuilds just that chunk
+    start = time.perf_counter()
+    for i in range(queries):
+        node = IndexNode(f"new_{random.choice(words)}_{i}.txt", directory, False)
+        directory.children[node.name] = node
+        index.add(node)
+        first_page(index.substring_names, f"_{random.randrange(file_count)}.")
+    print(f"add, then substring (rare): {(time.perf_counter() - start) * 1000 / queries:.3f}ms per query")
+
+def search_test() -> bool:
+    """
+    Searches a small tree with every kind of match and filter, from the root and from a subdirectory, a page at a time, and checks the results against going through every file. This is done again with a tiny scan limit, so the pages cut short by it are followed as well.
+    """
+    import tempfile
+    from pathlib import Path
+    import Server.io_tools as io_tools
+    from Server.io_tools import file_owner_db
+    from Server.namespace_index import NamespaceIndex
+    from Server.credentials import Credentials
+    from Common.file_io import get_file_type
+
+    names = ["Song.mp3", "song_live.mp3", "notes.txt", "My Song.mp4", "songbook.txt", "clip.mkv", "SONG.mp3"]
+    owners = [Credentials("tester", ""), Credentials("other", "")]
+    saved = io_tools.root_directory, NamespaceIndex.search_scan_limit
+    with tempfile.TemporaryDirectory() as directory:
+        base = Path(directory).resolve() / "data"
+        io_tools.root_directory = base
+        file_owner_db.open(Path(directory) / "files.db")
+        index = NamespaceIndex()
+        try:
+            files = []
+            for i, folder in enumerate(["", "music", "music/live", "docs", "docs/old/deep"]):
+                (base / folder).mkdir(parents=True, exist_ok=True)
+                for j, name in enumerate(names):
+                    relative = f"{folder}/{name}" if folder != "" else name
+                    (base / relative).write_bytes(bytes(100 * (i + j)))
+                    if (i + j) % 3 != 0:
+                        file_owner_db.set_file_owner(base / relative, owners[(i + j) % 2], size=100 * (i + j))
+                    files.append(relative)
+
+            index.start(base, use_inotify=False)
+            if not index.wait_ready(10.0):
+                print("The index was not built")
+                return False
+
+            def expected(scope: str, query: str, match: SearchMatch, kind, min_size, max_size, owner) -> list[str]:
+                prefix = scope + "/" if scope != "" else ""
+                found = []
+                for relative in files:
+                    name = relative.rsplit("/", 1)[-1].lower()
+                    size = (base / relative).stat().st_size
+                    if not relative.startswith(prefix) or not (name.startswith(query.lower()) if match == SearchMatch.Prefix else query.lower() in name):
+                        continue
+                    if (kind is not None and get_file_type(Path(name)) != kind) or (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+                        continue
+                    if owner is not None and file_owner_db.get_file_owner(relative, is_absolute=False) != owner:
+                        continue
+                    found.append((name, relative))
+                return [relative[len(prefix):] for _, relative in sorted(found)]
+
+            cases = [
+                ("", "song", SearchMatch.Prefix, None, None, None, None),
+                ("", "song", SearchMatch.Substring, None, None, None, None),
+                ("", "", SearchMatch.Substring, FileType.Audio, None, None, None),
+                ("", "", SearchMatch.Substring, None, None, None, "tester"),
+                ("", "o", SearchMatch.Substring, None, 300, 900, "other"),
+                ("music", "song", SearchMatch.Substring, None, None, None, None),
+                ("music", "", SearchMatch.Prefix, FileType.Text, None, None, None),
+                ("docs/old", "s", SearchMatch.Prefix, None, None, 1000, None),
+                ("docs", "", SearchMatch.Substring, None, None, None, "other"),
+            ]
+            for limit in [saved[1], 4]:
+                NamespaceIndex.search_scan_limit = limit
+                for scope, query, match, kind, min_size, max_size, owner in cases:
+                    found, cursor, pages = [], None, 0
+                    while pages == 0 or cursor is not None:
+                        results, cursor = index.search(base / scope, query, match, kind, min_size, max_size, owner, page_size=3, cursor=cursor)
+                        found.extend(result["path"] for result in results)
+                        pages += 1
+                        if pages > 100:
+                            break
+
+                    if found != expected(scope, query, match, kind, min_size, max_size, owner):
+                        print(f"Search of '{scope}' for '{query}' ({match.value}, {kind}, {min_size}-{max_size}, {owner}) with a scan limit of {limit} found {found}")
+                        return False
+        finally:
+            index.stop()
+            io_tools.root_directory, NamespaceIndex.search_scan_limit = saved
+            file_owner_db.close()
+
+    return True
+
+def listing_encoding_benchmark(entry_count: int = 100_000):
+    """
+    Compares the size of a synthetic Dir listing of entry_count files in the tree & compact encodings, and how long each takes to parse back into a DirectoryInfo.
+    """
+    import json
+    import time
+
+    root = DirectoryInfo("root")
+    for i in range(entry_count):
+        if i % 1000 == 0:
+            directory = DirectoryInfo(f"d{i // 1000}", parent=root)
+            root.add_content(directory)
+        directory.add_content(FileInfo(f"file_{i}.txt", f"user{i % 10}", FileType.Text, i, directory, 1_700_000_000 + i))
+
+    for label, encode, decode in [("tree", DirectoryInfo.to_dict, DirectoryInfo.from_dict), ("compact", DirectoryInfo.to_compact, DirectoryInfo.from_compact)]:
+        payload = json.dumps(encode(root), separators=(",", ":")).encode()
+
+        start = time.perf_counter()
+        decode(json.loads(payload))
+        print(f"{label}: {len(payload) / 1024:.0f}KB, parsed in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+def tree_model_benchmark(node_count: int = 1_000_000):
+    """
+    Builds a synthetic tree of node_count files (1000 per directory), and reports the memory it takes, how long encoding & decoding it take, and how long finding the path of every file takes (the first time, and then from the cache).
+    """
+    import json
+    import time
+    import tracemalloc
+
+    def build() -> DirectoryInfo:
+        root = DirectoryInfo("root")
+        for i in range(node_count):
+            if i % 1000 == 0:
+                directory = DirectoryInfo(f"d{i // 1000}", parent=root)
+                root.add_content(directory)
+            directory.add_content(FileInfo(f"file_{i}.txt", f"user{i % 10}", FileType.Text, i, directory, 1_700_000_000 + i))
+        return root
+
+    start = time.perf_counter()
+    build()
+    print(f"Built {node_count} files in {time.perf_counter() - start:.2f}s")
+
+    tracemalloc.start()
+    root = build()
+    print(f"Memory: {tracemalloc.get_traced_memory()[0] / 1024 / 1024:.0f}MB")
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    encoded = root.to_dict()
+    print(f"to_dict: {time.perf_counter() - start:.2f}s")
+
+    decoded = json.loads(json.dumps(encoded))
+    start = time.perf_counter()
+    tree = DirectoryInfo.from_dict(decoded)
+    print(f"from_dict: {time.perf_counter() - start:.2f}s")
+
+    files = [item for directory in tree.contents() for item in directory.contents()]
+    for label in ["first", "cached"]:
+        start = time.perf_counter()
+        for item in files:
+            item.target_path_relative()
+        print(f"Paths ({label}): {time.perf_counter() - start:.2f}s")
+
+def network_stats_benchmark(transfer_count: int = 1_000_000, ip_count: int = 1000):
+    """
+    Records transfer_count transfers spread over ip_count IPs, and reports how long recording and looking up the last stats take, and how many records are kept.
+    """
+    import time
+    from Server.network_analysis import NetworkAnalyzer, StatMetric
+
+    analyzer = NetworkAnalyzer()
+    start = time.perf_counter()
+    for i in range(transfer_count):
+        ip = i % ip_count
+        analyzer.record_transfer(4096, 0.0, 0.01, f"10.0.{ip // 256}.{ip % 256}", f"user{i % 100}")
+    print(f"Recorded {transfer_count} transfers in {time.perf_counter() - start:.2f}s")
+
+    kept = sum(len(analyzer.get_ip_stats(f"10.0.{i // 256}.{i % 256}")) for i in range(ip_count))
+    print(f"Records kept: {kept}")
+
+    start = time.perf_counter()
+    for i in range(100_000):
+        ip = i % ip_count
+        analyzer.get_last_ip_stats(f"10.0.{ip // 256}.{ip % 256}")
+    print(f"Last stats lookup: {(time.perf_counter() - start) * 10:.2f}us")
+
+    start = time.perf_counter()
+    for i in range(transfer_count):
+        analyzer.record_latency("dir", 0.001 * (1 + i % 1000), f"user{i % 100}")
+    print(f"Recorded {transfer_count} latencies in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    summary = analyzer.percentiles(StatMetric.Latency, "dir")
+    print(f"Percentiles in {(time.perf_counter() - start) * 1000:.2f}ms: {summary}")
+
+def metrics_scrape_test() -> bool:
+    """
+    Starts the metrics listener on a free port, records some activity, and checks that a scrape returns it in the Prometheus text format.
+    """
+    import tempfile
+    import urllib.request
+    from pathlib import Path
+    from Server.metrics import server_metrics
+    from Server.network_analysis import network_analyzer
+
+    port = server_metrics.start(0, root=Path(tempfile.gettempdir()))
+    try:
+        server_metrics.count_bytes(received=100, sent=250)
+        server_metrics.note_status(200)
+        server_metrics.count_request(MessageType.Dir.value)
+        network_analyzer.record_latency(MessageType.Dir.value, 0.01)
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            if response.status != 200:
+                print(f"Scrape failed with {response.status}")
+                return False
+            text = response.read().decode()
+
+        samples = {}
+        for line in text.splitlines():
+            if line.startswith("#") or len(line) == 0:
+                continue
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+        expected = [
+            "cnt_bytes_received_total",
+            "cnt_bytes_sent_total",
+            'cnt_requests_total{type="dir",code="200"}',
+            'cnt_request_latency_seconds{operation="dir",quantile="0.99"}',
+            "cnt_dir_cache_hit_ratio",
+            "cnt_disk_free_bytes"
+        ]
+        for name in expected:
+            if name not in samples:
+                print(f"Scrape is missing {name}")
+                return False
+
+        if samples["cnt_bytes_received_total"] < 100 or samples['cnt_requests_total{type="dir",code="200"}'] < 1:
+            print("Scrape has the wrong values")
+            return False
+
+        print(f"Scraped {len(samples)} samples")
+        return True
+    finally:
+        server_metrics.stop()
+
+def stats_log_test() -> bool:
+    """
+    Records transfers without closing the NetworkAnalyzer (as in a crash), and checks that they are read back once the background writer has run. Also reports how long recording takes.
+    """
+    import tempfile
+    import time
+    from pathlib import Path
+    from Server.network_analysis import NetworkAnalyzer
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "stats"
+        analyzer = NetworkAnalyzer()
+        analyzer.open(path)
+
+        start = time.perf_counter()
+        for i in range(100_000):
+            analyzer.record_transfer(4096, 0.0, 0.01, f"10.0.0.{i % 100}", f"user{i % 10}", MessageType.Upload.value)
+        print(f"Recorded 100000 transfers in {time.perf_counter() - start:.2f}s")
+
+        time.sleep(1.5) # Let the background writer flush
+
+        reopened = NetworkAnalyzer()
+        reopened.open(path)
+        last = reopened.get_last_ip_stats("10.0.0.99")
+        reopened.save()
+        analyzer.save()
+
+        if last is None or last.user != "user9" or last.operation != MessageType.Upload.value:
+            print(f"Records were not read back, got {last}")
+            return False
+
+        return True
+
+def handler_timing_benchmark(calls: int = 1_000_000):
+    """
+    Reports what the handler timing calls made per socket operation cost when disabled and enabled, and checks that the phases of a timed request add up.
+    """
+    import time
+    from Server.handler_timing import HandlerTimings, Phase
+
+    timings = HandlerTimings()
+    for enabled in [False, True]:
+        timings.enable(enabled)
+        timings.begin()
+        start = time.perf_counter()
+        for _ in range(calls):
+            with timings.phase(Phase.Send):
+                pass
+        print(f"Phase ({'enabled' if enabled else 'disabled'}): {(time.perf_counter() - start) / calls * 1e9:.0f}ns")
+        timings.finish("bench")
+
+    timings.begin(queue=0.001)
+    with timings.phase(Phase.Disk):
+        time.sleep(0.02)
+        with timings.phase(Phase.Send):
+            time.sleep(0.01)
+    timings.finish("check")
+
+    phases = timings.summary()["check"]
+    print({ phase: round(summary["total_seconds"], 3) for phase, summary in phases.items() })
+    return abs(phases["disk"]["total_seconds"] - 0.02) < 0.005 and abs(phases["send"]["total_seconds"] - 0.01) < 0.005
+
+def tracing_test() -> bool:
+    """
+    Traces requests with nested spans into a temporary file, and checks that it reads back as Chrome trace events. Also reports what a span costs when the request is not traced.
+    """
+    import json
+    import tempfile
+    import time
+    from pathlib import Path
+    from Common.tracing import Tracer
+
+    tracer = Tracer(max_events=10)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "trace.json"
+        tracer.open(path, 1.0)
+
+        trace = tracer.start("upload", user="tester")
+        with tracer.span("write", "disk", bytes=4096):
+            with tracer.span("send", "socket"):
+                pass
+        for _ in range(20): # Past max_events, so most are dropped
+            with tracer.span("recv", "socket"):
+                pass
+        tracer.finish(trace)
+        tracer.close()
+
+        with open(path) as f:
+            events = json.loads(f.read().rstrip().rstrip(",") + "]") # The closing bracket is optional in the format
+
+    request = [event for event in events if event["cat"] == "request"]
+    if len(events) != 11 or len(request) != 1 or request[0]["args"]["dropped_spans"] != 12:
+        print(f"Unexpected events: {events}")
+        return False
+    if any(event["args"]["trace_id"] != request[0]["args"]["trace_id"] for event in events):
+        print("Spans were not given the ID of their trace")
+        return False
+
+    start = time.perf_counter()
+    for _ in range(1_000_000):
+        with tracer.span("send", "socket"):
+            pass
+    print(f"Span (not traced): {(time.perf_counter() - start) * 1000:.0f}ns")
+    return True
+
+def user_database_test() -> bool:
+    """
+    Checks that users written to the user database survive reopening it (even with a bad record in the journal), and that the users of an older server's files.json are imported once, when there are none yet.
+    """
+    import json
+    import tempfile
+    from pathlib import Path
+    from Server.credentials import UserDatabase, Credentials
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "users.json"
+        legacy = Path(directory) / "files.json"
+        legacy.write_text(json.dumps({"old": "hash", "music/a.mp3": {"username": "owner", "password": "owner hash"}}))
+        path.touch() # As ensure_directories leaves it
+
+        database = UserDatabase()
+        database.open(path, legacy)
+        if database.get_user("old") != Credentials("old", "hash") or database.get_user("owner") != Credentials("owner", "owner hash"):
+            print("Users were not imported from the legacy file")
+            return False
+
+        database.set_user_pass(Credentials("new", "new hash"))
+        database.set_user_pass(Credentials("old", "changed"))
+        legacy.write_text(json.dumps({"late": "hash"}))
+        database.save()
+
+        database = UserDatabase()
+        database.open(path, legacy)
+        if database.get_user("new") is None or database.get_user("old").getPasswordHash() != "changed" or database.get_user("late") is not None:
+            print("Users were lost on reopening, or imported again")
+            return False
+        database.set_user_pass(Credentials("before", "hash"))
+        database.save() # Folds the journal into the snapshot
+
+        journal = path.with_suffix(".journal")
+        journal.write_bytes(b'{"username":"first","password":"hash"}\n{"user\xff\n{"username":"after","password":"hash"}\n{"username":"torn"')
+        database = UserDatabase()
+        database.open(path, legacy)
+        if database.get_user("before") is None or database.get_user("first") is None or database.get_user("after") is None or database.get_user("torn") is not None:
+            print("A bad record in the journal lost the records around it")
+            return False
+        database.set_user_pass(Credentials("appended", "hash"))
+        if b"torn" in journal.read_bytes() or not journal.read_bytes().endswith(b'\n{"username":"appended","password":"hash"}\n'):
+            print("The torn line was not dropped before appending")
+            return False
+        database.save()
+
+    return True
+
+def quota_test() -> bool:
+    """
+    Checks that usage follows the files a user owns, that reservations past the quota are refused, and that an old database has its usage added up when opened.
+    """
+    import sqlite3
+    import tempfile
+    from pathlib import Path
+    from Server.io_tools import FileOwnerDB
+    from Server.credentials import Credentials
+    from Server.server_paths import root_directory
+
+    user = Credentials("tester", "")
+    other = Credentials("other", "")
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "files.db"
+        db = FileOwnerDB()
+        db.open(path, default_quota=10_000)
+
+        db.set_file_owner(root_directory / "a.txt", user, size=3000)
+        db.set_file_owner(root_directory / "b.txt", user, size=2000)
+        db.set_file_owner(root_directory / "a.txt", user, size=4000) # Replaced, so only its new size counts
+        db.claim_file_owner(root_directory / "c.txt", other, size=500)
+        db.claim_file_owner(root_directory / "c.txt", user, size=500) # Already owned, so not counted
+        if db.usage("tester") != 6000 or db.usage("other") != 500:
+            print(f"Wrong usage: {db.usage('tester')}, {db.usage('other')}")
+            return False
+
+        if not db.reserve("tester", 4000) or db.reserve("tester", 1):
+            print("Reservations were not held to the quota")
+            return False
+        db.release("tester", 4000)
+
+        db.remove_file(root_directory / "b.txt")
+        db.set_quota("other", 100)
+        if db.usage("tester") != 4000 or db.quota("other") != 100 or db.reserve("other", 1):
+            print("Usage or quota was not updated")
+            return False
+        db.close()
+
+        with sqlite3.connect(path) as conn: # As written before usage was tracked
+            conn.execute("DROP TABLE usage")
+        reopened = FileOwnerDB()
+        reopened.open(path)
+        usage = reopened.usage("tester"), reopened.usage("other"), reopened.quota("tester")
+        reopened.close()
+        if usage != (4000, 500, None):
+            print(f"Usage was not added up from the files: {usage}")
+            return False
+
+        return True
+
+def legacy_owners_test() -> bool:
+    """
+    Opens a new files.db next to the files.json of an older server, and checks that the owners (and their usage) are imported once, and not again once the database exists.
+    """
+    import json
+    import tempfile
+    from pathlib import Path
+    import Server.io_tools as io_tools
+    from Server.io_tools import FileOwnerDB
+    from Server.credentials import Credentials
+
+    saved = io_tools.root_directory
+    with tempfile.TemporaryDirectory() as directory:
+        base = Path(directory).resolve() / "data"
+        (base / "music").mkdir(parents=True)
+        (base / "music" / "a.mp3").write_bytes(bytes(3000))
+        io_tools.root_directory = base
+        try:
+            legacy = Path(directory) / "files.json"
+            legacy.write_text(json.dumps({
+                "music/a.mp3": {"username": "tester", "password": "hash"},
+                "gone.txt": {"username": "other", "password": "hash"}
+            }))
+            path = Path(directory) / "files.db"
+            db = FileOwnerDB()
+            db.open(path, legacy_path=legacy)
+            owners = db.get_file_owner(base / "music" / "a.mp3"), db.get_file_owner(base / "gone.txt"), db.usage("tester")
+            db.set_file_owner(base / "music" / "a.mp3", Credentials("new", ""), size=3000)
+            db.close()
+            if owners != ("tester", "other", 3000):
+                print(f"The legacy owners were not imported: {owners}")
+                return False
+
+            reopened = FileOwnerDB()
+            reopened.open(path, legacy_path=legacy)
+            owner = reopened.get_file_owner(base / "music" / "a.mp3")
+            reopened.close()
+            if owner != "new":
+                print("The legacy owners were imported into an existing database")
+                return False
+        finally:
+            io_tools.root_directory = saved
+
+    return True
+
+def atomic_upload_test() -> bool:
+    """
+    Receives a file over a socket pair with each sync policy, and checks that nothing shows up at the path until all of it has arrived, and nothing is left behind when the sender stops partway. Also reports how long each policy takes.
+    """
+    import tempfile
+    import threading
+    import time
+    from pathlib import Path
+    from Common.file_io import split_binary_for_network, SyncPolicy, process_umask
+
+    contents = os.urandom(8 * 1024 * 1024 + 100)
+    frames = split_binary_for_network(contents)
+    with tempfile.TemporaryDirectory() as directory:
+        staging = Path(directory) / "staging"
+        staging.mkdir()
+        for policy in SyncPolicy:
+            path = Path(directory) / f"{policy.value}.bin"
+            receiver, sender = socket.socketpair()
+            seen_early = []
+            def send():
+                for i, frame in enumerate(frames):
+                    sender.sendall(frame)
+                    if i == len(frames) // 2:
+                        seen_early.append(path.exists())
+
+            thread = threading.Thread(target=send)
+            start = time.perf_counter()
+            thread.start()
+            received = receive_network_file(path, receiver, len(frames), staging=staging, sync=policy)
+            thread.join()
+            print(f"Received with sync {policy.value}: {time.perf_counter() - start:.3f}s")
+            receiver.close()
+            sender.close()
+
+            if not received or any(seen_early) or path.read_bytes() != contents:
+                print(f"The file was not published whole with sync {policy.value}")
+                return False
+            if os.name != "nt" and path.stat().st_mode & 0o777 != 0o666 & ~process_umask:
+                print(f"The file was published with mode {oct(path.stat().st_mode & 0o777)}, not the umask's")
+                return False
+
+        path = Path(directory) / "cut.bin"
+        receiver, sender = socket.socketpair()
+        sender.sendall(b"".join(frames[:10]))
+        sender.close()
+        received = receive_network_file(path, receiver, len(frames), staging=staging, sync=SyncPolicy.End)
+        receiver.close()
+        if received or path.exists() or any(staging.iterdir()):
+            print("A cut off upload was left behind")
+            return False
+
+    return True
+
+def upload_conflict_test() -> bool:
+    """
+    Checks that a second upload to a path is refused while the first is still being received, and that an upload does not replace a file put at its path in the meantime.
+    """
+    import tempfile
+    from pathlib import Path
+    import Server.io_tools as io_tools
+    import Server.server_io as server_io
+    from Server.io_tools import file_owner_db
+    from Server.server_io import RequestUpload, UploadFile
+    from Server.credentials import Credentials
+    from Common.file_io import split_binary_for_network
+    from Common.http_codes import HTTPErrorBasis
+
+    first = Credentials("first", "")
+    second = Credentials("second", "")
+    saved = io_tools.root_directory, server_io.staging_path
+    with tempfile.TemporaryDirectory() as directory:
+        base = Path(directory).resolve() / "data"
+        base.mkdir()
+        (Path(directory) / "staging").mkdir()
+        io_tools.root_directory = base
+        server_io.staging_path = Path(directory) / "staging"
+        file_owner_db.open(Path(directory) / "files.db")
+        try:
+            path = base / "song.mp3"
+            frames = split_binary_for_network(b"first's song")
+            handle = RequestUpload(path, len(frames), first)
+            if isinstance(handle, HTTPErrorBasis) or not isinstance(RequestUpload(path, len(frames), second), HTTPErrorBasis):
+                print("A second upload to a path being uploaded to was allowed")
+                return False
+
+            path.write_bytes(b"put here in the meantime")
+            receiver, sender = socket.socketpair()
+            sender.sendall(b"".join(frames))
+            uploaded = UploadFile(handle, receiver, len(frames))
+            receiver.close()
+            sender.close()
+            if uploaded or path.read_bytes() != b"put here in the meantime" or file_owner_db.get_file_owner(path) is not None:
+                print("The upload replaced a file put at its path")
+                return False
+
+            path.unlink()
+            handle = RequestUpload(path, len(frames), second)
+            if isinstance(handle, HTTPErrorBasis):
+                print("The path was still held once the upload was done")
+                return False
+            handle.release()
+        finally:
+            io_tools.root_directory, server_io.staging_path = saved
+            file_owner_db.close()
+
+    return True
+
+def read_cache_test(reads: int = 10_000) -> bool:
+    """
+    Checks that the read cache serves the same frames as the disk, that changing or replacing a file is noticed, and that the byte budget is kept. Also reports how long cached and uncached reads take.
+    """
+    import tempfile
+    import time
+    from pathlib import Path
+    from Server.read_cache import ReadCache
+
+    cache = ReadCache(max_bytes=64 * 1024, max_file_bytes=16 * 1024)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "small.txt"
+        path.write_bytes(os.urandom(10_000))
+
+        first = cache.read(path)
+        if [bytes(frame) for frame in first] != read_file_for_network(path) or cache.read(path) is not first:
+            print("Cached frames differ from the file, or were not shared")
+            return False
+
+        start = time.perf_counter()
+        for _ in range(reads):
+            cache.read(path)
+        cached = (time.perf_counter() - start) / reads
+        start = time.perf_counter()
+        for _ in range(reads // 10):
+            read_file_for_network(path)
+        uncached = (time.perf_counter() - start) / (reads // 10)
+        print(f"Read cached: {cached * 1e6:.1f}us, uncached: {uncached * 1e6:.1f}us")
+
+        replacement = Path(directory) / "replacement.txt"
+        replacement.write_bytes(b"changed")
+        os.replace(replacement, path)
+        if bytes(cache.read(path)[0]).rstrip(b"\x00") != b"changed":
+            print("A replaced file was served from the cache")
+            return False
+
+        for i in range(20):
+            (Path(directory) / f"{i}.txt").write_bytes(os.urandom(8000))
+            cache.read(Path(directory) / f"{i}.txt")
+        if cache.cached_bytes() > 64 * 1024:
+            print(f"The cache holds {cache.cached_bytes()} bytes, past its budget")
+            return False
+
+        large = Path(directory) / "large.bin"
+        large.write_bytes(os.urandom(20_000))
+        bytes_before = cache.cached_bytes()
+        if len(cache.read(large)) != 5 or cache.cached_bytes() != bytes_before:
+            print("A file past max_file_bytes was cached")
+            return False
+
+    print(f"Hits: {cache.hits}, misses: {cache.misses}")
+    return True
+
+def mapped_download_test(size: int = 64 * 1024 * 1024 + 100) -> bool:
+    """
+    Checks that a memory mapped file is sent as the same frames as read_file_for_network makes, and reports the Python memory each takes to send a large file.
+    """
+    import tempfile
+    import time
+    import tracemalloc
+    from pathlib import Path
+    from Server.mapped_file import MappedFrames
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "large.mp4"
+        path.write_bytes(os.urandom(size))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        mapped = MappedFrames(path)
+        count = len(mapped)
+        sent = 0
+        for chunk in mapped:
+            sent += len(chunk)
+        mapped_time = time.perf_counter() - start
+        mapped_peak = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        frames = read_file_for_network(path)
+        list_time = time.perf_counter() - start
+        list_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        read = b"".join(frames)
+        matches = count == len(frames) and sent == len(read) and b"".join(bytes(chunk) for chunk in mapped) == read
+        mapped.close()
+
+    print(f"Frames list: {list_time:.3f}s, {list_peak / 1e6:.1f}MB peak; mapped: {mapped_time:.3f}s, {mapped_peak / 1e6:.1f}MB peak")
+    return matches
+
+def range_download_test() -> bool:
+    """
+    Checks that ranges are resolved as documented, that only the bytes of the ranges are sent, and that a ranged download message reads back the same.
+    """
+    import tempfile
+    from pathlib import Path
+    from Server.mapped_file import MappedFrames, resolve_ranges
+
+    if resolve_ranges([(50, None), (0, 10), (5, 20), (20, 30), (2000, 3000)], 1000) != [(0, 30), (50, 1000)] or resolve_ranges([(1000, None)], 1000) is not None:
+        print("Ranges were not resolved as documented")
+        return False
+
+    contents = os.urandom(3 * 1024 * 1024 + 17)
+    ranges = [(0, 100), (1024 * 1024, 2 * 1024 * 1024 + 5), (len(contents) - 9, len(contents))]
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "movie.mp4"
+        path.write_bytes(contents)
+
+        frames = MappedFrames(path, ranges)
+        sent = b"".join(bytes(chunk) for chunk in frames)
+        count = len(frames)
+        frames.close()
+
+    expected = b"".join(contents[start:end] for start, end in ranges)
+    if len(sent) != count * 4096 or sent[:len(expected)] != expected or sent[len(expected):].strip(b"\x00") != b"":
+        print("The ranges sent do not match the file")
+        return False
+
+    request = MessageBasis.parse_from_json(DownloadMessage("movie.mp4", ranges=[(10, None)]).construct_message_json())
+    response = MessageBasis.parse_from_json(DownloadMessage(206, "Partial content", "video", count, ranges=ranges, total_size=len(contents)).construct_message_json(request=False))
+    if request.ranges() != [(10, None)] or response.ranges() != ranges or response.total_size() != len(contents):
+        print("The ranges of the messages were not read back")
+        return False
+
+    return True
+
+def relocate_test() -> bool:
+    """
+    Moves and copies a directory of files in a temporary root, and checks that the files, their owners, and the usage of their owner follow. Also reports how long moving and copying a large file takes.
+    """
+    import tempfile
+    import time
+    from pathlib import Path
+    import Server.io_tools as io_tools
+    import Server.server_io as server_io
+    from Server.io_tools import file_owner_db
+    from Server.server_io import RelocatePath
+    from Server.credentials import Credentials
+
+    user = Credentials("tester", "")
+    other = Credentials("other", "")
+    saved = io_tools.root_directory, server_io.root_directory, server_io.staging_path
+    with tempfile.TemporaryDirectory() as directory:
+        # The server's root & staging directories are pointed at the temporary directory for the test
+        base = Path(directory).resolve() / "data"
+        staging = Path(directory).resolve() / "staging"
+        base.mkdir()
+        staging.mkdir()
+        io_tools.root_directory = server_io.root_directory = base
+        server_io.staging_path = staging
+        file_owner_db.open(Path(directory) / "files.db")
+        try:
+            (base / "album" / "disc").mkdir(parents=True)
+            for name, size in [("album/a.mp3", 1000), ("album/disc/b.mp3", 2000), ("big.mp4", 256 * 1024 * 1024)]:
+                (base / name).write_bytes(os.urandom(size) if size < 1_000_000 else bytes(size))
+                file_owner_db.set_file_owner(base / name, user, size=size)
+
+            start = time.perf_counter()
+            moved = RelocatePath(base / "big.mp4", base / "films" / "big.mp4", RelocateAction.Move, user)
+            move_time = time.perf_counter() - start
+            start = time.perf_counter()
+            copied = RelocatePath(base / "films" / "big.mp4", base / "big copy.mp4", RelocateAction.Copy, user)
+            copy_time = time.perf_counter() - start
+            print(f"Moved 256MB in {move_time * 1000:.1f}ms, copied in {copy_time * 1000:.1f}ms")
+
+            if moved is not None or copied is not None or file_owner_db.get_file_owner(base / "films" / "big.mp4") != "tester" or file_owner_db.get_file_owner(base / "big.mp4") is not None:
+                print(f"The large file was not moved and copied: {moved}, {copied}")
+                return False
+
+            usage = file_owner_db.usage("tester")
+            if RelocatePath(base / "album", base / "renamed", RelocateAction.Move, user) is not None or RelocatePath(base / "renamed", base / "copied", RelocateAction.Copy, other) is not None:
+                print("The directory was not moved and copied")
+                return False
+
+            if file_owner_db.get_file_owner(base / "renamed" / "disc" / "b.mp3") != "tester" or file_owner_db.get_file_owner(base / "copied" / "disc" / "b.mp3") != "other":
+                print("Owners did not follow the directory")
+                return False
+            if file_owner_db.usage("tester") != usage or file_owner_db.usage("other") != 3000 or (base / "copied" / "a.mp3").read_bytes() != (base / "renamed" / "a.mp3").read_bytes():
+                print("Usage or contents did not follow the directory")
+                return False
+
+            refused = [
+                RelocatePath(base / "renamed", base / "new" / "parents" / "moved", RelocateAction.Move, other), # Not their files
+                RelocatePath(base / "renamed", base / "renamed" / "inside", RelocateAction.Copy, user),
+                RelocatePath(base / "renamed", base / "copied", RelocateAction.Copy, user), # Already there
+                RelocatePath(base / "renamed", base.parent / "outside", RelocateAction.Copy, user)
+            ]
+            if any(result is None for result in refused) or any(staging.iterdir()) or (base / "new").exists():
+                print(f"Relocations that should fail did not, or left something behind: {[result.code if result is not None else None for result in refused]}")
+                return False
+        finally:
+            io_tools.root_directory, server_io.root_directory, server_io.staging_path = saved
+            file_owner_db.close()
+
+    return True
 
 if __name__ == "__main__":
     if client_test_server():